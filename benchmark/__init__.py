@@ -0,0 +1,4 @@
+"""Benchmarks of calculator bot hot paths."""
+
+from .hotpath import REPOSITORIES, replay, run
+from .traces import TRACES
@@ -0,0 +1,91 @@
+"""
+Replays keypress traces through CalculatorService over every repository and
+reports ops/s, p50/p99 latency and peak memory.
+Usage:
+    python -m benchmark [--repository NAME] [--trace NAME] [--output FILE]
+                        [--baseline FILE] [--tolerance FRACTION]
+                        [--resp-latency SECONDS]
+The resp repository talks to a local fake server, answering every round
+trip after the given latency.
+Results are saved as JSON to be used as baseline of later runs, which exit
+with an error when any result regresses beyond the tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List, Tuple
+
+from . import hotpath
+from .hotpath import REPOSITORIES, Result, run
+from .traces import TRACES
+
+# Metric and whether higher values are better
+METRICS = (
+    ('ops_per_second', True),
+    ('p50_us', False),
+    ('p99_us', False),
+    ('peak_memory_bytes', False),
+)
+
+
+def regressions(results: List[Result], baseline: List[Result],
+                tolerance: float) -> List[str]:
+    """Describes results worse than their baseline beyond tolerance."""
+    expected: Dict[Tuple[str, str], Result] = {
+        (str(result['repository']), str(result['trace'])): result
+        for result in baseline
+    }
+    found = []
+    for result in results:
+        base = expected.get((str(result['repository']), str(result['trace'])))
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS:
+            value, reference = float(result[metric]), float(base[metric])
+            limit = reference * (1 - tolerance if higher_is_better else 1 + tolerance)
+            if (value < limit) if higher_is_better else (value > limit):
+                found.append('%s/%s %s: %.2f (baseline %.2f)' % (
+                    result['repository'], result['trace'], metric,
+                    value, reference))
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    parser.add_argument('--repository', action='append',
+                        choices=sorted(REPOSITORIES))
+    parser.add_argument('--trace', action='append', choices=sorted(TRACES))
+    parser.add_argument('--output', default='build/bench/results.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--resp-latency', type=float, default=0.0)
+    args = parser.parse_args()
+    hotpath.RESP_LATENCY = args.resp_latency
+
+    results = []
+    for repository in args.repository or sorted(REPOSITORIES):
+        for trace in args.trace or sorted(TRACES):
+            result = run(repository, trace, TRACES[trace])
+            print('%(repository)-8s %(trace)-17s %(ops)8d ops '
+                  '%(ops_per_second)10.0f ops/s p50 %(p50_us)8.1fus '
+                  'p99 %(p99_us)8.1fus peak %(peak_memory_bytes)10d B' % result)
+            results.append(result)
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+            found = regressions(results, json.load(baseline), args.tolerance)
+        for regression in found:
+            print('regression: %s' % regression, file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Local stand-in of the Telegram Bot API for load tests."""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Calculator',
+            'username': 'calculator_bot'}
+USER = {'id': 2, 'is_bot': False, 'first_name': 'User'}
+CHAT = {'id': 2, 'type': 'private', 'first_name': 'User'}
+
+
+class FakeBotApi:
+    """Bot API server answering getMe, getUpdates, editMessageText,
+    answerCallbackQuery and answerInlineQuery from memory.
+
+    Updates pushed with push_update are served to long polling clients and
+    every call is recorded with the time it was received. Latency and flood
+    errors (429) can be injected to every call but getUpdates.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0) -> None:
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls: List[Tuple[float, str, Dict[str, Any]]] = []
+        self.__random = random.Random(seed)
+        self.__updates: List[Dict[str, Any]] = []
+        self.__next_update_id = 1
+        self.__lock = threading.Lock()
+        self.__pushed = threading.Condition(self.__lock)
+        self.__server = ThreadingHTTPServer((host, port), self.__handler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, name='FakeBotApi', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        """Base URL to pass to the bot, which appends its token."""
+        host, port = self.__server.server_address[:2]
+        return 'http://%s:%d/bot' % (host, port)
+
+    def start(self) -> None:
+        """Starts serving requests."""
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Stops serving requests."""
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """Queues an update for getUpdates, returning its update id."""
+        with self.__lock:
+            update_id = self.__next_update_id
+            self.__next_update_id += 1
+            self.__updates.append(dict(update, update_id=update_id))
+            self.__pushed.notify_all()
+        return update_id
+
+    def calls_of(self, method: str) -> List[Tuple[float, Dict[str, Any]]]:
+        """Time and parameters of every call received to given method."""
+        with self.__lock:
+            return [(at, params) for at, name, params in self.calls
+                    if name == method]
+
+    def call(self, method: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Answers a Bot API call, returning HTTP status and response."""
+        with self.__lock:
+            self.calls.append((time.monotonic(), method, params))
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.__get_updates(params)}
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__lock:
+            flood = self.__random.random() < self.flood_rate
+        if flood:
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': 'Too Many Requests: retry after %d' % self.retry_after,
+                'parameters': {'retry_after': self.retry_after},
+            }
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': BOT_USER}
+        if method == 'editMessageText' and 'inline_message_id' not in params:
+            return 200, {'ok': True, 'result': {
+                'message_id': int(params.get('message_id') or 0),
+                'date': int(time.time()), 'chat': CHAT, 'from': BOT_USER,
+                'text': params.get('text', ''),
+            }}
+        return 200, {'ok': True, 'result': True}
+
+    def __get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.__pushed:
+            # Updates before the offset are confirmed by the client
+            self.__updates = [update for update in self.__updates
+                              if update['update_id'] >= offset]
+            while not self.__updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__pushed.wait(remaining)
+            return self.__updates[:limit]
+
+    def __handler(self) -> type:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and payload are written apart, which would otherwise
+            # wait for the delayed acknowledgement of the client
+            disable_nagle_algorithm = True
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                params: Optional[Dict[str, Any]] = None
+                try:
+                    params = json.loads(body) if body else dict()
+                except ValueError:
+                    params = dict()
+                method = self.path.rsplit('/', 1)[-1]
+                status, response = api.call(method, params or dict())
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        return Handler
@@ -0,0 +1,199 @@
+"""Local stand-in of a Redis protocol server for tests and benchmarks."""
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from calculator_bot.repository.resp import RespError
+
+
+class FakeRespServer:
+    """Redis protocol server answering PING, GET, SET with NX, XX, EX and PX
+    options, MGET, DEL, EXISTS, TTL and DBSIZE from memory.
+
+    Commands are counted, and latency can be injected to every round trip,
+    so commands sent at once in a pipeline only wait for it once.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0) -> None:
+        self.latency = latency
+        self.commands = 0
+        self.__values: Dict[bytes, Tuple[bytes, Optional[float]]] = dict()
+        self.__lock = threading.Lock()
+        self.__connections: Set[socket.socket] = set()
+        self.__server = socketserver.ThreadingTCPServer(
+            (host, port), self.__handler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, kwargs={'poll_interval': 0.05},
+            name='FakeRespServer', daemon=True)
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """Host and port the server listens to."""
+        host, port = self.__server.server_address[:2]
+        return str(host), int(port)
+
+    def start(self) -> None:
+        """Starts serving connections."""
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Stops serving connections, closing the open ones."""
+        self.__server.shutdown()
+        self.__server.server_close()
+        with self.__lock:
+            connections = list(self.__connections)
+            self.__connections.clear()
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def call(self, args: List[bytes]) -> Any:
+        """Runs a command, returning its reply or RespError."""
+        name = args[0].upper().decode()
+        with self.__lock:
+            self.commands += 1
+            now = time.monotonic()
+            if name == 'PING':
+                return 'PONG'
+            if name == 'GET' and len(args) == 2:
+                return self.__get(args[1], now)
+            if name == 'MGET' and len(args) > 1:
+                return [self.__get(key, now) for key in args[1:]]
+            if name == 'SET' and len(args) >= 3:
+                return self.__set(args[1], args[2], args[3:], now)
+            if name == 'DEL':
+                deleted = [key for key in set(args[1:])
+                           if self.__get(key, now) is not None]
+                for key in deleted:
+                    del self.__values[key]
+                return len(deleted)
+            if name == 'EXISTS':
+                return sum(self.__get(key, now) is not None for key in args[1:])
+            if name == 'TTL' and len(args) == 2:
+                if self.__get(args[1], now) is None:
+                    return -2
+                expires = self.__values[args[1]][1]
+                return -1 if expires is None else round(expires - now)
+            if name == 'DBSIZE':
+                return sum(self.__get(key, now) is not None
+                           for key in list(self.__values))
+        return RespError('ERR unknown command or wrong arguments: %s' % name)
+
+    def __get(self, key: bytes, now: float) -> Optional[bytes]:
+        entry = self.__values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self.__values[key]
+            return None
+        return entry[0]
+
+    def __set(self, key: bytes, value: bytes, options: List[bytes],
+              now: float) -> Any:
+        expires = None
+        condition = None
+        index = 0
+        while index < len(options):
+            option = options[index].upper()
+            if option in (b'NX', b'XX'):
+                condition = option
+            elif option in (b'EX', b'PX') and index + 1 < len(options):
+                index += 1
+                seconds = int(options[index]) / (1 if option == b'EX' else 1000)
+                expires = now + seconds
+            else:
+                return RespError('ERR syntax error')
+            index += 1
+        exists = self.__get(key, now) is not None
+        if (condition == b'NX' and exists) or (condition == b'XX' and not exists):
+            return None
+        self.__values[key] = (value, expires)
+        return 'OK'
+
+    def __handler(self) -> type:
+        server = self
+        lock, connections = self.__lock, self.__connections
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def setup(self) -> None:
+                with lock:
+                    connections.add(self.request)
+
+            def finish(self) -> None:
+                with lock:
+                    connections.discard(self.request)
+
+            def handle(self) -> None:
+                buffer = b''
+                while True:
+                    try:
+                        data = self.request.recv(65536)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    buffer += data
+                    commands, buffer = parse_commands(buffer)
+                    if not commands:
+                        continue
+                    replies = [encode_reply(server.call(args)) for args in commands]
+                    # Commands received at once wait for a single round trip
+                    time.sleep(server.latency)
+                    self.request.sendall(b''.join(replies))
+
+        return Handler
+
+
+def parse_commands(buffer: bytes) -> Tuple[List[List[bytes]], bytes]:
+    """Parses the complete commands of buffer, returning them along with the
+    remaining bytes."""
+    commands = []
+    position = 0
+    while True:
+        args, end = _parse_command(buffer, position)
+        if args is None:
+            return commands, buffer[position:]
+        commands.append(args)
+        position = end
+
+
+def _parse_command(buffer: bytes, position: int) -> Tuple[Optional[List[bytes]], int]:
+    end = buffer.find(b'\r\n', position)
+    if end < 0:
+        return None, position
+    count = int(buffer[position + 1:end])
+    position = end + 2
+    args = []
+    for _ in range(count):
+        end = buffer.find(b'\r\n', position)
+        if end < 0:
+            return None, position
+        length = int(buffer[position + 1:end])
+        start = end + 2
+        if len(buffer) < start + length + 2:
+            return None, position
+        args.append(buffer[start:start + length])
+        position = start + length + 2
+    return args, position
+
+
+def encode_reply(reply: Any) -> bytes:
+    """Encodes a reply in the Redis protocol."""
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, RespError):
+        return b'-%s\r\n' % str(reply).encode()
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode()
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(encode_reply(item) for item in reply)
@@ -0,0 +1,98 @@
+"""Benchmarks of the service and repository hot paths."""
+import gc
+import tempfile
+import tracemalloc
+from time import perf_counter, perf_counter_ns
+from typing import Callable, Dict, List, Union
+
+from calculator_bot.repository import (BoundedMemoryCalculatorRepository,
+                                       CalculatorRepository,
+                                       MemoryCalculatorRepository,
+                                       RespCalculatorRepository, RespClient,
+                                       SnapshotCalculatorRepository,
+                                       SqliteCalculatorRepository,
+                                       TieredCalculatorRepository)
+from calculator_bot.service import CalculatorService
+
+from .fake_resp import FakeRespServer
+from .traces import Trace
+
+Result = Dict[str, Union[str, int, float]]
+
+# Seconds injected to every round trip of the resp repository
+RESP_LATENCY = 0.0
+
+
+class _FakeRespCalculatorRepository(RespCalculatorRepository):
+    """Repository over a FakeRespServer of its own, run in this process and
+    stopped on close."""
+
+    def __init__(self, latency: float) -> None:
+        self.server = FakeRespServer(latency=latency)
+        self.server.start()
+        super().__init__(RespClient(*self.server.address))
+
+    def close(self) -> None:
+        super().close()
+        self.server.stop()
+
+
+REPOSITORIES: Dict[str, Callable[[str], CalculatorRepository]] = {
+    'memory': lambda _: MemoryCalculatorRepository(),
+    'bounded': lambda _: BoundedMemoryCalculatorRepository(10000, 60),
+    'sqlite': lambda directory: SqliteCalculatorRepository(
+        directory + '/calculators.db'),
+    'snapshot': lambda directory: SnapshotCalculatorRepository(
+        directory + '/calculators.snapshot'),
+    'tiered': lambda directory: TieredCalculatorRepository(
+        SqliteCalculatorRepository(directory + '/calculators.db')),
+    'resp': lambda _: _FakeRespCalculatorRepository(RESP_LATENCY),
+}
+
+
+def replay(service: CalculatorService, trace: Trace) -> List[int]:
+    """Replays trace through the service returning nanoseconds per keypress."""
+    latencies = []
+    for id_, key in trace:
+        start = perf_counter_ns()
+        result = service.get_or_create_calculator(id_)
+        if result.is_ok:
+            service.evaluate_calculator_expression(result.unwrap(), key)
+        latencies.append(perf_counter_ns() - start)
+    return latencies
+
+
+def percentile(sorted_values: List[int], fraction: float) -> int:
+    """Nearest rank percentile of sorted values."""
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run(repository: str, trace_name: str, trace: Callable[[], Trace]) -> Result:
+    """Runs a trace against a repository, timing it first and measuring its
+    peak memory in a second run, since tracing allocations slows it down."""
+    with tempfile.TemporaryDirectory() as directory:
+        repo = REPOSITORIES[repository](directory)
+        gc.collect()
+        start = perf_counter()
+        latencies = replay(CalculatorService(repo), trace())
+        elapsed = perf_counter() - start
+        repo.close()
+    with tempfile.TemporaryDirectory() as directory:
+        repo = REPOSITORIES[repository](directory)
+        gc.collect()
+        tracemalloc.start()
+        replay(CalculatorService(repo), trace())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        repo.close()
+    latencies.sort()
+    return {
+        'repository': repository,
+        'trace': trace_name,
+        'ops': len(latencies),
+        'ops_per_second': len(latencies) / elapsed,
+        'p50_us': percentile(latencies, 0.5) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'peak_memory_bytes': peak,
+    }
@@ -0,0 +1,169 @@
+"""
+End-to-end load test of the bot, run as `python -m calculator_bot`, against
+a local fake Bot API fed with storms of callback queries.
+Usage:
+    python -m benchmark.loadtest [--concurrency N [N ...]] [--keys K]
+                                 [--latency SECONDS] [--flood-rate FRACTION]
+                                 [--duplicate-rate FRACTION]
+                                 [--bot-env NAME=VALUE] [--output FILE]
+For every concurrency level, that many inline calculators type K digits at
+once, a fraction of them retried as clients do. It reports end-to-end
+updates/s, edit and answer latency and the keypresses dropped, shown out of
+order or shown twice.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+from .fake_api import USER, FakeBotApi
+from .hotpath import Result, percentile
+
+DIGITS = '123456789'
+
+
+def callback_query(message_id: str, query_id: str, data: str) -> Dict[str, Any]:
+    """Update of a key pressed in an inline calculator message."""
+    return {'callback_query': {
+        'id': query_id, 'from': USER, 'chat_instance': '1',
+        'inline_message_id': message_id, 'data': data,
+    }}
+
+
+def start_bot(api: FakeBotApi, env: Dict[str, str]) -> 'subprocess.Popen[bytes]':
+    """Starts the bot process against the fake Bot API."""
+    bot_env = dict(os.environ, TG_TOKEN='123:loadtest', TG_API_URL=api.base_url)
+    bot_env.update(env)
+    return subprocess.Popen([sys.executable, '-m', 'calculator_bot'], env=bot_env)
+
+
+def wait_polling(api: FakeBotApi, timeout: float) -> None:
+    """Waits until the bot polls for updates."""
+    deadline = time.monotonic() + timeout
+    while not api.calls_of('getUpdates'):
+        if time.monotonic() > deadline:
+            raise TimeoutError('bot did not start polling')
+        time.sleep(0.05)
+
+
+def run_level(api: FakeBotApi, name: str, concurrency: int, keys: int,
+              timeout: float, duplicate_rate: float = 0.0) -> Result:
+    """Types keys digits in concurrency calculators at once, pushing every
+    keypress twice at duplicate_rate, and waits for their edits to show
+    every digit or timeout."""
+    duplicates = random.Random(concurrency)
+    typed = {'%s-%d' % (name, user): ''.join(DIGITS[(user + index) % len(DIGITS)]
+                                               for index in range(keys))
+             for user in range(concurrency)}
+    pressed: Dict[str, List[float]] = {message_id: [] for message_id in typed}
+    queried: Dict[str, float] = dict()
+    start = time.monotonic()
+    for index in range(keys):
+        for message_id, digits in typed.items():
+            query_id = '%s-%d' % (message_id, index)
+            pressed[message_id].append(time.monotonic())
+            queried[query_id] = pressed[message_id][-1]
+            update = callback_query(message_id, query_id, digits[index])
+            api.push_update(update)
+            if duplicates.random() < duplicate_rate:
+                api.push_update(update)
+
+    deadline = time.monotonic() + timeout
+    shown: Dict[str, int] = dict()
+    while True:
+        latencies: List[float] = []
+        shown = {message_id: 0 for message_id in typed}
+        out_of_order = corrupted = 0
+        last_edit = start
+        for at, params in api.calls_of('editMessageText'):
+            message_id = params.get('inline_message_id')
+            if message_id not in typed:
+                continue
+            expr = str(params.get('text', '')).partition('\n> ')[2]
+            if not typed[message_id].startswith(expr):
+                corrupted += 1
+                continue
+            if len(expr) < shown[message_id]:
+                out_of_order += 1
+            shown[message_id] = max(shown[message_id], len(expr))
+            if expr:
+                latencies.append(at - pressed[message_id][len(expr) - 1])
+            last_edit = max(last_edit, at)
+        complete = all(count == keys for count in shown.values())
+        if complete or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+
+    acks_ms = sorted(int((at - queried[params['callback_query_id']]) * 1000)
+                     for at, params in api.calls_of('answerCallbackQuery')
+                     if params.get('callback_query_id') in queried) or [0]
+    updates = concurrency * keys
+    elapsed = max(last_edit - start, 1e-9)
+    latencies_ms = sorted(int(latency * 1000) for latency in latencies) or [0]
+    return {
+        'concurrency': concurrency,
+        'updates': updates,
+        'updates_per_second': updates / elapsed,
+        'edits': len(latencies),
+        'edit_p50_ms': percentile(latencies_ms, 0.5),
+        'edit_p99_ms': percentile(latencies_ms, 0.99),
+        'ack_p50_ms': percentile(acks_ms, 0.5),
+        'ack_p99_ms': percentile(acks_ms, 0.99),
+        'dropped': sum(keys - count for count in shown.values()),
+        'out_of_order': out_of_order,
+        'corrupted': corrupted,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark.loadtest')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16, 64])
+    parser.add_argument('--keys', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--bot-env', action='append', default=[])
+    parser.add_argument('--output', default='build/bench/loadtest.json')
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency, flood_rate=args.flood_rate)
+    api.start()
+    bot = start_bot(api, dict(env.split('=', 1) for env in args.bot_env))
+    results = []
+    try:
+        wait_polling(api, args.timeout)
+        for level, concurrency in enumerate(args.concurrency):
+            result = run_level(api, 'load%d' % level, concurrency, args.keys,
+                               args.timeout, args.duplicate_rate)
+            print('%(concurrency)4d calculators %(updates)6d updates '
+                  '%(updates_per_second)8.1f updates/s edits %(edits)6d '
+                  'p50 %(edit_p50_ms)6dms p99 %(edit_p99_ms)6dms '
+                  'ack p50 %(ack_p50_ms)6dms p99 %(ack_p99_ms)6dms '
+                  'dropped %(dropped)d out of order %(out_of_order)d '
+                  'corrupted %(corrupted)d' % result)
+            results.append(result)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(args.timeout)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Startup time of the bot, run as `python -m calculator_bot`, against a local
+fake Bot API with an update already waiting.
+Usage:
+    python -m benchmark.startup [--runs N] [--latency SECONDS]
+                                [--bot-env NAME=VALUE] [--output FILE]
+Every run starts the bot once with the getMe handshake before handlers are
+registered and once with it in the background (LAZY_START=1). It reports
+the median seconds since the process was started until the bot polls for
+updates and until it answers the waiting update.
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from .fake_api import FakeBotApi
+from .hotpath import Result
+from .loadtest import callback_query, start_bot
+
+MODES = {'eager': '0', 'lazy': '1'}
+
+
+def first_call(api: FakeBotApi, method: str, timeout: float) -> float:
+    """Waits for the first call to method, returning when it was received."""
+    deadline = time.monotonic() + timeout
+    while not api.calls_of(method):
+        if time.monotonic() > deadline:
+            raise TimeoutError('bot did not call %s' % method)
+        time.sleep(0.001)
+    return api.calls_of(method)[0][0]
+
+
+def run_once(latency: float, env: Dict[str, str], timeout: float) -> Dict[str, float]:
+    """Starts the bot once, returning the seconds until it polls and until
+    it answers the update waiting."""
+    api = FakeBotApi(latency=latency)
+    api.start()
+    api.push_update(callback_query('startup', 'startup', '1'))
+    started = time.monotonic()
+    bot = start_bot(api, env)
+    try:
+        ready = first_call(api, 'getUpdates', timeout) - started
+        answered = first_call(api, 'answerCallbackQuery', timeout) - started
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(timeout)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+    return {'ready': ready, 'first_update': answered}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark.startup')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--bot-env', action='append', default=[])
+    parser.add_argument('--output', default='build/bench/startup.json')
+    args = parser.parse_args()
+
+    env = dict(env.split('=', 1) for env in args.bot_env)
+    results: List[Result] = []
+    for mode, lazy_start in MODES.items():
+        runs = [run_once(args.latency, dict(env, LAZY_START=lazy_start),
+                         args.timeout) for _ in range(args.runs)]
+        result: Result = {
+            'mode': mode,
+            'runs': args.runs,
+            'ready_ms': round(1000 * statistics.median(
+                run['ready'] for run in runs)),
+            'first_update_ms': round(1000 * statistics.median(
+                run['first_update'] for run in runs)),
+        }
+        print('%(mode)-5s ready %(ready_ms)6dms first update '
+              '%(first_update_ms)6dms' % result)
+        results.append(result)
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
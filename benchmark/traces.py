@@ -0,0 +1,54 @@
+"""Keypress traces replayed by benchmarks."""
+import random
+from typing import Callable, Dict, Iterator, Tuple
+
+# A trace yields (calculator id, key) pairs in the order they are pressed
+Trace = Iterator[Tuple[str, str]]
+
+
+def short_sums(calculators: int = 1000, seed: int = 0) -> Trace:
+    """Every calculator types a couple of short sums and the result."""
+    rng = random.Random(seed)
+    for index in range(calculators):
+        for _ in range(2):
+            expr = '%d+%d=' % (rng.randint(0, 999), rng.randint(0, 999))
+            for key in expr:
+                yield str(index), key
+
+
+def long_chains(calculators: int = 10, length: int = 2000, seed: int = 0) -> Trace:
+    """A few calculators type very long chains of operations."""
+    rng = random.Random(seed)
+    for index in range(calculators):
+        for _ in range(length // 2):
+            yield str(index), rng.choice('123456789')
+            yield str(index), rng.choice('+-*')
+        yield str(index), '1'
+        yield str(index), '='
+
+
+def many_calculators(calculators: int = 20000, keys: int = 60000,
+                     seed: int = 0) -> Trace:
+    """Keypresses interleaved across many concurrent calculators."""
+    rng = random.Random(seed)
+    for _ in range(keys):
+        yield str(rng.randrange(calculators)), rng.choice('0123456789+-*/.=c')
+
+
+def equals_and_clear(calculators: int = 1000, rounds: int = 10,
+                     seed: int = 0) -> Trace:
+    """Calculators evaluating and clearing after every short expression."""
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        for index in range(calculators):
+            expr = '%d*%d=' % (rng.randint(1, 99), rng.randint(1, 99))
+            for key in expr + 'c':
+                yield str(index), key
+
+
+TRACES: Dict[str, Callable[[], Trace]] = {
+    'short_sums': short_sums,
+    'long_chains': long_chains,
+    'many_calculators': many_calculators,
+    'equals_and_clear': equals_and_clear,
+}
@@ -1,3 +1,13 @@
 """Module of Telegram bot for searching words definition."""
+from importlib import import_module
+from typing import Any
 
-from . import controller, service, repository, model
+__all__ = ['controller', 'service', 'repository', 'model']
+
+
+def __getattr__(name: str) -> Any:
+    # Subpackages are imported once used, so the ones importing telegram do
+    # not slow down the ones not needing it
+    if name in __all__:
+        return import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
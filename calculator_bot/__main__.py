@@ -7,30 +7,45 @@ Basic inline bot example. Applies different text transformations.
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
+# Startup is timed since imported, before the modules of the bot
+import calculator_bot.startup  # isort:skip  # pylint: disable=unused-import
 import logging
 import os
 import sys
 
-from calculator_bot.controller import TelegramCalculatorController
-from calculator_bot.repository import (CalculatorRepository,
-                                       MemoryCalculatorRepository)
-from calculator_bot.service.calculator import CalculatorService
+from calculator_bot.app import REPOSITORIES, run_calculator
 
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
 
 if __name__ == '__main__':
     token = os.getenv("TG_TOKEN")
+    api_url = os.getenv("TG_API_URL")
     log_level = os.getenv("LOG_LEVEL") or logging.ERROR
+    repository = os.getenv("REPOSITORY") or 'memory'
+    shards = int(os.getenv("SHARDS") or 0)
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_listen = os.getenv("WEBHOOK_LISTEN") or '0.0.0.0'
+    webhook_port = int(os.getenv("WEBHOOK_PORT") or 8443)
 
     if not token:
         logging.error("Missing telegram token. May forgive to set TG_TOKEN?")
         sys.exit(1)
 
-    # Enable logger
-    logging.basicConfig(level=log_level)
+    if repository not in REPOSITORIES:
+        logging.error("Unknown repository: %s", repository)
+        sys.exit(1)
 
-    repo: CalculatorRepository = MemoryCalculatorRepository()
-    svc: CalculatorService = CalculatorService(repo)
-    ctrl = TelegramCalculatorController(token, svc)
-    ctrl.run()
+    if shards > 0:
+        from calculator_bot.controller import (  # pylint: disable=import-outside-toplevel
+            ShardedController, ShardPool)
+        # Enable logger
+        logging.basicConfig(level=log_level)
+        pool = ShardPool(shards, run_calculator, shards)
+        front = ShardedController(token, pool, api_url)
+        if webhook_url:
+            front.run_webhook(webhook_url, webhook_listen, webhook_port)
+        else:
+            front.run()
+    else:
+        run_calculator()
@@ -0,0 +1,216 @@
+"""Module of the bot application configured by the environment."""
+import logging
+import os
+import sys
+from queue import Queue
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from calculator_bot.logs import BackgroundLogging
+from calculator_bot.metrics import Metrics
+from calculator_bot.model.expression import Number
+from calculator_bot.repository import (BoundedMemoryCalculatorRepository,
+                                       CalculatorRepository,
+                                       InstrumentedCalculatorRepository,
+                                       MemoryCalculatorRepository,
+                                       RespCalculatorRepository, RespClient,
+                                       SnapshotCalculatorRepository,
+                                       SqliteCalculatorRepository,
+                                       TieredCalculatorRepository)
+from calculator_bot.service.cache import LRUCache
+from calculator_bot.service.calculator import CalculatorService
+from calculator_bot.startup import IMPORT, StartupReport
+
+if TYPE_CHECKING:
+    from calculator_bot.controller import (PooledRequest, SlowUpdateProfiler,
+                                           TelegramCalculatorController)
+
+REPOSITORIES = ('memory', 'resp', 'snapshot', 'sqlite')
+
+
+def run_calculator(shard: Optional[int] = None,
+                   updates: 'Optional[Queue[Optional[Dict[str, Any]]]]' = None,
+                   shards: int = 1) -> None:
+    """Runs the bot, or the worker of a shard reading updates from the
+    queue, as configured by the environment."""
+    startup = StartupReport()
+    # Imported once run, as telegram takes most of the startup
+    import calculator_bot.controller  # pylint: disable=import-outside-toplevel,unused-import
+    startup.mark(IMPORT)
+    logs = _start_logging()
+    # Every shard owns its own files and metrics port
+    repo = _build_repository('' if shard is None else '.%d' % shard)
+    metrics = _start_metrics(shard, startup, logs)
+    if metrics is not None:
+        repo = InstrumentedCalculatorRepository(repo, metrics)
+    ctrl = _build_controller(repo, metrics, startup, shards)
+    _start_transport(ctrl, updates)
+    repo.close()
+    if metrics is not None:
+        metrics.close()
+    logs.close()
+
+
+def _start_logging() -> BackgroundLogging:
+    """Logging configured by the environment, records written, and
+    repeated ones sampled, off the handler threads."""
+    log_level = os.getenv("LOG_LEVEL") or logging.ERROR
+    log_queue_size = int(os.getenv("LOG_QUEUE_SIZE") or 10000)
+    log_burst = int(os.getenv("LOG_BURST") or 10)
+    log_sample = int(os.getenv("LOG_SAMPLE") or 100)
+    log_interval = float(os.getenv("LOG_INTERVAL") or 60)
+
+    # Enable logger
+    logging.basicConfig(level=log_level)
+    logs = BackgroundLogging(log_queue_size, log_burst, log_sample,
+                             log_interval)
+    logs.install()
+    return logs
+
+
+def _build_repository(suffix: str) -> CalculatorRepository:
+    """Repository configured by the environment, its files named with
+    suffix."""
+    repository = os.getenv("REPOSITORY") or 'memory'
+    sqlite_path = os.getenv("SQLITE_PATH") or 'calculators.db'
+    snapshot_path = os.getenv("SNAPSHOT_PATH") or 'calculators.snapshot'
+    snapshot_interval = float(os.getenv("SNAPSHOT_INTERVAL") or 60)
+    memory_max_entries = int(os.getenv("MEMORY_MAX_ENTRIES") or 0)
+    memory_ttl = float(os.getenv("MEMORY_TTL") or 0)
+    tier_idle = float(os.getenv("TIER_IDLE") or 0)
+    tier_interval = float(os.getenv("TIER_INTERVAL") or 30)
+    resp_host = os.getenv("RESP_HOST") or 'localhost'
+    resp_port = int(os.getenv("RESP_PORT") or 6379)
+    resp_expiry = int(os.getenv("RESP_EXPIRY") or 0)
+
+    tiered = tier_idle > 0 and repository != 'memory'
+    bounded = memory_max_entries > 0 or memory_ttl > 0
+    repo: CalculatorRepository
+    if repository == 'sqlite':
+        repo = SqliteCalculatorRepository(sqlite_path + suffix)
+    elif repository == 'snapshot':
+        # Calculators of the last snapshot are decoded once used, and the
+        # ones saved are only kept by the memory in front, if any
+        repo = SnapshotCalculatorRepository(snapshot_path + suffix,
+                                            snapshot_interval,
+                                            not (tiered or bounded))
+    elif repository == 'resp':
+        # Shared by every shard and host
+        repo = RespCalculatorRepository(RespClient(resp_host, resp_port),
+                                        expiry=resp_expiry or None)
+    else:
+        repo = MemoryCalculatorRepository()
+    if tiered:
+        # Idle calculators are demoted to storage in the background
+        repo = TieredCalculatorRepository(repo, tier_idle, tier_interval)
+    elif bounded:
+        # Bounded memory replaces the plain one or sits in front of storage
+        repo = BoundedMemoryCalculatorRepository(
+            memory_max_entries or sys.maxsize,
+            memory_ttl or float('inf'),
+            repo if repository != 'memory' else None
+        )
+    return repo
+
+
+def _start_metrics(shard: Optional[int], startup: StartupReport,
+                   logs: BackgroundLogging) -> Optional[Metrics]:
+    """Metrics served as configured by the environment, if any, as nothing
+    is instrumented unless metrics are served."""
+    metrics_listen = os.getenv("METRICS_LISTEN") or '0.0.0.0'
+    metrics_port = int(os.getenv("METRICS_PORT") or 0)
+    if metrics_port <= 0:
+        return None
+    metrics = Metrics()
+    metrics.serve(metrics_listen, metrics_port + (shard or 0))
+    startup.gauge(metrics)
+    metrics.gauge('suppressed_log_records', lambda: logs.suppressed)
+    metrics.gauge('dropped_log_records', lambda: logs.dropped)
+    return metrics
+
+
+def _build_controller(repo: CalculatorRepository, metrics: Optional[Metrics],
+                      startup: StartupReport,
+                      shards: int) -> 'TelegramCalculatorController':
+    """Controller configured by the environment over the calculators of
+    repo."""
+    from calculator_bot.controller import (  # pylint: disable=import-outside-toplevel
+        OutboundScheduler, TelegramCalculatorController)
+    token = os.getenv("TG_TOKEN") or ''
+    api_url = os.getenv("TG_API_URL")
+    workers = int(os.getenv("WORKERS") or 4)
+    edit_window = float(os.getenv("EDIT_WINDOW") or 0.5)
+    api_rate = float(os.getenv("API_RATE") or 30)
+    api_chat_rate = float(os.getenv("API_CHAT_RATE") or 1)
+    inline_cache_time = int(os.getenv("INLINE_CACHE_TIME") or 300)
+    dedup_window = int(os.getenv("DEDUP_WINDOW") or 10000)
+    lazy_start = bool(int(os.getenv("LAZY_START") or 0))
+
+    return TelegramCalculatorController(
+        token, _build_service(repo, metrics), workers, edit_window,
+        # Shards share the Bot API rate limit of the bot
+        OutboundScheduler(api_rate / shards, api_chat_rate, workers=workers,
+                          metrics=metrics),
+        api_url, metrics, _build_profiler(), inline_cache_time, dedup_window,
+        _build_request(workers), startup, lazy_start,
+        # Other processes edit the messages of calculators they share, so
+        # what this one sent last tells nothing
+        render_cache_size=0 if repo.shared else 10000
+    )
+
+
+def _build_service(repo: CalculatorRepository,
+                   metrics: Optional[Metrics]) -> CalculatorService:
+    """Service configured by the environment over the calculators of repo."""
+    cache_size = int(os.getenv("EXPRESSION_CACHE_SIZE") or 0)
+    history_depth = int(os.getenv("HISTORY_DEPTH") or 32)
+
+    cache: Optional[LRUCache[str, Optional[Number]]] = \
+        LRUCache(cache_size) if cache_size > 0 else None
+    return CalculatorService(repo, cache, metrics, history_depth)
+
+
+def _build_profiler() -> 'Optional[SlowUpdateProfiler]':
+    """Profiler of slow updates configured by the environment, if any."""
+    from calculator_bot.controller import (  # pylint: disable=import-outside-toplevel
+        SlowUpdateProfiler)
+    profile_dir = os.getenv("PROFILE_DIR")
+    profile_sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+    profile_threshold = os.getenv("PROFILE_THRESHOLD")
+    profile_keep = int(os.getenv("PROFILE_KEEP") or 100)
+
+    if not profile_dir:
+        return None
+    return SlowUpdateProfiler(
+        profile_dir, profile_sample_rate,
+        float(profile_threshold) if profile_threshold else None,
+        profile_keep
+    )
+
+
+def _build_request(workers: int) -> 'PooledRequest':
+    """Pooled connections to the Bot API configured by the environment."""
+    from calculator_bot.controller import (  # pylint: disable=import-outside-toplevel
+        PooledRequest)
+    api_pool_size = int(os.getenv("API_POOL_SIZE") or workers + 4)
+    api_connect_timeout = float(os.getenv("API_CONNECT_TIMEOUT") or 5)
+    api_read_timeout = float(os.getenv("API_READ_TIMEOUT") or 5)
+
+    # Long polls have their own connection, and their own read timeout
+    return PooledRequest(api_pool_size, api_connect_timeout, api_read_timeout,
+                         PooledRequest(1, api_connect_timeout))
+
+
+def _start_transport(ctrl: 'TelegramCalculatorController',
+                     updates: 'Optional[Queue[Optional[Dict[str, Any]]]]') -> None:
+    """Runs the controller on the updates of the queue, if any, or of a
+    webhook or long polling as configured by the environment, until
+    stopped."""
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_listen = os.getenv("WEBHOOK_LISTEN") or '0.0.0.0'
+    webhook_port = int(os.getenv("WEBHOOK_PORT") or 8443)
+    if updates is not None:
+        ctrl.run_shard(updates)
+    elif webhook_url:
+        ctrl.run_webhook(webhook_url, webhook_listen, webhook_port)
+    else:
+        ctrl.run()
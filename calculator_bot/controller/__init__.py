@@ -1,3 +1,8 @@
 """Module of application controllers."""
 
 from .calculator import TelegramCalculatorController
+from .profiler import SlowUpdateProfiler
+from .ratelimit import OutboundScheduler
+from .request import PooledRequest
+from .shard import ShardedController, ShardPool
+from .webhook import WebhookServer
@@ -1,168 +1,467 @@
 """Module of definition controller."""
 
+import asyncio
 import logging
-from collections import defaultdict
-from threading import Lock
-from typing import DefaultDict
-from uuid import uuid4
+from concurrent.futures import Future
+from functools import partial
+from queue import Queue
+from signal import SIGABRT, SIGINT, SIGTERM
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-from telegram import (InlineKeyboardMarkup, InlineQueryResultArticle,
-                      InputTextMessageContent, Update)
+from telegram import (Bot, CallbackQuery, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, TelegramError, Update)
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, InlineQueryHandler, Updater)
-from telegram.inline.inlinekeyboardbutton import InlineKeyboardButton
+                          CommandHandler, Dispatcher, DispatcherHandlerStop,
+                          ExtBot, InlineQueryHandler, TypeHandler, Updater)
 from telegram.message import Message
 from telegram.parsemode import ParseMode
 
+from calculator_bot.metrics import Metrics
+from calculator_bot.service.cache import LRUCache, normalize_query
 from calculator_bot.service.calculator import CalculatorService
+from calculator_bot.startup import (FIRST_UPDATE, HANDSHAKE, READY,
+                                    StartupReport)
+
+from .coalescer import EditCoalescer
+from .dedup import RecentIds
+from .executor import KeyedExecutor
+from .profiler import SlowUpdateProfiler
+from .ratelimit import (ANSWER_PRIORITY, EDIT_PRIORITY, REPLY_PRIORITY,
+                        OutboundScheduler)
+from .render import (CALCULATOR_ARTICLE, CALCULATOR_KEYBOARD, RenderCache,
+                     render_calculator, render_result_article)
+from .request import PooledRequest
+from .shard import ANSWERED_INLINE
+from .webhook import WebhookServer
+
+
+class _TokenIdBot(ExtBot):
+    """Bot telling its id from its token, without the getMe handshake
+    Updater waits for when naming its threads."""
+
+    __slots__ = ()
+
+    @property
+    def id(self) -> int:  # pylint: disable=invalid-name
+        return int(self.token.split(':', 1)[0])
 
 
 class TelegramCalculatorController:
     """Definition Controller for telegram bot inline queries."""
 
-    def __init__(self, token: str, service: CalculatorService) -> None:
+    def __init__(self, token: str, service: CalculatorService,
+                 workers: int = 4, edit_window: float = 0.5,
+                 scheduler: Optional[OutboundScheduler] = None,
+                 base_url: Optional[str] = None,
+                 metrics: Optional[Metrics] = None,
+                 profiler: Optional[SlowUpdateProfiler] = None,
+                 inline_cache_time: int = 300,
+                 dedup_window: int = 10000,
+                 request: Optional[PooledRequest] = None,
+                 startup: Optional[StartupReport] = None,
+                 background_handshake: bool = False,
+                 render_cache_size: int = 10000) -> None:
         self.token = token
+        self.base_url = base_url
         self.service = service
-        self.locks: DefaultDict[str, Lock] = defaultdict(Lock)
+        self.workers = workers
+        self.executor = KeyedExecutor(workers)
+        self.coalescer = EditCoalescer(self.executor, edit_window)
+        self.scheduler = scheduler or OutboundScheduler(workers=workers)
+        # A connection per worker sending calls, along with the ones of the
+        # dispatcher and main threads Updater expects
+        self.request = request or PooledRequest(
+            workers + 4, polling=PooledRequest(1))
+        self.__keypresses: Dict[str, List[Tuple[Update, CallbackContext]]] = dict()
+        self.__keypresses_lock = Lock()
+        # Latest edit of every message waiting for the one in flight
+        self.__edits: Dict[str, Optional[Tuple[Update, CallbackContext, str]]] = dict()
+        self.__edits_lock = Lock()
+        self.renders = RenderCache(render_cache_size)
+        self.inline_cache_time = inline_cache_time
+        self.answers: LRUCache[str, List[InlineQueryResultArticle]] = LRUCache(10000)
+        # Ids of the updates and callback queries handled lately, and of the
+        # callback queries answered in the webhook response
+        self.recent = RecentIds(dedup_window)
+        self.answered = RecentIds()
+        self.metrics = metrics
+        self.profiler = profiler
+        self.startup = startup or StartupReport()
+        self.background_handshake = background_handshake
+        self.__received = False
+        self.__evaluate = self.__instrument(
+            'callbackquery_batch', self.__evaluate_callbackqueries)
+        if metrics is not None:
+            metrics.gauge('skipped_edits', lambda: self.renders.skipped)
+            metrics.gauge('duplicate_updates', lambda: self.recent.duplicates)
+            self.__gauge_request(metrics, 'api', self.request)
+            if self.request.polling is not None:
+                self.__gauge_request(metrics, 'polling', self.request.polling)
+            metrics.gauge('inline_cache_hits', lambda: self.answers.hits)
+            metrics.gauge('inline_cache_misses', lambda: self.answers.misses)
+            metrics.gauge('queue_depth', lambda: len(self.executor), queue='keyed')
+            metrics.gauge('queue_depth', lambda: len(self.__keypresses),
+                          queue='keypresses')
+
+    def deduplicate(self, update: Update, context: CallbackContext) -> None:
+        """Stop handling updates, or callback queries retried by clients,
+        already handled."""
+        if not self.__received:
+            self.__received = True
+            if self.startup.mark(FIRST_UPDATE):
+                logging.info('Startup times: %s', self.startup)
+        if not self.recent.add(('update', update.update_id)):
+            raise DispatcherHandlerStop()
+        if update.callback_query and \
+                not self.recent.add(('callback_query', update.callback_query.id)):
+            raise DispatcherHandlerStop()
 
     def start(self, update: Update, context: CallbackContext) -> None:
         """Send a message when the command /start is issued."""
         if update.message is not None:
-            update.message.reply_text(
+            self.scheduler.submit(
+                REPLY_PRIORITY, update.message.chat_id,
+                update.message.reply_text,
                 'Hi! Try to create a new calculator using /new command')
 
     def help_command(self, update: Update, context: CallbackContext) -> None:
         """Send a message when the command /help is issued."""
         if update.message is not None:
-            update.message.reply_text('Help!')
+            self.scheduler.submit(
+                REPLY_PRIORITY, update.message.chat_id,
+                update.message.reply_text, 'Help!')
 
     def new_command(self, update: Update, context: CallbackContext) -> None:
         """Send a calculator message when the command /new is issued."""
         if update.message is not None:
-            update.message.reply_text(
+            self.scheduler.submit(
+                REPLY_PRIORITY, update.message.chat_id,
+                update.message.reply_text,
                 '__Start typing number to calculate__',
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=self.create_inline_markup_keyboard()
+                reply_markup=CALCULATOR_KEYBOARD
             )
 
+    def history_command(self, update: Update, context: CallbackContext) -> None:
+        """Send the latest results of the calculator replied to when the
+        command /history is issued."""
+        if update.message is None:
+            return
+        reply = update.message.reply_to_message
+        if reply is None:
+            text = 'Reply to a calculator message with /history'
+        else:
+            result = self.service.get_recent_results(str(reply.message_id))
+            if result.is_err:
+                text = 'No calculator found'
+            elif not result.unwrap():
+                text = 'No results yet'
+            else:
+                text = 'Latest results:\n' + '\n'.join(
+                    '%g' % value for value in reversed(result.unwrap()))
+        self.scheduler.submit(
+            REPLY_PRIORITY, update.message.chat_id,
+            update.message.reply_text, text)
+
     def inlinequery(self, update: Update, context: CallbackContext) -> None:
         """Handle the inline query."""
         if update.inline_query is not None:
-            results = [
-                InlineQueryResultArticle(
-                    id=str(uuid4()),
-                    title='Create new calculator',
-                    input_message_content=InputTextMessageContent(
-                        '__Start typing number to calculate__',
-                        parse_mode=ParseMode.MARKDOWN
-                    ),
-                    reply_markup=self.create_inline_markup_keyboard()
-                )
-            ]
-            update.inline_query.answer(results)
+            expr = normalize_query(update.inline_query.query)
+            cached = self.answers.get(expr)
+            if cached.is_some:
+                results = cached.unwrap()
+            else:
+                results = [CALCULATOR_ARTICLE]
+                value = self.service.evaluate_query(expr)
+                if value.is_ok:
+                    results.insert(0, render_result_article(expr, value.unwrap()))
+                self.answers.put(expr, results)
+            # Answers only depend on the query, so Telegram may share them
+            self.scheduler.submit(
+                REPLY_PRIORITY, None, update.inline_query.answer, results,
+                cache_time=self.inline_cache_time, is_personal=False)
 
     def callbackquery(self, update: Update, context: CallbackContext) -> None:
         """Handle the callback queries."""
         if update.callback_query:
+            if update.callback_query.id not in self.answered:
+                # Stops the client spinner before the keypress is evaluated
+                self.__answer_callbackquery(update.callback_query)
             message_id: str = str(update.callback_query.message.message_id \
                 if update.callback_query.message \
                 else update.callback_query.inline_message_id)
-            locked = self.locks[message_id].locked()
-            expr = update.callback_query.data
-            if not expr:
+            with self.__keypresses_lock:
+                keypresses = self.__keypresses.setdefault(message_id, [])
+                keypresses.append((update, context))
+                if len(keypresses) > 1:
+                    # Evaluated along with the keypresses already queued
+                    return
+            # Keypresses of the same message are evaluated in order
+            self.executor.submit(message_id, self.__evaluate, message_id)
+
+    def __answer_callbackquery(self, query: CallbackQuery) -> None:
+        start = perf_counter()
+        future = self.scheduler.submit(ANSWER_PRIORITY, None, query.answer)
+        metrics = self.metrics
+        if metrics is not None:
+            future.add_done_callback(lambda _: metrics.observe(
+                'callback_ack_seconds', perf_counter() - start))
+
+    def __evaluate_callbackqueries(self, message_id: str) -> None:
+        with self.__keypresses_lock:
+            keypresses = self.__keypresses.pop(message_id)
+        exprs = []
+        for update, _ in keypresses:
+            if update.callback_query and update.callback_query.data:
+                exprs.append((message_id, update.callback_query.data))
+            else:
                 logging.debug(
                     'failed answering callback query with empty expression')
+        if not exprs:
+            return
+        result = self.service.evaluate_batch(exprs)[message_id]
+        if result.is_err:
+            logging.error(
+                'failed evaluating calculator expressions: %s', result.unwrap_err())
+            return
+        text = render_calculator(result.unwrap())
+        # Only the latest text is sent once no keypress is left, or the edit
+        # window passes
+        update, context = keypresses[-1]
+        self.coalescer.schedule(
+            message_id, self.__edit_callbackquery,
+            update, context, message_id, text
+        )
+        if self.executor.pending(message_id) <= 1:
+            self.coalescer.drain(message_id)
+
+    def __edit_callbackquery(self, update: Update, context: CallbackContext,
+                             message_id: str, text: str) -> None:
+        with self.__edits_lock:
+            if message_id in self.__edits:
+                # Sent once the edit in flight is done, so they are not reordered
+                self.__edits[message_id] = (update, context, text)
                 return
-            result = self.service.get_or_create_calculator(str(message_id))
-            if result.is_err:
-                logging.error(
-                    'failed get or creating calculator for message: %s',
-                    result.unwrap_err()
-                )
-                return
-            result = self.service.evaluate_calculator_expression(
-                result.unwrap(), expr
+            self.__edits[message_id] = None
+        self.__send_edit(update, context, message_id, text)
+
+    def __send_edit(self, update: Update, context: CallbackContext,
+                    message_id: str, text: str) -> None:
+        future = self.__submit_edit(update, context, message_id, text)
+        if future is None:
+            self.__next_edit(message_id)
+        else:
+            # Workers do not wait for edits throttled by the chat rate limit
+            inline = update.callback_query.message is None
+            future.add_done_callback(partial(
+                self.__edited, message_id, text if inline else None))
+
+    def __submit_edit(self, update: Update, context: CallbackContext,
+                      message_id: str, text: str) -> 'Optional[Future[Any]]':
+        if update.callback_query is None:
+            return None
+        if update.callback_query.message:
+            # Messages of chats come with their text, which tells whether
+            # they need the edit, whatever was sent before
+            if text == update.callback_query.message.text:
+                self.renders.skipped += 1
+                return None
+            return self.scheduler.submit(
+                EDIT_PRIORITY, update.callback_query.message.chat_id,
+                update.callback_query.message.edit_text,
+                text,
+                reply_markup=CALCULATOR_KEYBOARD
             )
-            if result.is_err:
-                logging.error(
-                    'failed evaluating calculator expression: %s', result.unwrap_err())
-                return
-            calc = result.unwrap()
-            text = ('%g' % calc.value).ljust(50)
-            text += ('\n> %s' % calc.expr)
-            if update.callback_query.message:
-                if text != update.callback_query.message.text:
-                    message = update.callback_query.message.edit_text(
-                        text,
-                        reply_markup=self.create_inline_markup_keyboard()
-                    )
-                    if not isinstance(message, Message):
-                        logging.error(
-                            'failed editing callback message: %s', message)
-            else:
-                message = context.bot.edit_message_text(
-                    text,
-                    inline_message_id=message_id,
-                    reply_markup=self.create_inline_markup_keyboard()
-                )
-                if not isinstance(message, Message):
-                    logging.error(
-                        'failed editing callback message: %s', message)
-            if locked:
-                self.locks[message_id].release()
+        if self.renders.is_sent(message_id, text):
+            return None
+        return self.scheduler.submit(
+            EDIT_PRIORITY, None,
+            context.bot.edit_message_text,
+            text,
+            inline_message_id=message_id,
+            reply_markup=CALCULATOR_KEYBOARD
+        )
+
+    def __edited(self, message_id: str, inline_text: Optional[str],
+                 future: 'Future[Any]') -> None:
+        error = future.exception()
+        # Edits of messages return the message, and of inline messages True
+        message = error or future.result()
+        if isinstance(message, Message) or message is True:
+            if inline_text is not None:
+                self.renders.mark_sent(message_id, inline_text)
+        else:
+            logging.error('failed editing callback message: %s', message)
+        self.__next_edit(message_id)
+
+    def __next_edit(self, message_id: str) -> None:
+        with self.__edits_lock:
+            pending = self.__edits.pop(message_id)
+            if pending is not None:
+                self.__edits[message_id] = None
+        if pending is not None:
+            self.__send_edit(pending[0], pending[1], message_id, pending[2])
 
     def create_inline_markup_keyboard(self) -> InlineKeyboardMarkup:
-        """Creates inline keyboard markup for calculators."""
-        return InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton('7', callback_data='7'),
-                InlineKeyboardButton('8', callback_data='8'),
-                InlineKeyboardButton('9', callback_data='9'),
-                InlineKeyboardButton('*', callback_data='*'),
-                InlineKeyboardButton('/', callback_data='/')
-            ],
-            [
-                InlineKeyboardButton('4', callback_data='4'),
-                InlineKeyboardButton('5', callback_data='5'),
-                InlineKeyboardButton('6', callback_data='6'),
-                InlineKeyboardButton('+', callback_data='+'),
-                InlineKeyboardButton('-', callback_data='-')
-            ],
-            [
-                InlineKeyboardButton('1', callback_data='1'),
-                InlineKeyboardButton('2', callback_data='2'),
-                InlineKeyboardButton('3', callback_data='3'),
-                InlineKeyboardButton('=', callback_data='='),
-                InlineKeyboardButton('c', callback_data='c'),
-            ],
-            [
-                InlineKeyboardButton('0', callback_data='0'),
-                InlineKeyboardButton('.', callback_data='.'),
-            ]
-        ])
+        """Returns the inline keyboard markup shared by calculators."""
+        return CALCULATOR_KEYBOARD
 
     def run(self) -> None:
         """Run the bot."""
-        updater = Updater(self.token)
-        me_info = updater.bot.get_me()
-        logging.info('Starting updater for bot: %s', me_info)
+        updater = self.__create_updater()
+
+        # Start the Bot
+        updater.start_polling()
+        self.startup.mark(READY)
+
+        # Block until the user presses Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+        self.__shutdown()
+
+    def run_webhook(self, url: str, listen: str = '0.0.0.0', port: int = 8443) -> None:
+        """Run the bot receiving updates through a webhook at given url."""
+        updater = self.__create_updater()
+        dispatcher = updater.dispatcher
+        updater.bot.set_webhook(url)
+
+        # Updates are processed by the dispatcher thread as in polling mode
+        thread = Thread(target=dispatcher.start, name='Dispatcher')
+        thread.start()
+        server = WebhookServer(
+            partial(self.webhook_update, dispatcher),
+            listen, port, urlparse(url).path or '/'
+        )
+
+        async def serve() -> None:
+            loop = asyncio.get_running_loop()
+            for signum in (SIGINT, SIGTERM, SIGABRT):
+                loop.add_signal_handler(signum, server.stop)
+            self.startup.mark(READY)
+            await server.serve()
+
+        # Block until the process receives SIGINT, SIGTERM or SIGABRT
+        asyncio.run(serve())
+        dispatcher.stop()
+        thread.join()
+        self.__shutdown()
+
+    def run_shard(self, updates: 'Queue[Optional[Dict[str, Any]]]') -> None:
+        """Run the bot as worker of a shard pool, handling the updates read
+        from the queue until None."""
+        updater = self.__create_updater()
+        dispatcher = updater.dispatcher
+        ready = Event()
+        thread = Thread(target=dispatcher.start, args=(ready,), name='Dispatcher')
+        thread.start()
+        ready.wait()
+        self.startup.mark(READY)
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            if data.pop(ANSWERED_INLINE, False):
+                self.answered.add(data['callback_query']['id'])
+            update = Update.de_json(data, dispatcher.bot)
+            if update is not None:
+                dispatcher.update_queue.put(update)
+        # Dispatcher stops once its queue is empty
+        dispatcher.stop()
+        thread.join()
+        self.__shutdown()
+
+    def webhook_update(self, dispatcher: Dispatcher, data: Dict[str, Any]) \
+            -> Optional[Dict[str, Any]]:
+        """Queue update received through the webhook, returning the Bot API
+        method to answer it with in the webhook response, if any."""
+        update = Update.de_json(data, dispatcher.bot)
+        if update is None:
+            return None
+        if update.callback_query:
+            self.answered.add(update.callback_query.id)
+        dispatcher.update_queue.put(update)
+        if update.callback_query:
+            # Saves the round trip of answering the callback query
+            return {
+                'method': 'answerCallbackQuery',
+                'callback_query_id': update.callback_query.id,
+            }
+        return None
+
+    def __create_updater(self) -> Updater:
+        bot = _TokenIdBot(self.token, self.base_url, request=self.request)
+        updater = Updater(bot=bot, workers=self.workers)
+        if self.background_handshake:
+            # Updates are received while the token is checked
+            Thread(target=self.__handshake, args=(bot,), name='Handshake',
+                   daemon=True).start()
+        else:
+            self.__handshake(bot)
 
         # Get the dispatcher to register handlers
         dispatcher = updater.dispatcher
 
+        # Duplicates are dropped before any other handler group
+        dispatcher.add_handler(TypeHandler(Update, self.deduplicate), group=-1)
+
         # on different commands - answer in Telegram
-        dispatcher.add_handler(CommandHandler("start", self.start))
-        dispatcher.add_handler(CommandHandler("help", self.help_command))
-        dispatcher.add_handler(CommandHandler("new", self.new_command))
+        dispatcher.add_handler(CommandHandler(
+            "start", self.__instrument('start', self.start)))
+        dispatcher.add_handler(CommandHandler(
+            "help", self.__instrument('help_command', self.help_command)))
+        dispatcher.add_handler(CommandHandler(
+            "new", self.__instrument('new_command', self.new_command)))
+        dispatcher.add_handler(CommandHandler(
+            "history", self.__instrument('history_command', self.history_command)))
 
         # on non command i.e message - echo the message on Telegram
-        dispatcher.add_handler(InlineQueryHandler(self.inlinequery))
-        dispatcher.add_handler(CallbackQueryHandler(self.callbackquery))
+        dispatcher.add_handler(InlineQueryHandler(
+            self.__instrument('inlinequery', self.inlinequery)))
+        dispatcher.add_handler(CallbackQueryHandler(
+            self.__instrument('callbackquery', self.callbackquery)))
+        if self.metrics is not None:
+            self.metrics.gauge('queue_depth', dispatcher.update_queue.qsize,
+                               queue='updates')
+        return updater
 
-        # Start the Bot
-        updater.start_polling()
+    def __instrument(self, handler: str, fn: Callable[..., None]) -> Callable[..., None]:
+        # Handlers run unwrapped without metrics nor profiler
+        if self.profiler is not None:
+            fn = self.profiler.wrap(handler, fn)
+        if self.metrics is not None:
+            fn = self.metrics.timed('handler_seconds', fn, handler=handler)
+        return fn
 
-        # Block until the user presses Ctrl-C or the process receives SIGINT,
-        # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
-        updater.idle()
+    def __handshake(self, bot: Bot) -> None:
+        start = perf_counter()
+        try:
+            me_info = bot.get_me()
+        except TelegramError as error:
+            if not self.background_handshake:
+                raise
+            logging.error('failed getting bot info: %s', error)
+            return
+        self.startup.record(HANDSHAKE, perf_counter() - start)
+        logging.info('Starting updater for bot: %s', me_info)
+
+    @staticmethod
+    def __gauge_request(metrics: Metrics, pool: str, request: PooledRequest) -> None:
+        metrics.gauge('api_requests', lambda: request.requests, pool=pool)
+        metrics.gauge('api_connections_opened', lambda: request.connections,
+                      pool=pool)
+        metrics.gauge('api_pool_waits', lambda: request.waits, pool=pool)
+        metrics.gauge('api_pool_wait_seconds', lambda: request.wait_seconds,
+                      pool=pool)
+
+    def __shutdown(self) -> None:
+        self.coalescer.close()
+        self.executor.shutdown()
+        self.scheduler.close()
+        logging.info('Outbound calls stats: %s', self.scheduler.stats())
+        logging.info('Connection pool stats: %s', self.request.stats())
+        logging.info('Startup times: %s', self.startup)
+        self.request.stop()
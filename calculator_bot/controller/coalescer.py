@@ -0,0 +1,93 @@
+"""Module of coalescing of outgoing message edits."""
+
+import heapq
+import itertools
+import logging
+from functools import partial
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from .executor import KeyedExecutor
+
+
+class EditCoalescer:
+    """Coalesces tasks by key so only the latest one scheduled is run,
+    through the executor of the key, once the key is drained or at most a
+    window after the first one pending."""
+
+    def __init__(self, executor: KeyedExecutor, window: float) -> None:
+        self.executor = executor
+        self.window = window
+        self.scheduled = 0
+        self.sent = 0
+        self.__lock = Lock()
+        self.__wakeup = Condition(self.__lock)
+        self.__pending: Dict[Hashable, Callable[[], Any]] = dict()
+        self.__deadlines: List[Tuple[float, int, Hashable]] = []
+        self.__sequence = itertools.count()
+        self.__closed = False
+        self.__thread = Thread(
+            target=self.__run, name='EditCoalescer', daemon=True)
+        if self.window > 0:
+            self.__thread.start()
+
+    def schedule(self, key: Hashable, fn: Callable[..., Any], *args: Any) -> None:
+        """Replaces pending task of key by fn(*args)."""
+        task = partial(fn, *args)
+        with self.__lock:
+            debounced = key in self.__pending
+            self.__pending[key] = task
+            self.scheduled += 1
+            if not debounced and self.window > 0:
+                deadline = monotonic() + self.window
+                heapq.heappush(self.__deadlines,
+                               (deadline, next(self.__sequence), key))
+                self.__wakeup.notify()
+
+    def drain(self, key: Hashable) -> None:
+        """Runs pending task of key right away, as nothing is left to
+        coalesce it with.
+
+        Must be called once no more tasks are queued for key in the executor.
+        """
+        self.flush(key)
+
+    def flush(self, key: Hashable) -> None:
+        """Runs pending task of key, if any."""
+        with self.__lock:
+            task = self.__pending.pop(key, None)
+        if task is None:
+            return
+        self.sent += 1
+        try:
+            task()
+        except Exception:
+            logging.exception('failed running coalesced task for key: %s', key)
+
+    def close(self) -> None:
+        """Stops debouncing, handing every pending task to the executor."""
+        with self.__lock:
+            self.__closed = True
+            self.__wakeup.notify()
+            keys = list(self.__pending)
+        if self.__thread.is_alive():
+            self.__thread.join()
+        for key in keys:
+            self.executor.submit(key, self.flush, key)
+
+    def __run(self) -> None:
+        with self.__wakeup:
+            while not self.__closed:
+                if not self.__deadlines:
+                    self.__wakeup.wait()
+                    continue
+                deadline, _, key = self.__deadlines[0]
+                timeout = deadline - monotonic()
+                if timeout > 0:
+                    self.__wakeup.wait(timeout)
+                    continue
+                heapq.heappop(self.__deadlines)
+                if key in self.__pending:
+                    # Run in the executor so it is ordered with keypresses of key
+                    self.executor.submit(key, self.flush, key)
@@ -0,0 +1,39 @@
+"""Module of suppression of duplicate updates."""
+
+from collections import deque
+from threading import Lock
+from typing import Deque, Hashable, Set
+
+
+class RecentIds:
+    """Sliding window of the latest ids added, up to size.
+
+    Telegram delivers updates again when they are not confirmed in time,
+    and clients retry callback queries not answered, so ids found in the
+    window belong to updates already handled.
+    """
+
+    def __init__(self, size: int = 10000) -> None:
+        self.size = size
+        self.duplicates = 0
+        self.__lock = Lock()
+        self.__ids: Set[Hashable] = set()
+        self.__order: Deque[Hashable] = deque()
+
+    def add(self, id_: Hashable) -> bool:
+        """Adds id to the window, returning False if already in it."""
+        with self.__lock:
+            if id_ in self.__ids:
+                self.duplicates += 1
+                return False
+            self.__ids.add(id_)
+            self.__order.append(id_)
+            if len(self.__order) > self.size:
+                self.__ids.discard(self.__order.popleft())
+            return True
+
+    def __contains__(self, id_: Hashable) -> bool:
+        return id_ in self.__ids
+
+    def __len__(self) -> int:
+        return len(self.__order)
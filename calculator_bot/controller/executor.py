@@ -0,0 +1,69 @@
+"""Module of executors used by controllers."""
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Condition, Lock
+from typing import Any, Callable, Deque, Dict, Hashable
+
+
+class KeyedExecutor:
+    """Executor running tasks of the same key in order and tasks of different
+    keys in parallel across a pool of worker threads."""
+
+    def __init__(self, workers: int) -> None:
+        self.__pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='KeyedExecutor')
+        self.__lock = Lock()
+        self.__drained = Condition(self.__lock)
+        self.__queues: Dict[Hashable, Deque[Callable[[], Any]]] = dict()
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args: Any) -> None:
+        """Schedules fn(*args) after every task previously submitted for key."""
+        task = partial(fn, *args)
+        with self.__lock:
+            queue = self.__queues.get(key)
+            if queue is not None:
+                queue.append(task)
+                return
+            self.__queues[key] = deque([task])
+        self.__pool.submit(self.__run, key)
+
+    def pending(self, key: Hashable) -> int:
+        """Number of tasks waiting or running for key."""
+        with self.__lock:
+            queue = self.__queues.get(key)
+            return len(queue) if queue is not None else 0
+
+    def __len__(self) -> int:
+        """Number of keys with tasks waiting or running."""
+        return len(self.__queues)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the workers, waiting for the pending tasks if requested."""
+        if wait:
+            with self.__drained:
+                self.__drained.wait_for(lambda: not self.__queues)
+        self.__pool.shutdown(wait=wait)
+
+    def __run(self, key: Hashable) -> None:
+        # The running task stays at the head of its queue so that tasks
+        # submitted meanwhile are queued behind it instead of run in parallel
+        with self.__lock:
+            queue = self.__queues[key]
+            task = queue[0]
+        try:
+            task()
+        except Exception:
+            logging.exception('failed running task for key: %s', key)
+        with self.__lock:
+            queue.popleft()
+            if not queue:
+                # Reclaim idle keys
+                del self.__queues[key]
+                if not self.__queues:
+                    self.__drained.notify_all()
+                return
+        # Yield the worker so a busy key does not starve the other ones
+        self.__pool.submit(self.__run, key)
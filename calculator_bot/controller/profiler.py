@@ -0,0 +1,78 @@
+"""Module of profiling of slow updates."""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+from threading import Lock
+from typing import Any, Callable, Optional
+
+UNSAFE_FILENAME = re.compile(r'[^\w.-]')
+
+
+class SlowUpdateProfiler:
+    """Profiler of handlers saving the profiles of a sample of updates, and
+    of every update handled in more than threshold seconds if given.
+
+    Profiles are saved to directory as <time>-<update id>-<handler>.prof,
+    keeping only the latest ones. Every update is profiled while a threshold
+    is set, as the slow ones are only known once handled.
+    """
+
+    def __init__(self, directory: str, sample_rate: float = 0.0,
+                 threshold: Optional[float] = None, keep: int = 100) -> None:
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.keep = keep
+        self.saved = 0
+        self.__lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def wrap(self, handler: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Wraps fn, taking the update or its key as first argument."""
+        def profiled_fn(*args: Any, **kwargs: Any) -> Any:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+            if not sampled and self.threshold is None:
+                return fn(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active, as in handlers running in parallel
+                # since Python 3.12
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+                if sampled or elapsed >= (self.threshold or 0):
+                    self.__save(profile, handler, args[0] if args else None,
+                                elapsed)
+        return profiled_fn
+
+    def __save(self, profile: cProfile.Profile, handler: str, update: Any,
+               elapsed: float) -> None:
+        key = UNSAFE_FILENAME.sub('_', str(getattr(update, 'update_id', update)))
+        path = os.path.join(self.directory, '%d-%s-%s.prof' % (
+            time.time_ns(), key, handler))
+        try:
+            profile.dump_stats(path)
+            with self.__lock:
+                self.saved += 1
+                self.__rotate()
+        except OSError:
+            logging.exception('failed saving profile %s', path)
+            return
+        logging.info('Profiled %s of update %s in %.3fs: %s',
+                     handler, key, elapsed, path)
+
+    def __rotate(self) -> None:
+        profiles = sorted(name for name in os.listdir(self.directory)
+                          if name.endswith('.prof'))
+        for name in profiles[:max(len(profiles) - self.keep, 0)]:
+            os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,285 @@
+"""Module of flow control for outbound Bot API calls."""
+
+import heapq
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from calculator_bot.metrics import Metrics
+
+# Lower values are sent first. Answers to callback queries do not count
+# towards the limits of sent messages, so they skip the token buckets
+ANSWER_PRIORITY = 0
+REPLY_PRIORITY = 1
+EDIT_PRIORITY = 2
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to capacity."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait until a token is available."""
+        self.__refill(now)
+        delay = self.paused_until - now
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return max(delay, 0.0)
+
+    def pause_delay(self, now: float) -> float:
+        """Seconds to wait until the bucket is not paused."""
+        return max(self.paused_until - now, 0.0)
+
+    def consume(self, now: float) -> None:
+        """Takes a token from the bucket."""
+        self.__refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Holds every token for given seconds."""
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        """Whether the bucket is full and not paused."""
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+    def __refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+
+@dataclass(order=True)
+class _Call:
+    priority: int
+    sequence: int
+    chat_id: Optional[int] = field(compare=False)
+    task: Callable[[], Any] = field(compare=False)
+    future: 'Future[Any]' = field(compare=False)
+    enqueued: float = field(compare=False)
+    method: str = field(compare=False)
+
+
+class OutboundScheduler:
+    """Scheduler of Bot API calls under a global and per chat token buckets.
+
+    Calls are sent by priority as soon as both buckets have a token, and are
+    queued again after the retry_after interval when Telegram answers 429.
+    Calls at ANSWER_PRIORITY are sent at once, unless the global bucket is
+    paused by a 429 to a call of no chat or to an answer.
+    Calls are counted by method and outcome in metrics, if given.
+
+    Every chat queues its calls apart. Chats with a token are kept in a heap
+    by their first call, and the rest in a heap by the time they get one, so
+    sending a call takes logarithmic time in the number of chats.
+    """
+
+    MAX_IDLE_CHATS = 1024
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, workers: int = 4,
+                 metrics: Optional[Metrics] = None) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.retried = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.__bucket = TokenBucket(rate, rate)
+        self.__chat_buckets: Dict[int, TokenBucket] = dict()
+        # Calls of every chat, answers along with the calls of no chat
+        self.__lanes: Dict[Optional[int], List[_Call]] = dict()
+        # Chats with a token by their first call, and the rest by the time
+        # they get one. Entries of a former generation of a chat are stale
+        self.__ready: List[Tuple[int, int, int, Optional[int]]] = []
+        self.__waiting: List[Tuple[float, int, Optional[int]]] = []
+        self.__placed: Dict[Optional[int], Tuple[int, bool]] = dict()
+        self.__generation = itertools.count()
+        self.__depth = 0
+        self.__sequence = itertools.count()
+        self.__inflight = 0
+        self.__closed = False
+        self.__lock = Lock()
+        self.__wakeup = Condition(self.__lock)
+        self.__pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='OutboundScheduler')
+        self.__thread = Thread(
+            target=self.__run, name='OutboundScheduler', daemon=True)
+        self.metrics = metrics
+        self.__thread.start()
+        if metrics is not None:
+            metrics.gauge('queue_depth', lambda: self.depth, queue='outbound')
+            metrics.gauge('api_calls_inflight', lambda: self.__inflight)
+
+    def submit(self, priority: int, chat_id: Optional[int],
+               fn: Callable[..., Any], *args: Any, **kwargs: Any) -> 'Future[Any]':
+        """Schedules the call fn(*args, **kwargs) sent to given chat."""
+        future: 'Future[Any]' = Future()
+        call = _Call(priority, next(self.__sequence), chat_id,
+                     lambda: fn(*args, **kwargs), future, monotonic(),
+                     getattr(fn, '__name__', 'call'))
+        with self.__lock:
+            self.__enqueue(call, monotonic())
+            self.__wakeup.notify()
+        return future
+
+    @property
+    def depth(self) -> int:
+        """Number of calls waiting to be sent."""
+        return self.__depth
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth and wait times of sent calls."""
+        with self.__lock:
+            return {
+                'depth': self.__depth,
+                'inflight': self.__inflight,
+                'sent': self.sent,
+                'retried': self.retried,
+                'mean_wait': self.total_wait / self.sent if self.sent else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+    def close(self) -> None:
+        """Sends every queued call and stops the scheduler."""
+        with self.__lock:
+            self.__closed = True
+            self.__wakeup.notify()
+        self.__thread.join()
+        self.__pool.shutdown()
+
+    def __run(self) -> None:
+        with self.__wakeup:
+            while True:
+                if not self.__depth:
+                    if self.__closed and not self.__inflight:
+                        return
+                    self.__wakeup.wait()
+                    continue
+                now = monotonic()
+                call, delay = self.__next_call(now)
+                if call is None:
+                    self.__wakeup.wait(delay)
+                    continue
+                wait = now - call.enqueued
+                self.sent += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.__inflight += 1
+                self.__pool.submit(self.__send, call)
+
+    def __next_call(self, now: float) -> Tuple[Optional[_Call], float]:
+        # Chats out of tokens wait apart instead of blocking every chat
+        while self.__waiting and self.__waiting[0][0] <= now:
+            _, generation, chat_id = heapq.heappop(self.__waiting)
+            if self.__placed.get(chat_id) == (generation, False):
+                self.__place(chat_id, now)
+        while self.__ready and self.__placed.get(self.__ready[0][3]) != \
+                (self.__ready[0][2], True):
+            heapq.heappop(self.__ready)
+        if not self.__ready:
+            return None, self.__waiting[0][0] - now
+        priority, _, _, chat_id = self.__ready[0]
+        # Answers skip the tokens, but not the pauses asked by Telegram
+        delay = self.__bucket.pause_delay(now) if priority == ANSWER_PRIORITY \
+            else self.__bucket.delay(now)
+        if delay > 0:
+            return None, delay
+        heapq.heappop(self.__ready)
+        lane = self.__lanes[chat_id]
+        call = heapq.heappop(lane)
+        self.__depth -= 1
+        if call.priority != ANSWER_PRIORITY:
+            self.__bucket.consume(now)
+            if chat_id is not None:
+                self.__chat_bucket(chat_id).consume(now)
+        if lane:
+            self.__place(chat_id, now)
+        else:
+            del self.__lanes[chat_id]
+            del self.__placed[chat_id]
+        return call, 0.0
+
+    def __enqueue(self, call: _Call, now: float) -> None:
+        chat_id = None if call.priority == ANSWER_PRIORITY else call.chat_id
+        lane = self.__lanes.setdefault(chat_id, [])
+        heapq.heappush(lane, call)
+        self.__depth += 1
+        placed = self.__placed.get(chat_id)
+        # Chats waiting for a token keep waiting
+        if placed is None or (placed[1] and lane[0] is call):
+            self.__place(chat_id, now)
+
+    def __place(self, chat_id: Optional[int], now: float) -> None:
+        generation = next(self.__generation)
+        delay = 0.0 if chat_id is None else self.__chat_bucket(chat_id).delay(now)
+        if delay > 0:
+            self.__placed[chat_id] = (generation, False)
+            heapq.heappush(self.__waiting, (now + delay, generation, chat_id))
+        else:
+            head = self.__lanes[chat_id][0]
+            self.__placed[chat_id] = (generation, True)
+            heapq.heappush(self.__ready,
+                           (head.priority, head.sequence, generation, chat_id))
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.__chat_buckets) >= self.MAX_IDLE_CHATS:
+                now = monotonic()
+                self.__chat_buckets = {
+                    id_: bucket for id_, bucket in self.__chat_buckets.items()
+                    if not bucket.is_idle(now)
+                }
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.__chat_buckets[chat_id] = bucket
+        return bucket
+
+    def __send(self, call: _Call) -> None:
+        start = perf_counter()
+        try:
+            result = call.task()
+        except RetryAfter as error:
+            self.__record(call, 'retry_after', start)
+            with self.__lock:
+                chat_id = None if call.priority == ANSWER_PRIORITY else call.chat_id
+                bucket = self.__bucket if chat_id is None \
+                    else self.__chat_bucket(chat_id)
+                now = monotonic()
+                bucket.pause(now, error.retry_after)
+                self.retried += 1
+                self.__inflight -= 1
+                self.__enqueue(call, now)
+                if self.__placed[chat_id][1]:
+                    # Paused chats wait apart until retry_after passes
+                    self.__place(chat_id, now)
+                self.__wakeup.notify()
+            return
+        except Exception as error:
+            self.__record(call, type(error).__name__, start)
+            call.future.set_exception(error)
+        else:
+            self.__record(call, 'ok', start)
+            call.future.set_result(result)
+        with self.__lock:
+            self.__inflight -= 1
+            self.__wakeup.notify()
+
+    def __record(self, call: _Call, outcome: str, start: float) -> None:
+        if self.metrics is None:
+            return
+        self.metrics.observe('api_call_seconds', perf_counter() - start,
+                             method=call.method)
+        self.metrics.count('api_calls_total', method=call.method,
+                           outcome=outcome)
@@ -0,0 +1,118 @@
+"""Module of rendering of calculator messages."""
+
+import hashlib
+import json
+from typing import Any, List, Optional
+
+from telegram import (InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InputTextMessageContent)
+from telegram.inline.inlinekeyboardbutton import InlineKeyboardButton
+from telegram.parsemode import ParseMode
+from telegram.utils.types import JSONDict
+
+from calculator_bot.model import Calculator, Number
+from calculator_bot.service.cache import LRUCache
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """Inline keyboard markup serialized once. It must not be modified."""
+
+    __slots__ = ('__frozen_dict', '__frozen_json')
+
+    def __init__(self, inline_keyboard: List[List[InlineKeyboardButton]],
+                 **_kwargs: Any) -> None:
+        super().__init__(inline_keyboard, **_kwargs)
+        self.__frozen_dict = super().to_dict()
+        self.__frozen_json = json.dumps(self.__frozen_dict)
+
+    def to_dict(self) -> JSONDict:
+        return self.__frozen_dict
+
+    def to_json(self) -> str:
+        return self.__frozen_json
+
+
+CALCULATOR_KEYBOARD = FrozenInlineKeyboardMarkup([
+    [
+        InlineKeyboardButton('7', callback_data='7'),
+        InlineKeyboardButton('8', callback_data='8'),
+        InlineKeyboardButton('9', callback_data='9'),
+        InlineKeyboardButton('*', callback_data='*'),
+        InlineKeyboardButton('/', callback_data='/')
+    ],
+    [
+        InlineKeyboardButton('4', callback_data='4'),
+        InlineKeyboardButton('5', callback_data='5'),
+        InlineKeyboardButton('6', callback_data='6'),
+        InlineKeyboardButton('+', callback_data='+'),
+        InlineKeyboardButton('-', callback_data='-')
+    ],
+    [
+        InlineKeyboardButton('1', callback_data='1'),
+        InlineKeyboardButton('2', callback_data='2'),
+        InlineKeyboardButton('3', callback_data='3'),
+        InlineKeyboardButton('=', callback_data='='),
+        InlineKeyboardButton('c', callback_data='c'),
+    ],
+    [
+        InlineKeyboardButton('0', callback_data='0'),
+        InlineKeyboardButton('.', callback_data='.'),
+        InlineKeyboardButton('↩', callback_data='u'),
+    ]
+])
+
+# Fixed id so Telegram caches the article across queries
+CALCULATOR_ARTICLE = InlineQueryResultArticle(
+    id='calculator',
+    title='Create new calculator',
+    input_message_content=InputTextMessageContent(
+        '__Start typing number to calculate__',
+        parse_mode=ParseMode.MARKDOWN
+    ),
+    reply_markup=CALCULATOR_KEYBOARD
+)
+
+
+def render_calculator(calc: Calculator) -> str:
+    """Renders the message text of a calculator."""
+    text = ('%g' % calc.value).ljust(50)
+    text += ('\n> %s' % calc.expr)
+    return text
+
+
+def render_result_article(expr: str, value: Number) -> InlineQueryResultArticle:
+    """Renders the inline result of an expression, identified by a digest
+    of the expression so Telegram caches it."""
+    text = '%s = %g' % (expr, value)
+    return InlineQueryResultArticle(
+        id='result-%s' % hashlib.sha1(expr.encode()).hexdigest(),
+        title=text,
+        input_message_content=InputTextMessageContent(text)
+    )
+
+
+class RenderCache:
+    """Remembers the text last sent to each inline message, by its inline
+    message id, so renders matching it are not sent again. Inline messages
+    come without their text in callback queries, unlike chat messages.
+    Nothing is remembered with maxsize 0."""
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.skipped = 0
+        self.__sent: Optional[LRUCache[str, str]] = \
+            LRUCache(maxsize) if maxsize > 0 else None
+
+    def is_sent(self, message_id: str, text: str) -> bool:
+        """Whether text is the last one sent to the message."""
+        if self.__sent is None:
+            return False
+        sent = self.__sent.get(message_id)
+        if sent.is_some and sent.unwrap() == text:
+            self.skipped += 1
+            return True
+        return False
+
+    def mark_sent(self, message_id: str, text: str) -> None:
+        """Records text as the last one sent to the message."""
+        if self.__sent is not None:
+            self.__sent.put(message_id, text)
@@ -0,0 +1,100 @@
+"""Module of the connection pools of outbound Bot API calls."""
+
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, Optional, Union
+
+from telegram.utils.request import Request
+from telegram.utils.types import JSONDict
+from telegram.vendor.ptb_urllib3.urllib3 import PoolManager
+
+
+class PooledRequest(Request):
+    """Request of Bot API calls through a pool of keep-alive connections.
+
+    Calls wait for a free connection once con_pool_size connections are in
+    use, instead of opening new ones discarded once done, so connections are
+    reused. getUpdates calls are sent through the polling request, if given,
+    so a long poll never holds a connection needed by other calls.
+    Connections opened, calls and waits for a free connection are counted.
+    """
+
+    __slots__ = ('polling', 'read_timeout', 'requests', 'connections',
+                 'waits', 'wait_seconds', '__lock')
+
+    def __init__(self, con_pool_size: int, connect_timeout: float = 5.0,
+                 read_timeout: float = 5.0,
+                 polling: Optional['PooledRequest'] = None) -> None:
+        super().__init__(con_pool_size=con_pool_size,
+                         connect_timeout=connect_timeout,
+                         read_timeout=read_timeout)
+        self.polling = polling
+        self.read_timeout = read_timeout
+        self.requests = 0
+        self.connections = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.__lock = Lock()
+        manager = self._con_pool
+        # Pools of App Engine can not be counted
+        if isinstance(manager, PoolManager):
+            manager.connection_pool_kw['block'] = True
+            manager.pool_classes_by_scheme = {
+                scheme: self.__counted_pool_class(pool_class)
+                for scheme, pool_class in manager.pool_classes_by_scheme.items()
+            }
+
+    def post(self, url: str, data: JSONDict,
+             timeout: Optional[float] = None) -> Union[JSONDict, bool]:
+        """Sends a Bot API call, getUpdates through the polling request."""
+        if self.polling is not None and url.endswith('/getUpdates'):
+            return self.polling.post(url, data, timeout)
+        return super().post(
+            url, data, timeout if timeout is not None else self.read_timeout)
+
+    def stats(self) -> Dict[str, float]:
+        """Calls, connections opened and reused, and waits for a free
+        connection."""
+        with self.__lock:
+            reused = max(self.requests - self.connections, 0)
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'reuse_rate': reused / self.requests if self.requests else 0.0,
+                'waits': self.waits,
+                'mean_wait': self.wait_seconds / self.waits if self.waits else 0.0,
+            }
+
+    def stop(self) -> None:
+        """Closes the connections of both pools."""
+        super().stop()
+        if self.polling is not None:
+            self.polling.stop()
+
+    def __record(self, waited: bool, seconds: float, opened: bool) -> None:
+        with self.__lock:
+            self.requests += int(not opened)
+            self.connections += int(opened)
+            if waited:
+                self.waits += 1
+                self.wait_seconds += seconds
+
+    def __counted_pool_class(self, pool_class: type) -> type:
+        record = self.__record
+
+        class CountedConnectionPool(pool_class):  # type: ignore
+            """Connection pool counting connections and waits."""
+
+            def _get_conn(self, timeout: Optional[float] = None) -> Any:
+                # Every connection of the pool is in use
+                waited = self.pool is not None and self.pool.empty()
+                start = perf_counter()
+                connection = super()._get_conn(timeout)
+                record(waited, perf_counter() - start, False)
+                return connection
+
+            def _new_conn(self) -> Any:
+                record(False, 0.0, True)
+                return super()._new_conn()
+
+        return CountedConnectionPool
@@ -0,0 +1,210 @@
+"""Module of sharding of updates across worker processes."""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import zlib
+from functools import partial
+from signal import SIGABRT, SIGHUP, SIGINT, SIGTERM
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import CallbackContext, TypeHandler, Updater
+
+from .webhook import WebhookServer
+
+# Key flagging updates routed with their callback query already answered
+ANSWERED_INLINE = '_answered_inline'
+
+
+def shard_key(data: Dict[str, Any]) -> Optional[str]:
+    """Key of the calculator message of an update, as in callbackquery, or
+    of the message replied to by a command."""
+    query = data.get('callback_query')
+    if not query:
+        reply = (data.get('message') or dict()).get('reply_to_message')
+        return str(reply['message_id']) if reply else None
+    message = query.get('message')
+    return str(message['message_id'] if message else query.get('inline_message_id'))
+
+
+def _run_worker(target: Callable[..., None], index: int,
+                updates: 'multiprocessing.Queue[Any]', args: Any) -> None:
+    # Workers are stopped by the pool once their updates are drained
+    signal.signal(SIGINT, signal.SIG_IGN)
+    signal.signal(SIGTERM, signal.SIG_IGN)
+    target(index, updates, *args)
+
+
+class ShardPool:
+    """Pool of worker processes handling the updates of a shard each.
+
+    Callback queries, and commands replying to a message, are routed by a
+    hash of their message key, so every keypress of a message is handled in
+    order by the worker owning its calculator state. Other updates are
+    spread by update id. Workers run target(index, updates, *args), reading
+    the updates of their shard from the queue until None.
+    """
+
+    def __init__(self, shards: int, target: Callable[..., None], *args: Any) -> None:
+        if shards <= 0:
+            raise ValueError('number of shards must be positive')
+        self.target = target
+        self.args = args
+        self.restarts = 0
+        self.__context = multiprocessing.get_context('spawn')
+        self.__queues: List['multiprocessing.Queue[Any]'] = [
+            self.__context.Queue() for _ in range(shards)]
+        self.__processes: List[Optional[multiprocessing.process.BaseProcess]] = \
+            [None] * shards
+        self.__locks = [Lock() for _ in range(shards)]
+        self.__closed = Event()
+        self.__monitor = Thread(
+            target=self.__run_monitor, name='ShardMonitor', daemon=True)
+
+    def __len__(self) -> int:
+        return len(self.__queues)
+
+    def shard(self, data: Dict[str, Any]) -> int:
+        """Index of the shard handling the update."""
+        key = shard_key(data)
+        if key is None:
+            return int(data.get('update_id') or 0) % len(self)
+        return zlib.crc32(key.encode()) % len(self)
+
+    def start(self) -> None:
+        """Starts a worker per shard, restarting the ones exiting on error."""
+        for index in range(len(self)):
+            with self.__locks[index]:
+                self.__start(index)
+        self.__monitor.start()
+
+    def route(self, data: Dict[str, Any]) -> int:
+        """Queues the update for its shard, returning the shard index."""
+        index = self.shard(data)
+        self.__queues[index].put(data)
+        return index
+
+    def restart(self, index: int) -> None:
+        """Restarts the worker of a shard once it handled every update
+        queued before. Updates queued meanwhile wait for the new worker."""
+        with self.__locks[index]:
+            self.__drain(index)
+            self.__start(index)
+            self.restarts += 1
+        logging.info('Restarted shard %d', index)
+
+    def restart_all(self) -> None:
+        """Restarts the workers one by one."""
+        for index in range(len(self)):
+            self.restart(index)
+
+    def close(self) -> None:
+        """Stops every worker once it handled its queued updates."""
+        self.__closed.set()
+        for index in range(len(self)):
+            with self.__locks[index]:
+                self.__drain(index)
+
+    def __start(self, index: int) -> None:
+        process = self.__context.Process(
+            target=_run_worker, name='Shard-%d' % index,
+            args=(self.target, index, self.__queues[index], self.args))
+        process.start()
+        self.__processes[index] = process
+
+    def __drain(self, index: int) -> None:
+        process = self.__processes[index]
+        if process is None:
+            return
+        if process.is_alive():
+            self.__queues[index].put(None)
+        process.join()
+        self.__processes[index] = None
+
+    def __run_monitor(self) -> None:
+        while not self.__closed.wait(1):
+            for index, lock in enumerate(self.__locks):
+                with lock:
+                    process = self.__processes[index]
+                    if self.__closed.is_set() or process is None \
+                            or process.is_alive():
+                        continue
+                    logging.error('Shard %d exited with code %s, restarting',
+                                  index, process.exitcode)
+                    self.__start(index)
+                    self.restarts += 1
+
+
+class ShardedController:
+    """Controller receiving updates, through polling or a webhook, and
+    routing them to the workers of a shard pool.
+
+    SIGHUP restarts the workers one by one without losing updates.
+    """
+
+    def __init__(self, token: str, pool: ShardPool,
+                 base_url: Optional[str] = None) -> None:
+        self.token = token
+        self.pool = pool
+        self.base_url = base_url
+
+    def __create_updater(self) -> Updater:
+        # Updater only defaults the base url when not given
+        if self.base_url is None:
+            return Updater(self.token)
+        return Updater(self.token, base_url=self.base_url)
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        """Route an update received by polling to its shard."""
+        self.pool.route(update.to_dict())
+
+    def run(self) -> None:
+        """Run the bot polling updates."""
+        updater = self.__create_updater()
+        updater.dispatcher.add_handler(TypeHandler(Update, self.route))
+        self.pool.start()
+        signal.signal(SIGHUP, self.__restart_all)
+        updater.start_polling()
+        updater.idle()
+        self.pool.close()
+
+    def run_webhook(self, url: str, listen: str = '0.0.0.0', port: int = 8443) -> None:
+        """Run the bot receiving updates through a webhook at given url."""
+        updater = self.__create_updater()
+        updater.bot.set_webhook(url)
+        self.pool.start()
+        server = WebhookServer(
+            self.webhook_update, listen, port, urlparse(url).path or '/')
+
+        async def serve() -> None:
+            loop = asyncio.get_running_loop()
+            for signum in (SIGINT, SIGTERM, SIGABRT):
+                loop.add_signal_handler(signum, server.stop)
+            loop.add_signal_handler(SIGHUP, partial(self.__restart_all, SIGHUP, None))
+            await server.serve()
+
+        # Block until the process receives SIGINT, SIGTERM or SIGABRT
+        asyncio.run(serve())
+        self.pool.close()
+
+    def webhook_update(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Route update received through the webhook to its shard, answering
+        callback queries in the webhook response."""
+        query = data.get('callback_query')
+        if query:
+            data[ANSWERED_INLINE] = True
+        self.pool.route(data)
+        if query:
+            return {
+                'method': 'answerCallbackQuery',
+                'callback_query_id': query.get('id'),
+            }
+        return None
+
+    def __restart_all(self, _signum: int, _frame: Any) -> None:
+        # Restarting blocks until workers drain, out of the signal handler
+        Thread(target=self.pool.restart_all, name='ShardRestart').start()
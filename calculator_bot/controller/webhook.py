@@ -0,0 +1,154 @@
+"""Module of webhook ingestion of Telegram updates."""
+
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple, Union
+
+MAX_BODY_SIZE = 1 << 20
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+}
+
+
+class _RequestHead(NamedTuple):
+    """Request line and headers of a request, as needed to read its body."""
+    method: str
+    path: str
+    keep_alive: bool
+    length: int
+
+
+class WebhookServer:
+    """Asyncio HTTP server receiving Telegram updates through a webhook.
+
+    Every POST to path is decoded as an update and passed to handler. The
+    mapping returned by handler, if any, is sent back as the response body so
+    Telegram performs that Bot API method without another round trip.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+                 listen: str = '127.0.0.1', port: int = 8443, path: str = '/') -> None:
+        self.handler = handler
+        self.listen = listen
+        self.path = path
+        self.__port = port
+        self.__server: Optional[asyncio.base_events.Server] = None
+        self.__stopped: Optional[asyncio.Event] = None
+
+    @property
+    def port(self) -> int:
+        """Port the server is listening to."""
+        if self.__server is not None and self.__server.sockets:
+            return self.__server.sockets[0].getsockname()[1]
+        return self.__port
+
+    async def start(self) -> None:
+        """Starts listening to updates."""
+        self.__stopped = asyncio.Event()
+        self.__server = await asyncio.start_server(
+            self.__handle_connection, self.listen, self.__port)
+        logging.info('Listening webhook updates on %s:%d%s',
+                     self.listen, self.port, self.path)
+
+    async def serve(self) -> None:
+        """Serves updates until the server is stopped."""
+        if self.__server is None:
+            await self.start()
+        assert self.__server is not None and self.__stopped is not None
+        async with self.__server:
+            await self.__stopped.wait()
+
+    def stop(self) -> None:
+        """Stops serving updates. Must be called from the server loop."""
+        if self.__stopped is not None:
+            self.__stopped.set()
+
+    async def __handle_connection(self, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self.__handle_request(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def __handle_request(self, reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter) -> bool:
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        head = await self.__read_head(reader, request_line)
+        if isinstance(head, int):
+            # The body can not be skipped to read the next request
+            await self.__respond(writer, head, None, False)
+            return False
+        body = await reader.readexactly(head.length) if head.length else b''
+        status, data = self.__decode_update(head, body)
+        if status != 200:
+            await self.__respond(writer, status, None, head.keep_alive)
+            return head.keep_alive
+        try:
+            answer = self.handler(data)
+        except Exception:
+            logging.exception('failed handling webhook update: %s', data)
+            answer = None
+        await self.__respond(writer, 200, answer, head.keep_alive)
+        return head.keep_alive
+
+    @staticmethod
+    async def __read_head(reader: asyncio.StreamReader,
+                          request_line: bytes) -> Union[int, _RequestHead]:
+        """Head of the request, or the status of the error reading it."""
+        parts = request_line.decode('latin-1').split(' ', 2)
+        if len(parts) != 3:
+            return 400
+        method, path, version = parts
+        headers: Dict[str, str] = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return 400
+        if length < 0:
+            return 400
+        if length > MAX_BODY_SIZE:
+            return 413
+        keep_alive = headers.get('connection', '').lower() != 'close' \
+            and version.strip() == 'HTTP/1.1'
+        return _RequestHead(method, path, keep_alive, length)
+
+    def __decode_update(self, head: _RequestHead, body: bytes) -> Tuple[int, Any]:
+        """Status of the request, and the update it posts if OK."""
+        if head.method != 'POST':
+            return 405, None
+        if head.path != self.path:
+            return 404, None
+        try:
+            return 200, json.loads(body)
+        except ValueError:
+            return 400, None
+
+    async def __respond(self, writer: asyncio.StreamWriter, status: int,
+                        answer: Optional[Dict[str, Any]], keep_alive: bool) -> None:
+        body = json.dumps(answer).encode() if answer is not None else b''
+        head = 'HTTP/1.1 %d %s\r\nContent-Length: %d\r\n' % (
+            status, REASONS[status], len(body))
+        if answer is not None:
+            head += 'Content-Type: application/json\r\n'
+        if not keep_alive:
+            head += 'Connection: close\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
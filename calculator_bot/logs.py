@@ -0,0 +1,159 @@
+"""Module of logging written from a background thread."""
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+Key = Tuple[str, Any, Optional[type]]
+
+
+class SampledFilter(logging.Filter):
+    """Filter letting through the first burst records of every key, and one
+    in sample of the rest, until summaries are taken.
+
+    Records are keyed by the function logging them, their message before
+    formatting and the type of their exception, so repeated errors of the
+    same handler are sampled, whatever their arguments.
+    """
+
+    def __init__(self, burst: int = 10, sample: int = 100) -> None:
+        super().__init__()
+        self.burst = burst
+        self.sample = max(sample, 1)
+        self.suppressed = 0
+        self.__lock = Lock()
+        # Logger name, level, records seen and suppressed of every key
+        self.__counts: Dict[Key, List[Any]] = dict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.funcName, record.msg,
+               record.exc_info[0] if record.exc_info else None)
+        with self.__lock:
+            counts = self.__counts.get(key)
+            if counts is None:
+                counts = self.__counts[key] = [record.name, record.levelno, 0, 0]
+            counts[2] += 1
+            extra = counts[2] - self.burst
+            if extra <= 0 or extra % self.sample == 0:
+                return True
+            counts[3] += 1
+            self.suppressed += 1
+            return False
+
+    def summaries(self) -> List[logging.LogRecord]:
+        """Records summarizing the ones suppressed of every key, starting
+        the count of every key over."""
+        with self.__lock:
+            counts, self.__counts = self.__counts, dict()
+        return [logging.makeLogRecord({
+            'name': name,
+            'levelno': levelno,
+            'levelname': logging.getLevelName(levelno),
+            'funcName': function,
+            'msg': 'Suppressed %d of %d records of %s like: %s',
+            'args': (suppressed, seen, function, message),
+        }) for (function, message, _), (name, levelno, seen, suppressed)
+            in counts.items() if suppressed]
+
+
+class _DroppingQueueHandler(QueueHandler):
+
+    def __init__(self, queue: 'Queue[Optional[logging.LogRecord]]') -> None:
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatted once written, so arguments are not to be changed after
+        # being logged
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+
+    def enqueue_sentinel(self) -> None:
+        # Waits for room, instead of failing while the queue is full
+        self.queue.put(self._sentinel)
+
+
+class BackgroundLogging:
+    """Handler of a logger queuing its records to be written by the former
+    handlers of the logger from a background thread.
+
+    Records are queued as logged and formatted once written. Repeated
+    records are sampled by SampledFilter, and the ones suppressed are
+    summarized every interval. Records are dropped, and counted, while size
+    records are queued, so logging never blocks the threads handling
+    updates.
+    """
+
+    def __init__(self, size: int = 10000, burst: int = 10, sample: int = 100,
+                 interval: float = 60.0) -> None:
+        self.interval = interval
+        self.queue: 'Queue[Optional[logging.LogRecord]]' = Queue(size)
+        self.sampler = SampledFilter(burst, sample)
+        self.handler = _DroppingQueueHandler(self.queue)
+        self.handler.addFilter(self.sampler)
+        self.__logger: Optional[logging.Logger] = None
+        self.__handlers: List[logging.Handler] = []
+        self.__listener: Optional[QueueListener] = None
+        self.__closed = Event()
+        self.__thread = Thread(target=self.__run_summaries, name='LogSummaries',
+                               daemon=True)
+
+    @property
+    def suppressed(self) -> int:
+        """Number of records suppressed by sampling."""
+        return self.sampler.suppressed
+
+    @property
+    def dropped(self) -> int:
+        """Number of records dropped while the queue was full."""
+        return self.handler.dropped
+
+    def install(self, logger: Optional[logging.Logger] = None) -> None:
+        """Moves the handlers of logger, the root one by default, to the
+        background thread."""
+        logger = logger or logging.getLogger()
+        self.__logger = logger
+        self.__handlers = list(logger.handlers)
+        self.__listener = _Listener(self.queue, *self.__handlers,
+                                    respect_handler_level=True)
+        for handler in self.__handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(self.handler)
+        self.__listener.start()
+        self.__thread.start()
+
+    def close(self) -> None:
+        """Writes the records queued and the summaries pending, and gives
+        the handlers back to the logger."""
+        logger, self.__logger = self.__logger, None
+        if logger is None or self.__listener is None:
+            return
+        self.__closed.set()
+        self.__thread.join()
+        self.__summarize()
+        logger.removeHandler(self.handler)
+        self.__listener.stop()
+        for handler in self.__handlers:
+            logger.addHandler(handler)
+        if self.dropped:
+            logger.warning('Dropped %d log records while the queue was full',
+                           self.dropped)
+
+    def __run_summaries(self) -> None:
+        while not self.__closed.wait(self.interval):
+            self.__summarize()
+
+    def __summarize(self) -> None:
+        for record in self.sampler.summaries():
+            # Summaries are not sampled
+            with self.handler.lock:  # type: ignore
+                self.handler.emit(record)
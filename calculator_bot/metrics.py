@@ -0,0 +1,190 @@
+"""Module of application metrics exposed in Prometheus text format."""
+import logging
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+F = TypeVar('F', bound=Callable[..., Any])
+Labels = Tuple[Tuple[str, str], ...]
+
+# Upper bounds in seconds, from fast repository calls to slow Bot API ones
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Histogram of observed durations in seconds."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        # Last count is of observations over every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        """Records an observation."""
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics:
+    """Registry of histograms, counters and gauges.
+
+    Histograms and counters are updated by the instrumented code, while
+    gauges are read from callbacks when rendered. Components take an
+    optional registry, and skip any instrumentation without it.
+    """
+
+    def __init__(self, prefix: str = 'calculator_bot') -> None:
+        self.prefix = prefix
+        self.__lock = Lock()
+        self.__histograms: Dict[str, Dict[Labels, Histogram]] = dict()
+        self.__counters: Dict[str, Dict[Labels, float]] = dict()
+        self.__gauges: Dict[str, Dict[Labels, Callable[[], float]]] = dict()
+        self.__server: Any = None
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Records a duration in the histogram of given name and labels."""
+        key = _labels(labels)
+        with self.__lock:
+            histograms = self.__histograms.setdefault(name, dict())
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increments the counter of given name and labels."""
+        key = _labels(labels)
+        with self.__lock:
+            counters = self.__counters.setdefault(name, dict())
+            counters[key] = counters.get(key, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: str) -> None:
+        """Registers a gauge of given name and labels read from a callback."""
+        with self.__lock:
+            self.__gauges.setdefault(name, dict())[_labels(labels)] = read
+
+    def timed(self, name: str, fn: F, **labels: str) -> F:
+        """Wraps fn recording its duration in given histogram."""
+        def timed_fn(*args: Any, **kwargs: Any) -> Any:
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.observe(name, perf_counter() - start, **labels)
+        return timed_fn  # type: ignore
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        """Copy of the histogram of given name and labels."""
+        with self.__lock:
+            histogram = self.__histograms.get(name, dict()).get(_labels(labels))
+            copy = Histogram()
+            if histogram is not None:
+                copy.counts = list(histogram.counts)
+                copy.sum = histogram.sum
+                copy.count = histogram.count
+            return copy
+
+    def value(self, name: str, **labels: str) -> float:
+        """Current value of the counter or gauge of given name and labels."""
+        key = _labels(labels)
+        with self.__lock:
+            read = self.__gauges.get(name, dict()).get(key)
+            if read is None:
+                return self.__counters.get(name, dict()).get(key, 0)
+        return read()
+
+    def render(self) -> str:
+        """Every metric in Prometheus text exposition format."""
+        lines: List[str] = []
+        with self.__lock:
+            histograms = {name: {key: (list(histogram.counts), histogram.sum,
+                                       histogram.count)
+                                 for key, histogram in series.items()}
+                          for name, series in self.__histograms.items()}
+            counters = {name: dict(series)
+                        for name, series in self.__counters.items()}
+            gauges = {name: dict(series)
+                      for name, series in self.__gauges.items()}
+        for name, histogram_series in sorted(histograms.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s histogram' % name)
+            for key, (counts, total, count) in sorted(histogram_series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format(key + (('le', _bound(bound)),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, _format(key), total))
+                lines.append('%s_count%s %d' % (name, _format(key), count))
+        for name, counter_series in sorted(counters.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % name)
+            for key, amount in sorted(counter_series.items()):
+                lines.append('%s%s %r' % (name, _format(key), amount))
+        for name, gauge_series in sorted(gauges.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % name)
+            for key, read in sorted(gauge_series.items(), key=lambda item: item[0]):
+                try:
+                    value = read()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('failed reading gauge %s', name)
+                    continue
+                lines.append('%s%s %r' % (name, _format(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, listen: str = '0.0.0.0', port: int = 9090) -> int:
+        """Serves the metrics over HTTP in a background thread, returning
+        the port listened."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.__server = ThreadingHTTPServer((listen, port), Handler)
+        self.__server.daemon_threads = True
+        Thread(target=self.__server.serve_forever, name='Metrics',
+               daemon=True).start()
+        return self.__server.server_address[1]
+
+    def close(self) -> None:
+        """Stops serving the metrics, if served."""
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels)
+
+
+def _bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
@@ -1,3 +1,5 @@
 """Module of applications models."""
 
 from .calculator import *
+from .expression import *
+from .history import *
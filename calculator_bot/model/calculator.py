@@ -1,19 +1,106 @@
 """Model of definition model."""
 
-from dataclasses import dataclass
+from dataclasses import InitVar, dataclass
+from typing import Optional
+
+from .expression import ExpressionState, Number
+from .history import RESTORE, OperationLog
+
+
+# Longest expression kept, so a rendered calculator fits in a Telegram message
+MAX_EXPRESSION_LENGTH = 4000
 
 
 @dataclass
 class Calculator:
-    """Calculator represents a calculator with value and temporal expression."""
+    """Calculator represents a calculator with value and temporal expression.
+
+    Clones are given the expression state, the operation log and its size
+    once logged of the calculator they derive from."""
+    __slots__ = ('id_', 'value', 'expr', '__state', '__log', '__logged')
+
     id_: str
     value: float
     expr: str
+    state: InitVar[Optional[ExpressionState]] = None
+    history: InitVar[Optional[OperationLog]] = None
+    logged: InitVar[int] = 0
+
+    def __post_init__(self, state: Optional[ExpressionState],
+                      history: Optional[OperationLog], logged: int) -> None:
+        self.__state = state
+        self.__log = history
+        self.__logged = logged
+
+    @property
+    def log(self) -> Optional[OperationLog]:
+        """Log of the latest keys applied, if any"""
+        return self.__log
 
     def set_value(self, value: float) -> 'Calculator':
         """Creates clone instance with given value"""
-        return Calculator(self.id_, value, self.expr)
+        return self.__clone(value, self.expr, self.__state)
 
     def set_expr(self, expr: str) -> 'Calculator':
         """Creates clone instance with given expression"""
-        return Calculator(self.id_, self.value, expr)
+        return self.__clone(self.value, expr, None)
+
+    def push(self, key: str) -> 'Calculator':
+        """Creates clone instance with given key appended to the expression,
+        or returns the instance itself if the expression is too long"""
+        if len(self.expr) + len(key) > MAX_EXPRESSION_LENGTH:
+            return self
+        state = self.__expression_state().copy()
+        state.push(key)
+        return self.__clone(self.value, self.expr + key, state)
+
+    def record(self, before: 'Calculator', depth: int) -> None:
+        """Logs this clone as derived from before by a single key, keeping
+        up to depth keys. Expressions grown by the key are taken as appended
+        to, so it is only to be called on clones just created."""
+        log = before.branch_log(depth)
+        chars = len(self.expr) - len(before.expr)
+        if self.value == before.value and 0 <= chars < RESTORE:
+            log.append(chars)
+        else:
+            log.append_restore(before.value, before.expr)
+        self.__log = log
+        self.__logged = log.size
+
+    def branch_log(self, depth: int) -> OperationLog:
+        """Log to append the keys of clones derived from this calculator to,
+        keeping up to depth keys if new, or forked if other clones logged
+        keys since this one"""
+        if self.__log is None:
+            return OperationLog(depth)
+        if self.__log.size != self.__logged:
+            return self.__log.fork(self.__logged)
+        return self.__log
+
+    def undo(self) -> 'Calculator':
+        """Creates clone instance as it was before the latest key logged, or
+        returns the instance itself if none"""
+        if self.__log is None:
+            return self
+        # Undone apart, so the clones left behind keep their keys
+        log = self.__log.fork(self.__logged)
+        undone = log.undo(self.value, self.expr)
+        if undone is None:
+            return self
+        value, expr = undone
+        return Calculator(self.id_, value, expr, None, log, log.size)
+
+    def evaluate(self) -> Optional[Number]:
+        """Evaluates the expression, returning None if it is not complete"""
+        return self.__expression_state().result()
+
+    def __clone(self, value: float, expr: str,
+                state: Optional[ExpressionState]) -> 'Calculator':
+        return Calculator(self.id_, value, expr, state, self.__log,
+                          self.__logged)
+
+    def __expression_state(self) -> ExpressionState:
+        # State is built lazily for calculators created from a raw expression
+        if self.__state is None:
+            self.__state = ExpressionState.parse(self.expr)
+        return self.__state
@@ -0,0 +1,155 @@
+"""Model of calculator expressions evaluated key by key."""
+
+from typing import List, Optional, Union
+
+Number = Union[int, float]
+
+DIGITS = '0123456789.'
+PRECEDENCE = {'+': 0, '-': 0, '*': 1, '/': 1}
+# Opening parenthesis markers in the operator stack
+OPENING = ('(', '-(')
+
+
+class ExpressionState:
+    """Shunting-yard state of a calculator expression.
+
+    Keys are pushed one at a time and every operator is reduced as soon as
+    precedence allows it, so the operand and operator stacks never hold more
+    than three and two items per open parenthesis and each key costs O(1).
+    """
+
+    __slots__ = ('operands', 'operators', 'literal', 'closed', 'negate',
+                 'invalid')
+
+    def __init__(self) -> None:
+        self.operands: List[Number] = []
+        self.operators: List[str] = []
+        self.literal = ''
+        # Value of the last closed parenthesis, operand like the literal
+        self.closed: Optional[Number] = None
+        self.negate = False
+        self.invalid = False
+
+    @classmethod
+    def parse(cls, expr: str) -> 'ExpressionState':
+        """Creates state by pushing every key of given expression."""
+        state = cls()
+        for key in expr:
+            state.push(key)
+        return state
+
+    def copy(self) -> 'ExpressionState':
+        """Creates clone instance of the state."""
+        state = ExpressionState.__new__(ExpressionState)
+        state.operands = self.operands.copy()
+        state.operators = self.operators.copy()
+        state.literal = self.literal
+        state.closed = self.closed
+        state.negate = self.negate
+        state.invalid = self.invalid
+        return state
+
+    def push(self, key: str) -> None:
+        """Pushes a key into the expression, reducing pending operators."""
+        if self.invalid:
+            return
+        if key in DIGITS and self.closed is None:
+            self.literal += key
+        elif key in 'eE' and self.literal:
+            # Exponent of a previous value, i.e. '1e+20' from str(value)
+            self.literal += key
+        elif key in '+-' and self.literal[-1:] in ('e', 'E'):
+            self.literal += key
+        elif key in PRECEDENCE:
+            self.__push_operator(key)
+        elif key == '(' and not self.literal and self.closed is None:
+            self.operators.append('-(' if self.negate else '(')
+            self.negate = False
+        elif key == ')' and (self.literal or self.closed is not None):
+            self.__close_parenthesis()
+        else:
+            self.invalid = True
+
+    def result(self) -> Optional[Number]:
+        """Finishes the reduction, returning None if expression is not valid."""
+        if self.invalid or any(operator in OPENING for operator in self.operators):
+            return None
+        value = self.closed
+        if self.literal:
+            value = _literal_value(self.literal, self.negate)
+        if value is None:
+            return None
+        try:
+            for operand, operator in zip(reversed(self.operands),
+                                         reversed(self.operators)):
+                value = _apply(operator, operand, value)
+        except ArithmeticError:
+            return None
+        return value
+
+    def __push_operator(self, key: str) -> None:
+        if self.literal or self.closed is not None:
+            self.__push_operand()
+            if self.invalid:
+                return
+            self.__reduce(PRECEDENCE[key])
+            self.operators.append(key)
+        elif key == '-':
+            self.negate = not self.negate
+        elif key != '+':
+            # Unary plus leaves the operand as is
+            self.invalid = True
+
+    def __close_parenthesis(self) -> None:
+        self.__push_operand()
+        if self.invalid:
+            return
+        self.__reduce(-1)
+        if self.invalid or not self.operators:
+            self.invalid = True
+            return
+        value = self.operands.pop()
+        self.closed = -value if self.operators.pop() == '-(' else value
+
+    def __push_operand(self) -> None:
+        value = self.closed
+        if self.literal:
+            value = _literal_value(self.literal, self.negate)
+        self.literal = ''
+        self.closed = None
+        self.negate = False
+        if value is None:
+            self.invalid = True
+        else:
+            self.operands.append(value)
+
+    def __reduce(self, precedence: int) -> None:
+        while self.operators and self.operators[-1] not in OPENING \
+                and PRECEDENCE[self.operators[-1]] >= precedence:
+            right = self.operands.pop()
+            left = self.operands.pop()
+            try:
+                self.operands.append(_apply(self.operators.pop(), left, right))
+            except ArithmeticError:
+                self.invalid = True
+                return
+
+
+def _literal_value(literal: str, negate: bool) -> Optional[Number]:
+    if literal == '.':
+        literal = '0.'
+    try:
+        value: Number = int(literal) if literal.isdigit() else float(literal)
+    except ValueError:
+        return None
+    return -value if negate else value
+
+
+def _apply(operator: str, left: Number, right: Number) -> Number:
+    if operator == '+':
+        return left + right
+    if operator == '-':
+        return left - right
+    if operator == '*':
+        return left * right
+    return left / right
@@ -0,0 +1,139 @@
+"""Model of the history of keys applied to calculators."""
+
+import itertools
+from array import array
+from typing import Iterator, List, Optional, Tuple, Union
+
+Item = Union[int, float]
+
+
+class RingBuffer:
+    """Array of the latest items appended, up to capacity. The array grows
+    as items are appended until it reaches capacity."""
+
+    __slots__ = ('items', 'capacity', 'start', 'size')
+
+    def __init__(self, typecode: str, capacity: int) -> None:
+        self.items = array(typecode)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def copy(self) -> 'RingBuffer':
+        """Creates clone instance of the buffer."""
+        ring = RingBuffer.__new__(RingBuffer)
+        ring.items = self.items[:]
+        ring.capacity = self.capacity
+        ring.start = self.start
+        ring.size = self.size
+        return ring
+
+    def append(self, item: Item) -> Optional[Item]:
+        """Appends item, returning the oldest one if dropped to make room."""
+        if self.capacity <= 0:
+            return item
+        if len(self.items) < self.capacity:
+            # Items are not wrapped around until the array is full
+            del self.items[self.size:]
+            self.items.append(item)
+            self.size += 1
+            return None
+        dropped = None
+        if self.size == self.capacity:
+            dropped = self.items[self.start]
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+        self.items[(self.start + self.size) % self.capacity] = item
+        self.size += 1
+        return dropped
+
+    def pop(self) -> Optional[Item]:
+        """Removes the latest item, if any."""
+        if self.size == 0:
+            return None
+        self.size -= 1
+        return self.items[(self.start + self.size) % len(self.items)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[Item]:
+        for offset in range(self.size):
+            yield self.items[(self.start + offset) % len(self.items)]
+
+
+# Undo of a key replacing the value and the expression, kept apart
+RESTORE = 255
+
+
+class OperationLog:
+    """Log of the latest keys applied to a calculator, as the way to undo
+    each of them, and of its latest results.
+
+    Keys appending to the expression are undone by the number of characters
+    they appended, while the value and expression replaced by the rest are
+    kept apart. Once depth keys are logged, the oldest ones are dropped.
+
+    Logs are shared by the clones of a calculator and appended in place, so
+    every clone knows the size of the log it was created with, and forks the
+    log before logging on top of a size already left behind.
+    """
+
+    __slots__ = ('size', 'undos', 'restores', 'results')
+
+    def __init__(self, depth: int) -> None:
+        self.size = 0
+        self.undos = RingBuffer('B', depth)
+        # Values and expressions replaced by the keys logged, in pairs
+        self.restores: List[Union[float, str]] = []
+        self.results = RingBuffer('d', depth)
+
+    def fork(self, size: int) -> 'OperationLog':
+        """Creates clone instance of the log as it was at given size."""
+        log = OperationLog(self.undos.capacity)
+        first = self.size - len(self.undos)
+        size = min(size, self.size)
+        for undo in itertools.islice(self.undos, max(size - first, 0)):
+            log.undos.append(undo)
+        log.size = size
+        restores = sum(1 for undo in log.undos if undo == RESTORE)
+        log.restores = self.restores[:2 * restores]
+        log.results = self.results.copy()
+        return log
+
+    def append(self, chars: int) -> None:
+        """Logs a key appending given number of characters."""
+        self.__append(chars)
+
+    def append_restore(self, value: float, expr: str) -> None:
+        """Logs a key replacing given value and expression."""
+        self.restores += (value, expr)
+        self.__append(RESTORE)
+
+    def undo(self, value: float, expr: str) -> Optional[Tuple[float, str]]:
+        """Removes the latest key, returning given value and expression as
+        they were before it, if any."""
+        undo = self.undos.pop()
+        if undo is None:
+            return None
+        self.size -= 1
+        if undo == RESTORE:
+            expr = self.restores.pop()  # type: ignore
+            return self.restores.pop(), expr  # type: ignore
+        return value, expr[:len(expr) - int(undo)]
+
+    def add_result(self, value: float) -> None:
+        """Records the result of an evaluation."""
+        try:
+            self.results.append(float(value))
+        except OverflowError:
+            self.results.append(float('inf') if value > 0 else float('-inf'))
+
+    def recent_results(self) -> List[float]:
+        """Latest results, from the oldest."""
+        return [float(value) for value in self.results]
+
+    def __append(self, undo: int) -> None:
+        if self.undos.append(undo) == RESTORE:
+            del self.restores[:2]
+        self.size += 1
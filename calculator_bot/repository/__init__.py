@@ -1,3 +1,10 @@
 """Module of application repositories"""
 
+from .bounded import *
 from .calculator import *
+from .codec import *
+from .instrumented import *
+from .resp import *
+from .snapshot import *
+from .sqlite import *
+from .tiered import *
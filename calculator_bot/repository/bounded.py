@@ -0,0 +1,177 @@
+"""Module of memory bounded calculators repository."""
+import logging
+import os
+import resource
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, Optional, Tuple
+
+from option import Result
+from option.result import Err, Ok
+
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+
+
+class BoundedMemoryCalculatorRepository(CalculatorRepository):
+    """Repository class for calculators in memory bounded by entries and idle time.
+
+    Calculators idle for more than ttl seconds, or the least recently used
+    ones once max_entries is reached, are evicted. Evicted calculators are
+    written to the lower repository, if any, and rehydrated from it on next
+    access. Without lower repository they are recreated from scratch.
+    """
+
+    REPORT_EVERY = 1000
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 24 * 60 * 60,
+                 lower: Optional[CalculatorRepository] = None) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lower = lower
+        self.evictions = 0
+        self.rehydrations = 0
+        self.__lock = Lock()
+        # Ordered from least to most recently used
+        self.__calculators: 'OrderedDict[str, Tuple[Calculator, float]]' = OrderedDict()
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        if id_ == '':
+            return Err('bad_request')
+        with self.__lock:
+            found = self.__find(id_)
+            if found.is_ok:
+                return Err('conflict')
+            if found.unwrap_err() != 'not_found':
+                return found
+            calc = Calculator(id_, 0, '')
+            self.__store(calc)
+            return Ok(calc)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        with self.__lock:
+            result = self.__find(id_)
+            self.__evict()
+        return result
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        with self.__lock:
+            found = self.__find(id_)
+            if found.is_err:
+                return found
+            self.__store(calc)
+            return Ok(calc)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids."""
+        with self.__lock:
+            results = {id_: self.__find(id_) for id_ in ids}
+            self.__evict()
+        return results
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids."""
+        results: Dict[str, Result[Calculator, str]] = dict()
+        with self.__lock:
+            for calc in calcs:
+                found = self.__find(calc.id_)
+                if found.is_err:
+                    results[calc.id_] = found
+                    continue
+                self.__store(calc)
+                results[calc.id_] = Ok(calc)
+        return results
+
+    def evict_idle(self) -> None:
+        """Evicts calculators idle for more than ttl seconds."""
+        with self.__lock:
+            self.__evict()
+
+    @property
+    def shared(self) -> bool:
+        """Whether the lower repository, if any, is shared."""
+        return self.lower is not None and self.lower.shared
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators resident in memory."""
+        return len(self.__calculators)
+
+    def stats(self) -> Dict[str, int]:
+        """Resident calculators, evictions and resident set size of the process."""
+        return {
+            'entries': len(self.__calculators),
+            'evictions': self.evictions,
+            'rehydrations': self.rehydrations,
+            'rss_bytes': resident_set_size(),
+        }
+
+    def close(self) -> None:
+        """Writes resident calculators to the lower repository, if any."""
+        if self.lower is None:
+            return
+        with self.__lock:
+            while self.__calculators:
+                _, (calc, _) = self.__calculators.popitem(last=False)
+                self.__demote(calc)
+        self.lower.close()
+
+    def __find(self, id_: str) -> Result[Calculator, str]:
+        entry = self.__calculators.get(id_)
+        if entry is not None:
+            self.__calculators[id_] = (entry[0], monotonic())
+            self.__calculators.move_to_end(id_)
+            return Ok(entry[0])
+        if self.lower is None:
+            return Err('not_found')
+        # Failures of the lower repository are not taken as not found, so
+        # calculators are not recreated over the stored ones
+        result = self.lower.get_calculator(id_)
+        if result.is_ok:
+            self.rehydrations += 1
+            self.__store(result.unwrap())
+        return result
+
+    def __store(self, calc: Calculator) -> None:
+        self.__calculators[calc.id_] = (calc, monotonic())
+        self.__calculators.move_to_end(calc.id_)
+        self.__evict()
+
+    def __evict(self) -> None:
+        deadline = monotonic() - self.ttl
+        while self.__calculators:
+            _, (calc, used) = next(iter(self.__calculators.items()))
+            if len(self.__calculators) <= self.max_entries and used > deadline:
+                break
+            self.__calculators.popitem(last=False)
+            self.__demote(calc)
+            self.evictions += 1
+            if self.evictions % self.REPORT_EVERY == 0:
+                logging.info('Evicted calculators: %s', self.stats())
+
+    def __demote(self, calc: Calculator) -> None:
+        if self.lower is None:
+            return
+        result = self.lower.update_calculator(calc.id_, calc)
+        if result.is_err and result.unwrap_err() == 'not_found':
+            result = self.lower.create_calculator(calc.id_)
+            if result.is_ok:
+                result = self.lower.update_calculator(calc.id_, calc)
+        if result.is_err:
+            logging.error('failed demoting calculator %s: %s',
+                          calc.id_, result.unwrap_err())
+
+
+def resident_set_size() -> int:
+    """Resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Peak instead of current size where procfs is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,6 +1,6 @@
 """Module of definitions repository through HTTP requests."""
 from abc import ABC, abstractmethod
-from typing import Dict
+from typing import Dict, Iterable, Optional
 
 from option import Result
 from option.result import Err, Ok
@@ -23,6 +23,34 @@ class CalculatorRepository(ABC):
     def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
         """Update calculator by id."""
 
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids."""
+        return {id_: self.get_calculator(id_) for id_ in ids}
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids."""
+        return {calc.id_: self.update_calculator(calc.id_, calc) for calc in calcs}
+
+    def get_or_create_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids, creating the ones not found."""
+        results = self.get_many(ids)
+        for id_, result in results.items():
+            if result.is_err and result.unwrap_err() == 'not_found':
+                results[id_] = self.create_calculator(id_)
+        return results
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators held, if known."""
+        return None
+
+    @property
+    def shared(self) -> bool:
+        """Whether other processes read and write the same calculators."""
+        return False
+
+    def close(self) -> None:
+        """Release resources held by the repository."""
+
 
 class MemoryCalculatorRepository(CalculatorRepository):
     """Repository class for definitions through HTTP requests to RAE's DLE pages."""
@@ -53,3 +81,7 @@ class MemoryCalculatorRepository(CalculatorRepository):
             return Err('not_found')
         self.__calculators[id_] = calc
         return Ok(calc)
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators held."""
+        return len(self.__calculators)
@@ -0,0 +1,13 @@
+"""Module of the text encoding of calculator values in storage."""
+
+from calculator_bot.model import Number
+
+
+def encode_value(value: Number) -> str:
+    """Encodes value as text, keeping integers exact whatever their size."""
+    return repr(value)
+
+
+def decode_value(value: str) -> Number:
+    """Decodes value encoded by encode_value."""
+    return int(value) if value.lstrip('-').isdigit() else float(value)
@@ -0,0 +1,70 @@
+"""Module of calculators repository recording operation timings."""
+from typing import Dict, Iterable, Optional
+
+from option import Result
+
+from calculator_bot.metrics import Metrics
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+
+
+class InstrumentedCalculatorRepository(CalculatorRepository):
+    """Repository class recording the duration of every operation of the
+    wrapped repository, and gauging its number of calculators."""
+
+    def __init__(self, repo: CalculatorRepository, metrics: Metrics) -> None:
+        super().__init__()
+        self.repo = repo
+        self.metrics = metrics
+        self.__create = metrics.timed(
+            'repository_seconds', repo.create_calculator, operation='create')
+        self.__get = metrics.timed(
+            'repository_seconds', repo.get_calculator, operation='get')
+        self.__update = metrics.timed(
+            'repository_seconds', repo.update_calculator, operation='update')
+        self.__get_many = metrics.timed(
+            'repository_seconds', repo.get_many, operation='get_many')
+        self.__update_many = metrics.timed(
+            'repository_seconds', repo.update_many, operation='update_many')
+        self.__get_or_create_many = metrics.timed(
+            'repository_seconds', repo.get_or_create_many,
+            operation='get_or_create_many')
+        metrics.gauge('calculators', lambda: repo.count_calculators() or 0)
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        return self.__create(id_)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        return self.__get(id_)
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        return self.__update(id_, calc)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids."""
+        return self.__get_many(ids)
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids."""
+        return self.__update_many(calcs)
+
+    def get_or_create_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids, creating the ones not found."""
+        return self.__get_or_create_many(ids)
+
+    @property
+    def shared(self) -> bool:
+        """Whether the wrapped repository is shared."""
+        return self.repo.shared
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators of the wrapped repository."""
+        return self.repo.count_calculators()
+
+    def close(self) -> None:
+        """Closes the wrapped repository."""
+        self.repo.close()
@@ -0,0 +1,252 @@
+"""Module of calculators repository stored in a Redis protocol server."""
+import logging
+import socket
+from threading import Lock
+from typing import (Any, BinaryIO, Dict, Iterable, List, Optional, Sequence,
+                    Union, cast)
+
+from option import Result
+from option.result import Err, Ok
+
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+from .codec import decode_value, encode_value
+
+Argument = Union[str, bytes, int, float]
+Reply = Union[None, int, str, bytes, 'RespError', List[Any]]
+
+
+class RespError(Exception):
+    """Error replied by the server to a command."""
+
+
+def encode_command(*args: Argument) -> bytes:
+    """Encodes a command as a RESP array of bulk strings."""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+def read_reply(file: BinaryIO) -> Reply:
+    """Reads a RESP reply. Error replies are returned, not raised, so the
+    replies following them in a pipeline are read as well."""
+    line = file.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed by the server')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        return RespError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = file.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError('connection closed by the server')
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(file) for _ in range(length)]
+    raise RespError('unexpected reply: %r' % line)
+
+
+class RespClient:
+    """Client of a Redis protocol server sending commands in pipelines.
+
+    Every pipeline is written at once and its replies read in a single round
+    trip. Connections are kept open and shared by threads one at a time, and
+    dropped along with the idle ones once a pipeline fails on them.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379,
+                 timeout: Optional[float] = 5.0) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.round_trips = 0
+        self.__lock = Lock()
+        self.__idle: List[socket.socket] = []
+
+    def execute(self, *args: Argument) -> Reply:
+        """Sends a command, returning its reply."""
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands: Sequence[Sequence[Argument]]) -> List[Reply]:
+        """Sends commands at once, returning their replies. Raises the first
+        error replied after reading every reply, and OSError, RespError or
+        ValueError if the connection fails or replies garbage."""
+        connection = self.__acquire()
+        try:
+            connection.sendall(b''.join(encode_command(*args) for args in commands))
+            with connection.makefile('rb') as file:
+                replies = [read_reply(file) for _ in commands]
+        except Exception:
+            # Replies of a broken pipeline can not be told apart anymore, and
+            # idle connections are likely broken as well
+            connection.close()
+            self.close()
+            raise
+        with self.__lock:
+            self.round_trips += 1
+            self.__idle.append(connection)
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for connection in idle:
+            connection.close()
+
+    def __acquire(self) -> socket.socket:
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+        connection = socket.create_connection((self.host, self.port), self.timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+
+class RespCalculatorRepository(CalculatorRepository):
+    """Repository class for calculators stored in a Redis protocol server,
+    shared by every process and host running the bot.
+
+    Calculators are stored as strings under prefix followed by their id,
+    expiring after expiry seconds without updates if given. Creations and
+    updates are atomic SET NX and SET XX commands, and calculators of a
+    batch are read or written in a single round trip. Failures reaching the
+    server are logged and returned as 'unavailable'.
+    """
+
+    def __init__(self, client: RespClient, prefix: str = 'calculator:',
+                 expiry: Optional[int] = None) -> None:
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.expiry = expiry
+
+    @property
+    def shared(self) -> bool:
+        """Calculators are shared by every process using the server."""
+        return True
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        if id_ == '':
+            return Err('bad_request')
+        calc = Calculator(id_, 0, '')
+        replies = self.__pipeline([self.__set(calc, 'NX')])
+        if replies.is_err:
+            return Err(replies.unwrap_err())
+        if replies.unwrap()[0] is None:
+            return Err('conflict')
+        return Ok(calc)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        replies = self.__pipeline([['GET', self.prefix + id_]])
+        if replies.is_err:
+            return Err(replies.unwrap_err())
+        data = replies.unwrap()[0]
+        if not isinstance(data, bytes):
+            return Err('not_found')
+        return Ok(_decode_calculator(id_, data))
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        replies = self.__pipeline([self.__set(calc, 'XX', id_)])
+        if replies.is_err:
+            return Err(replies.unwrap_err())
+        if replies.unwrap()[0] is None:
+            return Err('not_found')
+        return Ok(calc)
+
+    def get_or_create_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids, creating the ones not found, in a single
+        round trip."""
+        ids = list(ids)
+        results: Dict[str, Result[Calculator, str]] = {
+            id_: Err('bad_request') for id_ in ids if id_ == ''}
+        ids = [id_ for id_ in ids if id_ != '']
+        if not ids:
+            return results
+        commands: List[Sequence[Argument]] = [
+            self.__set(Calculator(id_, 0, ''), 'NX') for id_ in ids]
+        commands.append(['MGET'] + [self.prefix + id_ for id_ in ids])
+        replies = self.__pipeline(commands)
+        if replies.is_err:
+            results.update((id_, Err(replies.unwrap_err())) for id_ in ids)
+            return results
+        values = cast(List[Reply], replies.unwrap()[-1])
+        for id_, data in zip(ids, values):
+            # Removed by expiry between both commands
+            results[id_] = Ok(_decode_calculator(id_, data)) \
+                if isinstance(data, bytes) else Err('not_found')
+        return results
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids at once."""
+        ids = list(ids)
+        if not ids:
+            return dict()
+        replies = self.__pipeline([['MGET'] + [self.prefix + id_ for id_ in ids]])
+        if replies.is_err:
+            return {id_: Err(replies.unwrap_err()) for id_ in ids}
+        values = cast(List[Reply], replies.unwrap()[0])
+        return {id_: Ok(_decode_calculator(id_, data))
+                if isinstance(data, bytes) else Err('not_found')
+                for id_, data in zip(ids, values)}
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids at once."""
+        calcs = list(calcs)
+        if not calcs:
+            return dict()
+        replies = self.__pipeline([self.__set(calc, 'XX') for calc in calcs])
+        if replies.is_err:
+            return {calc.id_: Err(replies.unwrap_err()) for calc in calcs}
+        return {calc.id_: Ok(calc) if reply is not None else Err('not_found')
+                for calc, reply in zip(calcs, replies.unwrap())}
+
+    def close(self) -> None:
+        """Closes the connections to the server."""
+        self.client.close()
+
+    def __pipeline(self, commands: Sequence[Sequence[Argument]]) -> Result[List[Reply], str]:
+        try:
+            return Ok(self.client.pipeline(commands))
+        except (OSError, RespError, ValueError) as error:
+            logging.error('failed sending %d commands to %s:%d: %r', len(commands),
+                          self.client.host, self.client.port, error)
+            return Err('unavailable')
+
+    def __set(self, calc: Calculator, condition: str,
+              id_: Optional[str] = None) -> List[Argument]:
+        command: List[Argument] = [
+            'SET', self.prefix + (calc.id_ if id_ is None else id_),
+            _encode_calculator(calc), condition]
+        if self.expiry is not None:
+            command += ['EX', self.expiry]
+        return command
+
+
+def _encode_calculator(calc: Calculator) -> bytes:
+    # Values and expressions never contain spaces
+    return ('%s %s' % (encode_value(calc.value), calc.expr)).encode()
+
+
+def _decode_calculator(id_: str, data: bytes) -> Calculator:
+    value, _, expr = data.decode().partition(' ')
+    return Calculator(id_, decode_value(value), expr)
@@ -0,0 +1,246 @@
+"""Module of calculators repository restored from binary snapshots."""
+import heapq
+import logging
+import mmap
+import os
+import struct
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from option import Result
+from option.result import Err, Ok
+
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+from .codec import decode_value, encode_value
+
+MAGIC = b'CALCSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sI')
+# Lengths of the id, value and expression of a record
+RECORD = struct.Struct('<HHI')
+OFFSET = struct.Struct('<Q')
+# Offset of the index and number of records
+FOOTER = struct.Struct('<QQ')
+
+Record = Tuple[bytes, bytes, bytes]
+
+
+class Snapshot:
+    """Calculators of a snapshot file, memory mapped and decoded on access.
+
+    The file holds a header, the records of every calculator as id, value
+    and expression prefixed by their lengths, the offsets of the records
+    sorted by id, and a footer locating them. Calculators are found by
+    binary search of the offsets, so opening takes the same time whatever
+    the number of calculators.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.__map)
+        if size < HEADER.size + FOOTER.size or \
+                HEADER.unpack_from(self.__map) != (MAGIC, VERSION):
+            self.__map.close()
+            raise ValueError('invalid snapshot: %s' % path)
+        self.__index, self.__count = FOOTER.unpack_from(self.__map, size - FOOTER.size)
+
+    @classmethod
+    def open(cls, path: str) -> Optional['Snapshot']:
+        """Opens the snapshot at path, if any."""
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def get(self, id_: str) -> Optional[Calculator]:
+        """Decodes calculator by id, if in the snapshot."""
+        key = id_.encode()
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            found, value, expr = self.__record(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return Calculator(id_, decode_value(value.decode()), expr.decode())
+        return None
+
+    def records(self) -> Iterator[Record]:
+        """Undecoded records sorted by id."""
+        for position in range(self.__count):
+            yield self.__record(position)
+
+    def close(self) -> None:
+        """Unmaps the snapshot file."""
+        self.__map.close()
+
+    def __record(self, position: int) -> Record:
+        offset, = OFFSET.unpack_from(self.__map, self.__index + position * OFFSET.size)
+        id_length, value_length, expr_length = RECORD.unpack_from(self.__map, offset)
+        start = offset + RECORD.size
+        value_start = start + id_length
+        expr_start = value_start + value_length
+        return (self.__map[start:value_start], self.__map[value_start:expr_start],
+                self.__map[expr_start:expr_start + expr_length])
+
+
+def write_snapshot(path: str, records: Iterable[Record]) -> int:
+    """Writes records sorted by id as the snapshot at path, replacing it at
+    once. Returns the number of records written."""
+    offsets: List[int] = []
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION))
+        offset = HEADER.size
+        for id_, value, expr in records:
+            offsets.append(offset)
+            file.write(RECORD.pack(len(id_), len(value), len(expr)))
+            file.write(id_)
+            file.write(value)
+            file.write(expr)
+            offset += RECORD.size + len(id_) + len(value) + len(expr)
+        # Offsets follow the last record
+        file.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        file.write(FOOTER.pack(offset, len(offsets)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return len(offsets)
+
+
+class SnapshotCalculatorRepository(CalculatorRepository):
+    """Repository class for calculators in memory saved to a snapshot file.
+
+    Calculators of the snapshot found at path on creation are decoded on
+    first access. Snapshots merging the updated calculators into the
+    previous one are written every interval seconds and on close.
+
+    Unless keep_saved, calculators are dropped from memory once saved and
+    decoded again on every access, so a repository in front of this one
+    holds the calculators in use.
+    """
+
+    def __init__(self, path: str, interval: float = 60.0,
+                 keep_saved: bool = True) -> None:
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self.keep_saved = keep_saved
+        self.snapshot = Snapshot.open(path)
+        self.__lock = Lock()
+        # Held while saving, so snapshots are merged and swapped in turn
+        self.__saving = Lock()
+        self.__calculators: Dict[str, Calculator] = dict()
+        self.__created = 0
+        self.__dirty = False
+        self.__closed = Event()
+        self.__writer = Thread(
+            target=self.__run_writer, name='SnapshotWriter', daemon=True)
+        self.__writer.start()
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        if id_ == '':
+            return Err('bad_request')
+        with self.__lock:
+            if self.__find(id_) is not None:
+                return Err('conflict')
+            calc = Calculator(id_, 0, '')
+            self.__calculators[id_] = calc
+            self.__created += 1
+            self.__dirty = True
+            return Ok(calc)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        with self.__lock:
+            calc = self.__find(id_)
+        if calc is None:
+            return Err('not_found')
+        return Ok(calc)
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        with self.__lock:
+            if self.__find(id_) is None:
+                return Err('not_found')
+            self.__calculators[id_] = calc
+            self.__dirty = True
+            return Ok(calc)
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators held, restored or not."""
+        restored = len(self.snapshot) if self.snapshot is not None else 0
+        return restored + self.__created
+
+    def save(self) -> None:
+        """Writes a snapshot if any calculator changed since the last one."""
+        with self.__saving:
+            self.__save()
+
+    def close(self) -> None:
+        """Writes a last snapshot and releases the previous one."""
+        self.__closed.set()
+        self.__writer.join()
+        self.save()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+    def __save(self) -> None:
+        with self.__lock:
+            if not self.__dirty:
+                return
+            calcs = list(self.__calculators.values())
+            created = self.__created
+            self.__dirty = False
+        try:
+            count = write_snapshot(self.path, self.__records(calcs))
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError):
+            logging.exception('failed writing snapshot %s', self.path)
+            with self.__lock:
+                self.__dirty = True
+            return
+        with self.__lock:
+            # Calculators saved are found in the new snapshot from now on
+            previous, self.snapshot = self.snapshot, snapshot
+            self.__created -= created
+            if not self.keep_saved:
+                for calc in calcs:
+                    # Calculators updated while being saved stay in memory
+                    if self.__calculators.get(calc.id_) is calc:
+                        del self.__calculators[calc.id_]
+        if previous is not None:
+            previous.close()
+        logging.info('Saved snapshot of %d calculators: %s', count, self.path)
+
+    def __find(self, id_: str) -> Optional[Calculator]:
+        calc = self.__calculators.get(id_)
+        if calc is None and self.snapshot is not None:
+            calc = self.snapshot.get(id_)
+            if calc is not None and self.keep_saved:
+                self.__calculators[id_] = calc
+        return calc
+
+    def __records(self, calcs: List[Calculator]) -> Iterator[Record]:
+        updated = sorted((calc.id_.encode(), encode_value(calc.value).encode(),
+                          calc.expr.encode()) for calc in calcs)
+        restored = self.snapshot.records() if self.snapshot is not None \
+            else iter(())
+        previous = None
+        # Updated records come first among records of the same id
+        for record in heapq.merge(updated, restored, key=lambda record: record[0]):
+            if record[0] != previous:
+                previous = record[0]
+                yield record
+
+    def __run_writer(self) -> None:
+        while not self.__closed.wait(self.interval):
+            self.save()
@@ -0,0 +1,197 @@
+"""Module of calculators repository persisted in SQLite."""
+import logging
+import sqlite3
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from option import Result
+from option.result import Err, Ok
+
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+from .codec import decode_value, encode_value
+
+CREATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS calculators (
+    id TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expr TEXT NOT NULL
+) WITHOUT ROWID
+'''
+SELECT_CALCULATOR = 'SELECT value, expr FROM calculators WHERE id = ?'
+SELECT_CALCULATORS = 'SELECT id, value, expr FROM calculators WHERE id IN (%s)'
+# Default SQLITE_MAX_VARIABLE_NUMBER of old SQLite versions
+MAX_VARIABLES = 999
+COUNT_CALCULATORS = 'SELECT COUNT(*) FROM calculators'
+UPSERT_CALCULATOR = 'INSERT OR REPLACE INTO calculators (id, value, expr) VALUES (?, ?, ?)'
+
+
+class SqliteCalculatorRepository(CalculatorRepository):
+    """Repository class for calculators persisted in a SQLite database.
+
+    Recently used calculators are kept in memory and updates are written
+    behind by a flusher thread, grouping every update of a flush interval
+    in a single transaction.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0,
+                 cache_size: int = 10000) -> None:
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.__connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__connection.execute(CREATE_TABLE)
+        self.__connection_lock = Lock()
+        self.__lock = Lock()
+        self.__calculators: 'OrderedDict[str, Calculator]' = OrderedDict()
+        self.__dirty: Dict[str, Calculator] = dict()
+        self.__flushing: Dict[str, Calculator] = dict()
+        self.__closed = Event()
+        self.__flusher = Thread(
+            target=self.__run_flusher, name='SqliteFlusher', daemon=True)
+        self.__flusher.start()
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        if id_ == '':
+            return Err('bad_request')
+        with self.__lock:
+            if self.__find(id_) is not None:
+                return Err('conflict')
+            calc = Calculator(id_, 0, '')
+            self.__store(calc)
+            return Ok(calc)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        with self.__lock:
+            calc = self.__find(id_)
+        if calc is None:
+            return Err('not_found')
+        return Ok(calc)
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        with self.__lock:
+            if self.__find(id_) is None:
+                return Err('not_found')
+            self.__store(calc)
+            return Ok(calc)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids, querying the missing ones at once."""
+        with self.__lock:
+            calcs = {id_: self.__find_cached(id_) for id_ in ids}
+            loaded = self.__load(
+                [id_ for id_, calc in calcs.items() if calc is None])
+            calcs = {id_: calc or loaded.get(id_)
+                     for id_, calc in calcs.items()}
+        return {id_: Ok(calc) if calc is not None else Err('not_found')
+                for id_, calc in calcs.items()}
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids."""
+        calcs = list(calcs)
+        results: Dict[str, Result[Calculator, str]] = dict()
+        with self.__lock:
+            found = {calc.id_ for calc in calcs
+                     if self.__find_cached(calc.id_) is not None}
+            found.update(self.__load(
+                [calc.id_ for calc in calcs if calc.id_ not in found]))
+            for calc in calcs:
+                if calc.id_ not in found:
+                    results[calc.id_] = Err('not_found')
+                    continue
+                self.__store(calc)
+                results[calc.id_] = Ok(calc)
+        return results
+
+    def flush(self) -> None:
+        """Writes every pending update in a single transaction."""
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__flushing, self.__dirty = self.__dirty, dict()
+            rows = [(calc.id_, encode_value(calc.value), calc.expr)
+                    for calc in self.__flushing.values()]
+        try:
+            with self.__connection_lock, self.__connection:
+                self.__connection.execute('BEGIN')
+                self.__connection.executemany(UPSERT_CALCULATOR, rows)
+        except sqlite3.Error:
+            logging.exception('failed flushing %d calculators', len(rows))
+            with self.__lock:
+                # Keep updates newer than the failed ones
+                self.__flushing.update(self.__dirty)
+                self.__dirty = self.__flushing
+                self.__flushing = dict()
+            return
+        with self.__lock:
+            self.__flushing = dict()
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators stored, flushing pending updates first."""
+        self.flush()
+        with self.__connection_lock:
+            row: Tuple[int] = self.__connection.execute(COUNT_CALCULATORS).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        """Flushes pending updates and closes the database."""
+        self.__closed.set()
+        self.__flusher.join()
+        self.flush()
+        with self.__connection_lock:
+            self.__connection.close()
+
+    def __find(self, id_: str) -> Optional[Calculator]:
+        calc = self.__find_cached(id_)
+        if calc is not None:
+            return calc
+        with self.__connection_lock:
+            row: Optional[Tuple[str, str]] = self.__connection.execute(
+                SELECT_CALCULATOR, (id_,)).fetchone()
+        if row is None:
+            return None
+        calc = Calculator(id_, decode_value(row[0]), row[1])
+        self.__cache(calc)
+        return calc
+
+    def __find_cached(self, id_: str) -> Optional[Calculator]:
+        calc = self.__dirty.get(id_) or self.__flushing.get(id_) \
+            or self.__calculators.get(id_)
+        if calc is not None:
+            self.__cache(calc)
+        return calc
+
+    def __load(self, ids: List[str]) -> Dict[str, Calculator]:
+        calcs: Dict[str, Calculator] = dict()
+        for start in range(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            query = SELECT_CALCULATORS % ', '.join('?' * len(chunk))
+            with self.__connection_lock:
+                rows = self.__connection.execute(query, chunk).fetchall()
+            for id_, value, expr in rows:
+                calcs[id_] = Calculator(id_, decode_value(value), expr)
+                self.__cache(calcs[id_])
+        return calcs
+
+    def __store(self, calc: Calculator) -> None:
+        self.__dirty[calc.id_] = calc
+        self.__cache(calc)
+
+    def __cache(self, calc: Calculator) -> None:
+        self.__calculators[calc.id_] = calc
+        self.__calculators.move_to_end(calc.id_)
+        if len(self.__calculators) > self.cache_size:
+            # Pending updates are still found in the dirty calculators
+            self.__calculators.popitem(last=False)
+
+    def __run_flusher(self) -> None:
+        while not self.__closed.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,221 @@
+"""Module of calculators repository tiered in hot memory and cold storage."""
+import logging
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from option import Result
+from option.result import Err, Ok
+
+from calculator_bot.model import Calculator
+
+from .calculator import CalculatorRepository
+
+
+class TieredCalculatorRepository(CalculatorRepository):
+    """Repository class for calculators in a hot memory tier in front of a
+    cold repository.
+
+    Calculators idle for more than idle seconds are demoted to the cold
+    repository by a background thread every interval seconds, and promoted
+    back to memory on next access. Calculators in use are served from
+    memory without touching the cold repository.
+    """
+
+    def __init__(self, cold: CalculatorRepository, idle: float = 300.0,
+                 interval: float = 30.0) -> None:
+        super().__init__()
+        self.cold = cold
+        self.idle = idle
+        self.interval = interval
+        self.demotions = 0
+        self.promotions = 0
+        self.__lock = Lock()
+        # Held while demoting, so a copy written by a former demotion never
+        # overwrites the one written by a later demotion in cold storage
+        self.__demoting = Lock()
+        # Ordered from least to most recently used
+        self.__hot: 'OrderedDict[str, Tuple[Calculator, float]]' = OrderedDict()
+        self.__closed = Event()
+        self.__demoter = Thread(
+            target=self.__run_demoter, name='TieredDemoter', daemon=True)
+        self.__demoter.start()
+
+    def create_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Create a new calculator."""
+        if id_ == '':
+            return Err('bad_request')
+        found = self.__find(id_)
+        if found.is_ok:
+            return Err('conflict')
+        if found.unwrap_err() != 'not_found':
+            return found
+        calc = Calculator(id_, 0, '')
+        with self.__lock:
+            # Created meanwhile by another thread
+            if id_ in self.__hot:
+                return Err('conflict')
+            self.__store(calc)
+        return Ok(calc)
+
+    def get_calculator(self, id_: str) -> Result[Calculator, str]:
+        """Find calculator by id."""
+        return self.__find(id_)
+
+    def update_calculator(self, id_: str, calc: Calculator) -> Result[Calculator, str]:
+        """Update calculator by id."""
+        with self.__lock:
+            if id_ in self.__hot:
+                self.__store(calc)
+                return Ok(calc)
+        found = self.__find(id_)
+        if found.is_err:
+            return found
+        with self.__lock:
+            self.__store(calc)
+        return Ok(calc)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Result[Calculator, str]]:
+        """Find calculators by ids, promoting the cold ones at once."""
+        results: Dict[str, Result[Calculator, str]] = dict()
+        missing: List[str] = []
+        with self.__lock:
+            for id_ in ids:
+                calc = self.__touch(id_)
+                if calc is None:
+                    missing.append(id_)
+                else:
+                    results[id_] = Ok(calc)
+        if missing:
+            for id_, result in self.cold.get_many(missing).items():
+                results[id_] = Ok(self.__promote(result.unwrap())) \
+                    if result.is_ok else result
+        return results
+
+    def update_many(self, calcs: Iterable[Calculator]) -> Dict[str, Result[Calculator, str]]:
+        """Update calculators by their ids."""
+        calcs = list(calcs)
+        found = self.get_many(calc.id_ for calc in calcs)
+        results: Dict[str, Result[Calculator, str]] = dict()
+        with self.__lock:
+            for calc in calcs:
+                if found[calc.id_].is_err:
+                    results[calc.id_] = found[calc.id_]
+                    continue
+                self.__store(calc)
+                results[calc.id_] = Ok(calc)
+        return results
+
+    def demote_idle(self, idle: Optional[float] = None) -> int:
+        """Writes calculators idle for more than idle seconds, the idle time
+        of the repository if not given, to the cold repository and drops
+        them from memory. Returns the number of calculators demoted."""
+        with self.__demoting:
+            return self.__demote_idle(idle)
+
+    @property
+    def shared(self) -> bool:
+        """Whether the cold repository is shared."""
+        return self.cold.shared
+
+    def count_calculators(self) -> Optional[int]:
+        """Number of calculators resident in memory."""
+        return len(self.__hot)
+
+    def stats(self) -> Dict[str, int]:
+        """Resident calculators, demotions and promotions."""
+        return {
+            'entries': len(self.__hot),
+            'demotions': self.demotions,
+            'promotions': self.promotions,
+        }
+
+    def close(self) -> None:
+        """Demotes every calculator and closes the cold repository."""
+        self.__closed.set()
+        self.__demoter.join()
+        self.demote_idle(float('-inf'))
+        self.cold.close()
+
+    def __demote_idle(self, idle: Optional[float]) -> int:
+        deadline = monotonic() - (self.idle if idle is None else idle)
+        with self.__lock:
+            demoted: List[Tuple[Calculator, float]] = []
+            for calc, used in self.__hot.values():
+                if used > deadline:
+                    break
+                demoted.append((calc, used))
+        if not demoted:
+            return 0
+        # Storage is written out of the lock, so calculators in use are not
+        # blocked by the cold repository
+        results = self.cold.update_many(calc for calc, _ in demoted)
+        written: List[Tuple[Calculator, float]] = []
+        for calc, used in demoted:
+            result = results[calc.id_]
+            if result.is_err and result.unwrap_err() == 'not_found':
+                # Created since last demotion
+                result = self.cold.create_calculator(calc.id_)
+                if result.is_ok:
+                    result = self.cold.update_calculator(calc.id_, calc)
+            if result.is_err:
+                logging.error('failed demoting calculator %s: %s',
+                              calc.id_, result.unwrap_err())
+                continue
+            written.append((calc, used))
+        count = 0
+        with self.__lock:
+            for calc, used in written:
+                # Calculators used while being written stay in memory, and
+                # are written again once idle
+                entry = self.__hot.get(calc.id_)
+                if entry is not None and entry[0] is calc and entry[1] == used:
+                    del self.__hot[calc.id_]
+                    count += 1
+            self.demotions += count
+        return count
+
+    def __find(self, id_: str) -> Result[Calculator, str]:
+        with self.__lock:
+            calc = self.__touch(id_)
+        if calc is not None:
+            return Ok(calc)
+        # Failures of the cold repository are not taken as not found, so
+        # calculators are not recreated over the stored ones
+        result = self.cold.get_calculator(id_)
+        if result.is_err:
+            return result
+        return Ok(self.__promote(result.unwrap()))
+
+    def __touch(self, id_: str) -> Optional[Calculator]:
+        entry = self.__hot.get(id_)
+        if entry is None:
+            return None
+        self.__hot[id_] = (entry[0], monotonic())
+        self.__hot.move_to_end(id_)
+        return entry[0]
+
+    def __promote(self, calc: Calculator) -> Calculator:
+        with self.__lock:
+            # Promoted or updated meanwhile by another thread
+            found = self.__touch(calc.id_)
+            if found is not None:
+                return found
+            self.__store(calc)
+            self.promotions += 1
+        return calc
+
+    def __store(self, calc: Calculator) -> None:
+        self.__hot[calc.id_] = (calc, monotonic())
+        self.__hot.move_to_end(calc.id_)
+
+    def __run_demoter(self) -> None:
+        while not self.__closed.wait(self.interval):
+            try:
+                count = self.demote_idle()
+            except Exception:
+                logging.exception('failed demoting idle calculators')
+                continue
+            if count:
+                logging.info('Demoted calculators: %s', self.stats())
@@ -1,3 +1,4 @@
 """Module of application services"""
 
 from .calculator import *
+from .cache import *
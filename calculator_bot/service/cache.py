@@ -0,0 +1,57 @@
+"""Module for bounded caches used by services."""
+import re
+from collections import OrderedDict
+from threading import Lock
+from typing import Generic, Hashable, TypeVar
+
+from option import NONE, Option, Some
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+LEADING_ZEROS = re.compile(r'(?<![0-9.])0+(?=[0-9])')
+WHITESPACE = re.compile(r'\s+')
+
+
+class LRUCache(Generic[K, V]):
+    """Bounded mapping with least recently used eviction and hit/miss counters."""
+
+    def __init__(self, maxsize: int) -> None:
+        if maxsize <= 0:
+            raise ValueError('cache size must be positive')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__lock = Lock()
+        self.__entries: 'OrderedDict[K, V]' = OrderedDict()
+
+    def get(self, key: K) -> Option[V]:
+        """Find cached value by key, marking it as recently used."""
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return NONE
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return Some(self.__entries[key])
+
+    def put(self, key: K, value: V) -> None:
+        """Store value by key, evicting the least recently used if full."""
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+def normalize_expression(expr: str) -> str:
+    """Normalizes expression so equivalent keypresses share a cache entry."""
+    return LEADING_ZEROS.sub('', expr)
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes inline query so equivalent expressions share a cache entry."""
+    return normalize_expression(WHITESPACE.sub('', query))
@@ -1,21 +1,37 @@
 """Module for calculator service."""
+import logging
 import re
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from option import Result
-from option.result import Err
-from py_expression_eval import Parser
+from option.result import Err, Ok
 
+from calculator_bot.metrics import Metrics
 from calculator_bot.model.calculator import Calculator
+from calculator_bot.model.expression import ExpressionState, Number
 from calculator_bot.repository import CalculatorRepository
 
-VALID_EXPRESSION = re.compile('[0-9./=+-c*]')
+from .cache import LRUCache, normalize_expression, normalize_query
+
+VALID_EXPRESSION = re.compile('[0-9./=+-c*u]')
+VALID_QUERY = re.compile(r'[0-9.eE+\-*/()]+')
 
 
 class CalculatorService:
     """Service class for definitions. Implements calculator operations."""
 
-    def __init__(self, repo: CalculatorRepository) -> None:
+    def __init__(self, repo: CalculatorRepository,
+                 cache: Optional[LRUCache[str, Optional[Number]]] = None,
+                 metrics: Optional[Metrics] = None,
+                 history_depth: int = 32) -> None:
         self.repo = repo
+        self.cache = cache
+        self.metrics = metrics
+        self.history_depth = history_depth
+        if metrics is not None and cache is not None:
+            metrics.gauge('expression_cache_hits', lambda: cache.hits)
+            metrics.gauge('expression_cache_misses', lambda: cache.misses)
 
     def get_or_create_calculator(self, id_: str) -> Result[Calculator, str]:
         """Creates a new calculator."""
@@ -32,20 +48,97 @@ class CalculatorService:
         if calc is None or \
                 VALID_EXPRESSION.fullmatch(expr) is None:
             return Err('bad_request')
-        if expr == '=':
-            calc = self.__calculate_calculator_value(calc)
-        elif expr == 'c':
-            calc = calc.set_value(0).set_expr('')
-        elif not expr.isnumeric() and len(calc.expr) == 0:
-            calc = calc.set_expr(str(calc.value)+expr)
-        else:
-            calc = calc.set_expr(calc.expr + expr)
+        calc = self.__apply_expression(calc, expr)
         return self.repo.update_calculator(calc.id_, calc)
 
+    def get_recent_results(self, id_: str) -> Result[List[float], str]:
+        """Latest results of the calculator identified by id, from the oldest."""
+        result = self.repo.get_calculator(id_)
+        if result.is_err:
+            return Err(result.unwrap_err())
+        log = result.unwrap().log
+        return Ok(log.recent_results() if log is not None else [])
+
+    def evaluate_query(self, query: str) -> Result[Number, str]:
+        """Evaluates a whole expression typed in an inline query."""
+        expr = normalize_query(query)
+        if VALID_QUERY.fullmatch(expr) is None:
+            return Err('bad_request')
+        value = self.__evaluate_cached(
+            expr, lambda: ExpressionState.parse(expr).result())
+        if value is None:
+            return Err('bad_request')
+        return Ok(value)
+
+    def evaluate_batch(self, keypresses: Iterable[Tuple[str, str]])\
+            -> Dict[str, Result[Calculator, str]]:
+        """Evaluates expressions of many calculators identified by id.
+
+        Expressions of every calculator are folded in order, reading and
+        writing each calculator once. Invalid expressions are skipped.
+        """
+        grouped: Dict[str, List[str]] = dict()
+        for id_, expr in keypresses:
+            grouped.setdefault(id_, []).append(expr)
+        results: Dict[str, Result[Calculator, str]] = dict()
+        calcs: List[Calculator] = []
+        for id_, result in self.repo.get_or_create_many(grouped).items():
+            if result.is_err:
+                results[id_] = result
+                continue
+            calc = result.unwrap()
+            for expr in grouped[id_]:
+                if VALID_EXPRESSION.fullmatch(expr) is None:
+                    logging.debug('skipping bad expression: %s', expr)
+                    continue
+                calc = self.__apply_expression(calc, expr)
+            calcs.append(calc)
+        results.update(self.repo.update_many(calcs))
+        return results
+
+    def __apply_expression(self, calc: Calculator, expr: str) -> Calculator:
+        if expr == 'u':
+            return calc.undo()
+        applied = self.__apply_key(calc, expr)
+        if self.history_depth <= 0 or applied is calc:
+            return applied
+        applied.record(calc, self.history_depth)
+        if expr == '=':
+            applied.log.add_result(applied.value)  # type: ignore
+        return applied
+
+    def __apply_key(self, calc: Calculator, expr: str) -> Calculator:
+        if expr == '=':
+            return self.__calculate_calculator_value(calc)
+        if expr == 'c':
+            return calc.set_value(0).set_expr('')
+        if not expr.isnumeric() and len(calc.expr) == 0:
+            return calc.set_expr(str(calc.value)).push(expr)
+        return calc.push(expr)
+
     def __calculate_calculator_value(self, calc: Calculator) -> Calculator:
-        parser = Parser()
-        try:
-            value = parser.parse(calc.expr).evaluate({})
-            return calc.set_value(value).set_expr('')
-        except Exception:
+        value = self.__evaluate_cached(calc.expr, calc.evaluate)
+        if value is None:
             return calc
+        return calc.set_value(value).set_expr('')
+
+    def __evaluate_cached(self, expr: str,
+                          evaluate: Callable[[], Optional[Number]]) -> Optional[Number]:
+        if self.cache is None:
+            return self.__evaluate(evaluate)
+        key = normalize_expression(expr)
+        cached = self.cache.get(key)
+        if cached.is_some:
+            return cached.unwrap()
+        # Failed evaluations are cached as None as well
+        value = self.__evaluate(evaluate)
+        self.cache.put(key, value)
+        return value
+
+    def __evaluate(self, evaluate: Callable[[], Optional[Number]]) -> Optional[Number]:
+        if self.metrics is None:
+            return evaluate()
+        start = perf_counter()
+        value = evaluate()
+        self.metrics.observe('evaluation_seconds', perf_counter() - start)
+        return value
@@ -0,0 +1,63 @@
+"""Module of the report of the time taken by startup."""
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Optional
+
+from calculator_bot.metrics import Metrics
+
+# Imported before anything else, as the package does not import its modules
+STARTED = perf_counter()
+
+IMPORT = 'import'
+READY = 'ready'
+HANDSHAKE = 'handshake'
+FIRST_UPDATE = 'first_update'
+
+
+class StartupReport:
+    """Seconds taken by every phase of startup.
+
+    Importing the controller, being ready to receive updates and handling
+    the first update are timed since the process started, while the getMe
+    handshake is timed on its own, as it may run in the background.
+    """
+
+    def __init__(self, started: Optional[float] = None) -> None:
+        self.started = STARTED if started is None else started
+        self.__lock = Lock()
+        self.__phases: Dict[str, float] = dict()
+        self.__metrics: Optional[Metrics] = None
+
+    def mark(self, phase: str) -> bool:
+        """Records the seconds since startup of phase, returning False if
+        already recorded."""
+        return self.record(phase, perf_counter() - self.started)
+
+    def record(self, phase: str, seconds: float) -> bool:
+        """Records the seconds taken by phase, returning False if already
+        recorded."""
+        with self.__lock:
+            if phase in self.__phases:
+                return False
+            self.__phases[phase] = seconds
+            metrics = self.__metrics
+        if metrics is not None:
+            metrics.gauge('startup_seconds', lambda: seconds, phase=phase)
+        return True
+
+    def phases(self) -> Dict[str, float]:
+        """Seconds taken by every phase recorded."""
+        with self.__lock:
+            return dict(self.__phases)
+
+    def gauge(self, metrics: Metrics) -> None:
+        """Gauges the phases recorded, and the ones recorded later."""
+        with self.__lock:
+            self.__metrics = metrics
+            phases = dict(self.__phases)
+        for phase, seconds in phases.items():
+            metrics.gauge('startup_seconds', lambda seconds=seconds: seconds,
+                          phase=phase)
+
+    def __str__(self) -> str:
+        return ', '.join('%s %.3fs' % item for item in self.phases().items())
@@ -1,9 +1,56 @@
 import unittest
 
-from .test_calculator_bot import TestCalculatorRepository, TestCalculatorService
+from .test_calculator_bot import (TestBackgroundLogging, TestBenchmark,
+                                  TestBoundedMemoryCalculatorRepository,
+                                  TestCalculatorRepository,
+                                  TestCalculatorService, TestCodec,
+                                  TestExpressionState,
+                                  TestEditCoalescer, TestFakeBotApi,
+                                  TestInstrumentedCalculatorRepository,
+                                  TestKeyedExecutor,
+                                  TestLRUCache, TestMetrics,
+                                  TestOperationLog,
+                                  TestOutboundScheduler, TestPooledRequest,
+                                  TestRecentIds,
+                                  TestRender, TestRespCalculatorRepository,
+                                  TestSampledFilter,
+                                  TestShardPool,
+                                  TestSlowUpdateProfiler,
+                                  TestSnapshotCalculatorRepository,
+                                  TestSqliteCalculatorRepository,
+                                  TestStartupReport,
+                                  TestTelegramCalculatorController,
+                                  TestTieredCalculatorRepository,
+                                  TestWebhookServer)
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestCalculatorRepository)
+    suite.addTest(TestCodec)
+    suite.addTest(TestSqliteCalculatorRepository)
+    suite.addTest(TestSnapshotCalculatorRepository)
+    suite.addTest(TestRespCalculatorRepository)
+    suite.addTest(TestInstrumentedCalculatorRepository)
+    suite.addTest(TestBoundedMemoryCalculatorRepository)
+    suite.addTest(TestTieredCalculatorRepository)
     suite.addTest(TestCalculatorService)
+    suite.addTest(TestExpressionState)
+    suite.addTest(TestLRUCache)
+    suite.addTest(TestOperationLog)
+    suite.addTest(TestKeyedExecutor)
+    suite.addTest(TestRecentIds)
+    suite.addTest(TestEditCoalescer)
+    suite.addTest(TestRender)
+    suite.addTest(TestOutboundScheduler)
+    suite.addTest(TestWebhookServer)
+    suite.addTest(TestTelegramCalculatorController)
+    suite.addTest(TestBenchmark)
+    suite.addTest(TestFakeBotApi)
+    suite.addTest(TestPooledRequest)
+    suite.addTest(TestStartupReport)
+    suite.addTest(TestSampledFilter)
+    suite.addTest(TestBackgroundLogging)
+    suite.addTest(TestMetrics)
+    suite.addTest(TestSlowUpdateProfiler)
+    suite.addTest(TestShardPool)
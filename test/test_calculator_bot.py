@@ -1,15 +1,70 @@
 from typing import Union
 from calculator_bot.repository.calculator import CalculatorRepository
 from math import exp
+import asyncio
+import multiprocessing
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock, MagicMock
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from logging.handlers import BufferingHandler
+from queue import Queue
+from threading import Event, Thread
+from unittest.mock import MagicMock, Mock, call
 
 from option import Err, Ok
+from telegram import Bot, Update
+from telegram.error import RetryAfter
+from telegram.ext import DispatcherHandlerStop
 from option.result import Result
 
-from calculator_bot.model import Calculator
-from calculator_bot.repository import MemoryCalculatorRepository
-from calculator_bot.service import CalculatorService
+from benchmark import REPOSITORIES, replay
+from benchmark.__main__ import regressions
+from benchmark.fake_api import FakeBotApi
+from benchmark.fake_resp import FakeRespServer
+from benchmark.loadtest import callback_query
+from calculator_bot.controller import (TelegramCalculatorController,
+                                       WebhookServer)
+from calculator_bot.controller.coalescer import EditCoalescer
+from calculator_bot.controller.dedup import RecentIds
+from calculator_bot.controller.executor import KeyedExecutor
+from calculator_bot.controller.shard import (ANSWERED_INLINE,
+                                             ShardedController, ShardPool,
+                                             shard_key)
+from calculator_bot.controller.profiler import SlowUpdateProfiler
+from calculator_bot.controller.ratelimit import (ANSWER_PRIORITY,
+                                                 EDIT_PRIORITY,
+                                                 OutboundScheduler,
+                                                 TokenBucket)
+from calculator_bot.controller.render import (CALCULATOR_ARTICLE,
+                                              CALCULATOR_KEYBOARD,
+                                              RenderCache, render_calculator,
+                                              render_result_article)
+from calculator_bot.controller.request import PooledRequest
+from calculator_bot.controller.webhook import MAX_BODY_SIZE
+from calculator_bot.logs import BackgroundLogging, SampledFilter
+from calculator_bot.metrics import Metrics
+from calculator_bot.model import (MAX_EXPRESSION_LENGTH, Calculator,
+                                  ExpressionState, OperationLog, RingBuffer)
+from calculator_bot.repository import (BoundedMemoryCalculatorRepository,
+                                       InstrumentedCalculatorRepository,
+                                       MemoryCalculatorRepository,
+                                       RespCalculatorRepository, RespClient,
+                                       RespError, Snapshot,
+                                       SnapshotCalculatorRepository,
+                                       SqliteCalculatorRepository,
+                                       TieredCalculatorRepository,
+                                       decode_value, encode_value)
+from calculator_bot.service import (CalculatorService, LRUCache,
+                                    normalize_expression)
+from calculator_bot.startup import (FIRST_UPDATE, HANDSHAKE, IMPORT, READY,
+                                    StartupReport)
 
 
 class TestCalculatorRepository(unittest.TestCase):
@@ -46,6 +101,14 @@ class TestCalculatorRepository(unittest.TestCase):
         self.assertTrue(result.is_ok)
         self.assertEqual(expected, result.unwrap())
 
+    def test_get_or_create_many(self):
+        self.repository.create_calculator('a')
+        self.repository.update_calculator('a', Calculator('a', 1, '2+'))
+        results = self.repository.get_or_create_many(['a', 'b'])
+        self.assertEqual(Calculator('a', 1, '2+'), results['a'].unwrap())
+        self.assertEqual(Calculator('b', 0, ''), results['b'].unwrap())
+        self.assertTrue(self.repository.get_calculator('b').is_ok)
+
     def test_error_update_calculator_when_calculator_not_found(self):
         result = self.repository.update_calculator(
             'unknown', Calculator('', 0, '')
@@ -61,6 +124,339 @@ class TestCalculatorRepository(unittest.TestCase):
         self.assertEqual(expected, result.unwrap())
 
 
+class TestCodec(unittest.TestCase):
+
+    def test_values_round_trip(self):
+        for value in (0, -12, 2**70, 0.1, -2.5e-300, float('inf')):
+            encoded = encode_value(value)
+            self.assertEqual(value, decode_value(encoded), encoded)
+            self.assertIs(type(value), type(decode_value(encoded)))
+
+
+class TestSqliteCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'calculators.db')
+        self.repository = SqliteCalculatorRepository(self.path, 60)
+
+    def tearDown(self) -> None:
+        self.repository.close()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def reopen(self) -> None:
+        self.repository.close()
+        self.repository = SqliteCalculatorRepository(self.path, 60)
+
+    def test_get_calculator_after_reopen(self):
+        self.repository.create_calculator('id')
+        expected = Calculator('id', 12.5, '1+')
+        self.repository.update_calculator('id', expected)
+        self.reopen()
+        result = self.repository.get_calculator('id')
+        self.assertTrue(result.is_ok)
+        self.assertEqual(expected, result.unwrap())
+
+    def test_create_calculator_conflict_after_reopen(self):
+        self.repository.create_calculator('id')
+        self.reopen()
+        result = self.repository.create_calculator('id')
+        result.expect_err('conflict')
+
+    def test_get_many_and_update_many(self):
+        self.repository.create_calculator('a')
+        self.repository.flush()
+        self.reopen()
+        results = self.repository.get_many(['a', 'b'])
+        self.assertEqual(Calculator('a', 0, ''), results['a'].unwrap())
+        results['b'].expect_err('not_found')
+        results = self.repository.update_many(
+            [Calculator('a', 1, ''), Calculator('b', 2, '')])
+        self.assertEqual(Calculator('a', 1, ''), results['a'].unwrap())
+        results['b'].expect_err('not_found')
+
+    def test_flush_keeps_large_values(self):
+        self.repository.create_calculator('id')
+        expected = Calculator('id', 10 ** 30, '')
+        self.repository.update_calculator('id', expected)
+        self.repository.flush()
+        self.reopen()
+        self.assertEqual(expected, self.repository.get_calculator('id').unwrap())
+
+
+class TestSnapshotCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'calculators.snapshot')
+        self.repository = SnapshotCalculatorRepository(self.path, 60)
+
+    def tearDown(self) -> None:
+        self.repository.close()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def reopen(self) -> None:
+        self.repository.close()
+        self.repository = SnapshotCalculatorRepository(self.path, 60)
+
+    def test_get_calculator_after_reopen(self):
+        self.repository.create_calculator('id')
+        expected = Calculator('id', 12.5, '1+')
+        self.repository.update_calculator('id', expected)
+        self.reopen()
+        self.assertEqual(expected, self.repository.get_calculator('id').unwrap())
+        self.repository.create_calculator('id').expect_err('conflict')
+
+    def test_save_merges_previous_snapshot(self):
+        for id_ in ('b', 'a', 'c'):
+            self.repository.create_calculator(id_)
+        self.reopen()
+        self.repository.update_calculator('b', Calculator('b', 2**70, '3'))
+        self.repository.create_calculator('aa')
+        self.reopen()
+        self.assertEqual(4, self.repository.count_calculators())
+        self.assertEqual(Calculator('b', 2**70, '3'),
+                         self.repository.get_calculator('b').unwrap())
+        self.assertEqual([b'a', b'aa', b'b', b'c'],
+                         [id_ for id_, _, _ in self.repository.snapshot.records()])
+
+    def test_save_drops_saved_calculators_unless_kept(self):
+        self.repository.create_calculator('a')
+        self.repository.save()
+        self.assertEqual(1, self.repository.count_calculators())
+        self.repository.close()
+        self.repository = SnapshotCalculatorRepository(self.path, 60, False)
+        expected = Calculator('a', 3, '1+')
+        self.repository.update_calculator('a', expected)
+        self.assertIs(expected, self.repository.get_calculator('a').unwrap())
+        self.repository.save()
+        found = self.repository.get_calculator('a').unwrap()
+        self.assertEqual(expected, found)
+        self.assertIsNot(expected, found)
+        self.assertEqual(1, self.repository.count_calculators())
+
+    def test_snapshot_is_decoded_on_access(self):
+        self.repository.create_calculator('a')
+        self.repository.save()
+        snapshot = Snapshot(self.path)
+        self.assertEqual(1, len(snapshot))
+        self.assertEqual(Calculator('a', 0, ''), snapshot.get('a'))
+        self.assertIsNone(snapshot.get('b'))
+        snapshot.close()
+
+    def test_invalid_snapshot(self):
+        with open(self.path + '.bad', 'wb') as file:
+            file.write(b'not a snapshot' * 4)
+        with self.assertRaises(ValueError):
+            Snapshot(self.path + '.bad')
+
+
+class TestRespCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        self.server = FakeRespServer()
+        self.server.start()
+        self.client = RespClient(*self.server.address)
+        self.repository = RespCalculatorRepository(self.client)
+
+    def tearDown(self) -> None:
+        self.repository.close()
+        self.server.stop()
+        super().tearDown()
+
+    def test_calculators_are_shared_by_clients(self):
+        other = RespCalculatorRepository(RespClient(*self.server.address))
+        self.repository.create_calculator('a')
+        other.create_calculator('a').expect_err('conflict')
+        other.update_calculator('a', Calculator('a', 2**70, '1+'))
+        self.assertEqual(Calculator('a', 2**70, '1+'),
+                         self.repository.get_calculator('a').unwrap())
+        other.close()
+
+    def test_batches_are_pipelined(self):
+        self.repository.create_calculator('a')
+        round_trips = self.client.round_trips
+        results = self.repository.get_or_create_many(['a', 'b', 'c'])
+        self.repository.update_many(
+            [result.unwrap().set_expr('1') for result in results.values()])
+        self.assertEqual(round_trips + 2, self.client.round_trips)
+        self.assertEqual('1', self.repository.get_calculator('c').unwrap().expr)
+
+    def test_calculators_expire_without_updates(self):
+        self.repository.expiry = 60
+        self.repository.create_calculator('a')
+        self.assertEqual(60, self.client.execute('TTL', 'calculator:a'))
+        self.client.execute('SET', 'calculator:a', '0 1', 'PX', 1)
+        time.sleep(0.01)
+        self.repository.get_calculator('a').expect_err('not_found')
+
+    def test_errors_are_returned_once_server_stops(self):
+        self.repository.create_calculator('a')
+        self.server.stop()
+        calc = Calculator('a', 1, '')
+        results = [self.repository.get_calculator('a'),
+                   self.repository.create_calculator('b'),
+                   self.repository.update_calculator('a', calc),
+                   *self.repository.get_or_create_many(['a']).values(),
+                   *self.repository.get_many(['a']).values(),
+                   *self.repository.update_many([calc]).values(),
+                   TieredCalculatorRepository(self.repository).create_calculator('a')]
+        for result in results:
+            result.expect_err('unavailable')
+        # Broken connections are not reused
+        self.server = FakeRespServer()
+        self.server.start()
+        self.client.host, self.client.port = self.server.address
+        self.assertTrue(self.repository.create_calculator('a').is_ok)
+
+    def test_error_reply_is_raised(self):
+        with self.assertRaises(RespError):
+            self.client.pipeline([['SET', 'a'], ['PING']])
+        self.assertEqual('PONG', self.client.execute('PING'))
+
+    def test_shared_by_wrappers(self):
+        self.assertTrue(self.repository.shared)
+        self.assertTrue(TieredCalculatorRepository(self.repository).shared)
+        self.assertTrue(BoundedMemoryCalculatorRepository(
+            lower=self.repository).shared)
+        self.assertTrue(InstrumentedCalculatorRepository(
+            self.repository, Metrics()).shared)
+        self.assertFalse(BoundedMemoryCalculatorRepository().shared)
+        self.assertFalse(MemoryCalculatorRepository().shared)
+
+
+class TestInstrumentedCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.metrics = Metrics()
+        self.repository = InstrumentedCalculatorRepository(
+            MemoryCalculatorRepository(), self.metrics)
+
+    def test_operations_are_timed(self):
+        self.repository.create_calculator('a')
+        self.repository.get_many(['a', 'b'])
+        self.assertEqual(1, self.metrics.histogram(
+            'repository_seconds', operation='create').count)
+        self.assertEqual(1, self.metrics.histogram(
+            'repository_seconds', operation='get_many').count)
+        self.assertEqual(1, self.metrics.value('calculators'))
+
+
+class TestBoundedMemoryCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.repository = BoundedMemoryCalculatorRepository(2, 60)
+
+    def test_create_calculator_evicts_least_recently_used(self):
+        self.repository.create_calculator('a')
+        self.repository.create_calculator('b')
+        self.repository.get_calculator('a')
+        self.repository.create_calculator('c')
+        self.assertTrue(self.repository.get_calculator('a').is_ok)
+        self.repository.get_calculator('b').expect_err('not_found')
+        self.assertEqual(1, self.repository.evictions)
+        self.assertEqual(2, self.repository.stats()['entries'])
+
+    def test_evict_idle_calculators(self):
+        self.repository.ttl = 0
+        self.repository.create_calculator('a')
+        self.repository.evict_idle()
+        self.repository.get_calculator('a').expect_err('not_found')
+
+    def test_get_calculator_rehydrated_from_lower_repository(self):
+        lower = MemoryCalculatorRepository()
+        self.repository = BoundedMemoryCalculatorRepository(1, 60, lower)
+        self.repository.create_calculator('a')
+        expected = Calculator('a', 3, '1+')
+        self.repository.update_calculator('a', expected)
+        self.repository.create_calculator('b')
+        self.assertEqual(expected, lower.get_calculator('a').unwrap())
+        self.assertEqual(expected, self.repository.get_calculator('a').unwrap())
+        self.assertEqual(1, self.repository.rehydrations)
+        self.repository.create_calculator('a').expect_err('conflict')
+
+    def test_stats_reports_resident_set_size(self):
+        self.assertGreater(self.repository.stats()['rss_bytes'], 0)
+
+
+class TestTieredCalculatorRepository(TestCalculatorRepository):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.cold = MemoryCalculatorRepository()
+        self.repository = TieredCalculatorRepository(self.cold, 60, 60)
+
+    def tearDown(self) -> None:
+        self.repository.close()
+        super().tearDown()
+
+    def test_demote_idle_calculators(self):
+        self.repository.create_calculator('a')
+        expected = Calculator('a', 3, '1+')
+        self.repository.update_calculator('a', expected)
+        self.repository.create_calculator('b')
+        self.assertEqual(0, self.repository.demote_idle())
+        self.assertEqual(2, self.repository.demote_idle(0))
+        self.assertEqual(0, self.repository.count_calculators())
+        self.assertEqual(expected, self.cold.get_calculator('a').unwrap())
+
+    def test_get_calculator_promoted_from_cold_repository(self):
+        self.repository.create_calculator('a')
+        self.repository.demote_idle(0)
+        expected = Calculator('a', 3, '1+')
+        self.repository.update_calculator('a', expected)
+        self.assertEqual(1, self.repository.count_calculators())
+        self.assertEqual(expected, self.repository.get_calculator('a').unwrap())
+        self.assertEqual(Calculator('a', 0, ''), self.cold.get_calculator('a').unwrap())
+        self.repository.create_calculator('a').expect_err('conflict')
+        self.assertEqual({'entries': 1, 'demotions': 1, 'promotions': 1},
+                         self.repository.stats())
+
+    def test_get_many_promotes_cold_calculators(self):
+        self.repository.create_calculator('a')
+        self.repository.demote_idle(0)
+        self.repository.create_calculator('b')
+        results = self.repository.get_many(['a', 'b', 'c'])
+        self.assertTrue(results['a'].is_ok and results['b'].is_ok)
+        results['c'].expect_err('not_found')
+        self.assertEqual(2, self.repository.count_calculators())
+
+    def test_demotions_do_not_write_stale_copies(self):
+        writing, release = Event(), Event()
+        update_many = self.cold.update_many
+
+        def slow_update_many(calcs):
+            calcs = list(calcs)
+            if not writing.is_set():
+                writing.set()
+                release.wait(5)
+            return update_many(calcs)
+        self.cold.update_many = slow_update_many
+        self.repository.create_calculator('a')
+        first = Thread(target=self.repository.demote_idle, args=(0,))
+        first.start()
+        writing.wait(5)
+        expected = Calculator('a', 3, '1+')
+        self.repository.update_calculator('a', expected)
+        second = Thread(target=self.repository.demote_idle, args=(float('-inf'),))
+        second.start()
+        time.sleep(0.05)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(expected, self.cold.get_calculator('a').unwrap())
+        self.assertEqual(0, self.repository.count_calculators())
+
+    def test_close_demotes_every_calculator(self):
+        self.repository.create_calculator('a')
+        self.repository.close()
+        self.assertTrue(self.cold.get_calculator('a').is_ok)
+
+
 class TestCalculatorService(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -252,6 +648,1187 @@ class TestCalculatorService(unittest.TestCase):
         self.assertEqual(expected.set_value(
             20.1).set_expr(''), result.unwrap())
 
+    def test_evaluate_calculator_expression_when_equals_honours_precedence(self):
+        expected = Calculator('', 0, '')
+        self.mockedRepo.update_calculator.side_effect = lambda _, c: Ok(c)
+        calc = expected
+        for key in '1-2*3-4/2=':
+            calc = self.service.evaluate_calculator_expression(calc, key).unwrap()
+        self.assertEqual(expected.set_value(-7.0), calc)
+
+    def test_evaluate_calculator_expression_when_equals_and_division_by_zero(self):
+        expected = Calculator('', 20, '1/0')
+        self.mockedRepo.update_calculator.side_effect = lambda _, c: Ok(c)
+        result = self.service.evaluate_calculator_expression(expected, '=')
+        self.assertTrue(result.is_ok)
+        self.assertEqual(expected, result.unwrap())
+
+    def evaluate_keys(self, service, keys):
+        return service.evaluate_batch([('a', key) for key in keys])['a'].unwrap()
+
+    def test_evaluate_unary_plus(self):
+        for keys, expected in (('5*+3=', 15), ('+5=', 5), ('574/+2=', 287)):
+            service = CalculatorService(MemoryCalculatorRepository())
+            self.assertEqual(Calculator('a', expected, ''),
+                             self.evaluate_keys(service, keys), keys)
+
+    def test_evaluate_undo(self):
+        service = CalculatorService(MemoryCalculatorRepository())
+        self.assertEqual(Calculator('a', 0, '1+'),
+                         self.evaluate_keys(service, '1+2u'))
+        self.assertEqual(Calculator('a', 0, '1+2'),
+                         self.evaluate_keys(service, '2=u'))
+        self.assertEqual(Calculator('a', 0, ''),
+                         self.evaluate_keys(service, 'uuuu'))
+
+    def test_evaluate_undo_past_history_depth(self):
+        service = CalculatorService(MemoryCalculatorRepository(), history_depth=2)
+        self.assertEqual(Calculator('a', 0, '12'),
+                         self.evaluate_keys(service, '1234uuuu'))
+        self.assertEqual(0, len(service.repo.get_calculator('a').unwrap().log.undos))
+
+    def test_get_recent_results(self):
+        service = CalculatorService(MemoryCalculatorRepository(), history_depth=2)
+        self.evaluate_keys(service, '1+1=*3=+=-1=')
+        self.assertEqual([6, 5], service.get_recent_results('a').unwrap())
+        self.assertEqual('not_found',
+                         service.get_recent_results('b').unwrap_err())
+
+    def test_evaluate_query(self):
+        self.assertEqual(84, self.service.evaluate_query(' 12 * (3+4)').unwrap())
+        for query in ('', '12*(3+', 'abc', '1/0'):
+            self.assertEqual('bad_request',
+                             self.service.evaluate_query(query).unwrap_err(), query)
+
+    def test_evaluate_query_uses_cache(self):
+        cache = LRUCache(8)
+        service = CalculatorService(self.mockedRepo, cache)
+        service.evaluate_query('2*(1+1)')
+        self.assertEqual(4, service.evaluate_query('2 * (01+1)').unwrap())
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evaluate_calculator_expression_when_equals_uses_cache(self):
+        cache = LRUCache(8)
+        service = CalculatorService(self.mockedRepo, cache)
+        self.mockedRepo.update_calculator.side_effect = lambda _, c: Ok(c)
+        for expr in ('12*3', '012*3'):
+            result = service.evaluate_calculator_expression(
+                Calculator('', 0, expr), '=')
+            self.assertEqual(36, result.unwrap().value)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evaluate_calculator_expression_when_equals_caches_failures(self):
+        cache = LRUCache(8)
+        service = CalculatorService(self.mockedRepo, cache)
+        self.mockedRepo.update_calculator.side_effect = lambda _, c: Ok(c)
+        expected = Calculator('', 20, '10-')
+        for _ in range(2):
+            result = service.evaluate_calculator_expression(expected, '=')
+            self.assertEqual(expected, result.unwrap())
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evaluate_batch_folds_expressions_by_calculator(self):
+        self.mockedRepo.get_or_create_many.return_value = {
+            'a': Ok(Calculator('a', 0, '')),
+            'b': Ok(Calculator('b', 0, '')),
+        }
+        self.mockedRepo.update_many.side_effect = \
+            lambda calcs: {c.id_: Ok(c) for c in calcs}
+        results = self.service.evaluate_batch([
+            ('a', '1'), ('b', '2'), ('a', '+'), ('a', '2'), ('b', ''),
+            ('a', '='),
+        ])
+        self.assertEqual(Calculator('a', 3, ''), results['a'].unwrap())
+        self.assertEqual(Calculator('b', 0, '2'), results['b'].unwrap())
+        self.mockedRepo.get_or_create_many.assert_called_once()
+        self.mockedRepo.update_many.assert_called_once()
+
+    def test_evaluate_batch_when_get_unknown_error(self):
+        self.mockedRepo.get_or_create_many.return_value = {'a': Err('unknown')}
+        self.mockedRepo.update_many.return_value = {}
+        results = self.service.evaluate_batch([('a', '1')])
+        results['a'].expect_err('unknown')
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_when_missing(self):
+        cache = LRUCache(2)
+        self.assertTrue(cache.get('a').is_none)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+    def test_put_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get('a').unwrap())
+        self.assertTrue(cache.get('b').is_none)
+        self.assertEqual(3, cache.get('c').unwrap())
+
+    def test_error_when_non_positive_size(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+    def test_normalize_expression(self):
+        self.assertEqual('12*3+0.5', normalize_expression('0012*03+0.5'))
+        self.assertEqual('100/4', normalize_expression('100/4'))
+
+
+class TestExpressionState(unittest.TestCase):
+
+    def test_result_of_empty_expression(self):
+        self.assertIsNone(ExpressionState().result())
+
+    def test_result_honours_precedence_and_associativity(self):
+        self.assertEqual(-7.0, ExpressionState.parse('1-2*3-4/2').result())
+        self.assertEqual(2.0, ExpressionState.parse('8/2/2').result())
+
+    def test_result_with_unary_minus(self):
+        self.assertEqual(8, ExpressionState.parse('5--3').result())
+        self.assertEqual(-10.0, ExpressionState.parse('-5.0*2').result())
+
+    def test_result_with_unary_plus(self):
+        self.assertEqual(15, ExpressionState.parse('5*+3').result())
+        self.assertEqual(5, ExpressionState.parse('+5').result())
+        self.assertEqual(929, ExpressionState.parse('1719*0++929').result())
+        self.assertEqual(2, ExpressionState.parse('-+2*-1').result())
+
+    def test_result_with_exponent_of_previous_value(self):
+        self.assertEqual(2e+20, ExpressionState.parse('1e+20*2').result())
+
+    def test_result_when_invalid_expression(self):
+        for expr in ('10-', '1+*2', '1..2', '1..2+3', '1/0+2', '10+a'):
+            self.assertIsNone(ExpressionState.parse(expr).result(), expr)
+
+    def test_push_keeps_stacks_bounded(self):
+        state = ExpressionState()
+        for key in '1+2*3-' * 1000:
+            state.push(key)
+            self.assertLessEqual(len(state.operands), 3)
+            self.assertLessEqual(len(state.operators), 2)
+        state.push('1')
+        self.assertEqual(eval('1+2*3-' * 1000 + '1'), state.result())
+
+    def test_result_with_parentheses(self):
+        self.assertEqual(84, ExpressionState.parse('12*(3+4)').result())
+        self.assertEqual(-10, ExpressionState.parse('-(2+3)*2').result())
+        self.assertEqual(16, ExpressionState.parse('(1+2)*(3+4)-5').result())
+        for expr in ('(1+2', '1+2)', '2(3)', '(3)4', '()', '1/(2-2)'):
+            self.assertIsNone(ExpressionState.parse(expr).result(), expr)
+
+    def test_result_does_not_consume_state(self):
+        state = ExpressionState.parse('2+3')
+        self.assertEqual(5, state.result())
+        state.push('*')
+        self.assertIsNone(state.result())
+        state.push('2')
+        self.assertEqual(8, state.result())
+
+
+class TestOperationLog(unittest.TestCase):
+
+    def test_ring_buffer_keeps_latest_items(self):
+        ring = RingBuffer('B', 3)
+        self.assertEqual([None, None, None, 1],
+                         [ring.append(item) for item in (1, 2, 3, 4)])
+        self.assertEqual([2, 3, 4], list(ring))
+        self.assertEqual(4, ring.pop())
+        copy = ring.copy()
+        copy.append(5)
+        self.assertEqual([2, 3], list(ring))
+        self.assertEqual([2, 3, 5], list(copy))
+
+    def test_undo_restores_expression_and_replaced_values(self):
+        log = OperationLog(3)
+        log.append(1)
+        log.append_restore(3, '1+2')
+        log.append(2)
+        self.assertEqual((3, ''), log.undo(3, '12'))
+        self.assertEqual((3, '1+2'), log.undo(3, ''))
+        self.assertEqual((3, '1+'), log.undo(3, '1+2'))
+        self.assertIsNone(log.undo(3, '1+'))
+
+    def test_append_drops_oldest_keys(self):
+        log = OperationLog(2)
+        log.append_restore(1, '1')
+        self.assertEqual([1, '1'], log.restores)
+        log.append(1)
+        log.append(1)
+        self.assertEqual((3, []), (log.size, log.restores))
+        self.assertEqual([1, 1], list(log.undos))
+
+    def test_fork_keeps_keys_up_to_size(self):
+        log = OperationLog(2)
+        log.append_restore(1, '1')
+        log.append(1)
+        fork = log.fork(1)
+        log.append(1)
+        fork.append(2)
+        self.assertEqual([1, 1], list(log.undos))
+        self.assertEqual((2, [255, 2]), (fork.size, list(fork.undos)))
+        self.assertEqual((0, ''), fork.undo(0, '12'))
+        self.assertEqual((1, '1'), fork.undo(0, ''))
+
+    def test_calculator_clones_share_log(self):
+        before = Calculator('a', 0, '1')
+        after = before.push('+')
+        after.record(before, 4)
+        again = after.push('2')
+        again.record(after, 4)
+        self.assertIs(after.log, again.log)
+        other = after.push('3')
+        other.record(after, 4)
+        self.assertIsNot(after.log, other.log)
+        self.assertEqual(Calculator('a', 0, '1+2'), again.undo().push('2'))
+        self.assertEqual(Calculator('a', 0, '1+'), other.undo())
+        self.assertEqual(Calculator('a', 0, '1'), other.undo().undo())
+        self.assertEqual(Calculator('a', 0, '1+2'), again.set_value(0).undo().push('2'))
+
+    def test_push_caps_expression(self):
+        calc = Calculator('a', 0, '1' * MAX_EXPRESSION_LENGTH)
+        self.assertIs(calc, calc.push('1'))
+
+    def test_results_are_bounded(self):
+        log = OperationLog(2)
+        for value in (1, 2.5, 10 ** 400):
+            log.add_result(value)
+        self.assertEqual([2.5, float('inf')], log.recent_results())
+
+
+class TestKeyedExecutor(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.executor = KeyedExecutor(4)
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_submit_runs_tasks_of_same_key_in_order(self):
+        results = {'a': [], 'b': []}
+
+        def task(key, i):
+            time.sleep(0.001)
+            results[key].append(i)
+        for i in range(20):
+            self.executor.submit('a', task, 'a', i)
+            self.executor.submit('b', task, 'b', i)
+        self.executor.shutdown()
+        self.assertEqual(list(range(20)), results['a'])
+        self.assertEqual(list(range(20)), results['b'])
+
+    def test_submit_runs_tasks_of_different_keys_in_parallel(self):
+        started = Event()
+        self.executor.submit('a', started.wait, 1)
+        self.executor.submit('b', started.set)
+        self.executor.shutdown()
+        self.assertTrue(started.is_set())
+
+    def test_shutdown_reclaims_idle_keys(self):
+        self.executor.submit('a', lambda: None)
+        self.executor.submit('b', lambda: 1 / 0)
+        self.executor.shutdown()
+        self.assertEqual(0, len(self.executor))
+        self.assertEqual(0, self.executor.pending('a'))
+
+
+class TestRecentIds(unittest.TestCase):
+
+    def test_add_drops_ids_in_window(self):
+        recent = RecentIds(2)
+        self.assertTrue(recent.add(1))
+        self.assertTrue(recent.add(2))
+        self.assertFalse(recent.add(1))
+        self.assertTrue(recent.add(3))
+        self.assertNotIn(1, recent)
+        self.assertTrue(recent.add(1))
+        self.assertEqual((2, 1), (len(recent), recent.duplicates))
+
+
+class TestEditCoalescer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.executor = KeyedExecutor(2)
+        self.sent = []
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_schedule_sends_latest_once_window_passes(self):
+        coalescer = EditCoalescer(self.executor, 0.05)
+        for text in ('1', '12', '123'):
+            coalescer.schedule('a', self.sent.append, text)
+        self.assertEqual([], self.sent)
+        time.sleep(0.2)
+        self.assertEqual(['123'], self.sent)
+        self.assertEqual((3, 1), (coalescer.scheduled, coalescer.sent))
+        coalescer.close()
+
+    def test_drain_sends_right_away_without_window(self):
+        coalescer = EditCoalescer(self.executor, 0)
+        coalescer.schedule('a', self.sent.append, '1')
+        coalescer.schedule('a', self.sent.append, '12')
+        coalescer.drain('a')
+        coalescer.drain('a')
+        self.assertEqual(['12'], self.sent)
+
+    def test_drain_sends_right_away_within_window(self):
+        coalescer = EditCoalescer(self.executor, 60)
+        coalescer.schedule('a', self.sent.append, '1')
+        coalescer.drain('a')
+        self.assertEqual(['1'], self.sent)
+        coalescer.close()
+        self.executor.shutdown()
+        self.assertEqual(['1'], self.sent)
+
+    def test_close_sends_pending(self):
+        coalescer = EditCoalescer(self.executor, 60)
+        coalescer.schedule('a', self.sent.append, '1')
+        coalescer.close()
+        self.executor.shutdown()
+        self.assertEqual(['1'], self.sent)
+
+
+class TestRender(unittest.TestCase):
+
+    def test_render_calculator(self):
+        text = render_calculator(Calculator('', 12.5, '3*'))
+        self.assertEqual('12.5'.ljust(50) + '\n> 3*', text)
+
+    def test_keyboard_is_serialized_once(self):
+        self.assertIs(CALCULATOR_KEYBOARD.to_dict(), CALCULATOR_KEYBOARD.to_dict())
+        self.assertEqual(json.dumps(CALCULATOR_KEYBOARD.to_dict()),
+                         CALCULATOR_KEYBOARD.to_json())
+
+    def test_render_result_article_id_is_deterministic(self):
+        article = render_result_article('2*3', 6)
+        self.assertEqual('2*3 = 6', article.title)
+        self.assertEqual(article.id, render_result_article('2*3', 6).id)
+        self.assertNotEqual(article.id, render_result_article('3*2', 6).id)
+        self.assertLessEqual(len(article.id), 64)
+
+    def test_render_cache(self):
+        renders = RenderCache(2)
+        self.assertFalse(renders.is_sent('a', 'text'))
+        renders.mark_sent('a', 'text')
+        self.assertTrue(renders.is_sent('a', 'text'))
+        self.assertFalse(renders.is_sent('a', 'other'))
+        self.assertEqual(1, renders.skipped)
+
+    def test_render_cache_disabled(self):
+        renders = RenderCache(0)
+        renders.mark_sent('a', 'text')
+        self.assertFalse(renders.is_sent('a', 'text'))
+
+
+class TestOutboundScheduler(unittest.TestCase):
+
+    def test_token_bucket_delay(self):
+        bucket = TokenBucket(10, 1)
+        now = bucket.updated
+        self.assertEqual(0, bucket.delay(now))
+        bucket.consume(now)
+        self.assertAlmostEqual(0.1, bucket.delay(now))
+        bucket.pause(now, 2)
+        self.assertAlmostEqual(2, bucket.delay(now))
+
+    def test_submit_sends_by_priority(self):
+        scheduler = OutboundScheduler(rate=1000, chat_rate=1, chat_burst=1,
+                                      workers=1)
+        sent = []
+        # Exhaust the chat bucket so the following calls are queued
+        scheduler.submit(EDIT_PRIORITY, 1, sent.append, 'first').result()
+        scheduler.submit(EDIT_PRIORITY, 1, sent.append, 'edit')
+        scheduler.submit(ANSWER_PRIORITY, 1, sent.append, 'answer')
+        scheduler.close()
+        self.assertEqual(['first', 'answer', 'edit'], sent)
+        self.assertEqual(0, scheduler.depth)
+        self.assertGreater(scheduler.stats()['max_wait'], 0.5)
+
+    def test_submit_does_not_wait_for_throttled_chats(self):
+        scheduler = OutboundScheduler(rate=1000, chat_rate=1, chat_burst=1,
+                                      workers=1)
+        sent = []
+        scheduler.submit(EDIT_PRIORITY, 1, sent.append, 'first').result()
+        throttled = scheduler.submit(EDIT_PRIORITY, 1, sent.append, 'throttled')
+        scheduler.submit(EDIT_PRIORITY, 2, sent.append, 'other').result(0.5)
+        self.assertEqual(['first', 'other'], sent)
+        self.assertFalse(throttled.done())
+        scheduler.close()
+        self.assertEqual(['first', 'other', 'throttled'], sent)
+
+    def test_submit_answers_skip_token_buckets(self):
+        scheduler = OutboundScheduler(rate=1, chat_rate=1, chat_burst=1)
+        sent = []
+        scheduler.submit(EDIT_PRIORITY, 1, sent.append, 'edit').result()
+        scheduler.submit(ANSWER_PRIORITY, 1, sent.append, 'answer').result(0.5)
+        scheduler.submit(ANSWER_PRIORITY, None, sent.append, 'answer').result(0.5)
+        self.assertEqual(['edit', 'answer', 'answer'], sent)
+        scheduler.close()
+
+    def test_submit_retries_after_flood_error(self):
+        scheduler = OutboundScheduler(rate=1000)
+        errors = [RetryAfter(0.05)]
+
+        def call():
+            if errors:
+                raise errors.pop()
+            return 'sent'
+        future = scheduler.submit(EDIT_PRIORITY, 1, call)
+        self.assertEqual('sent', future.result(timeout=1))
+        scheduler.close()
+        self.assertEqual(1, scheduler.retried)
+
+    def test_submit_answers_wait_after_flood_error(self):
+        scheduler = OutboundScheduler(rate=1000)
+        sent = []
+
+        def answer(name):
+            sent.append((name, time.monotonic()))
+            if len(sent) == 1:
+                raise RetryAfter(0.1)
+            return True
+        scheduler.submit(ANSWER_PRIORITY, 1, answer, 'first')
+        while not scheduler.retried:
+            time.sleep(0.001)
+        scheduler.submit(EDIT_PRIORITY, 2, answer, 'edit')
+        scheduler.submit(ANSWER_PRIORITY, 2, answer, 'second')
+        scheduler.close()
+        # Answers still jump the queue once the pause is over
+        self.assertEqual(['first', 'first', 'second', 'edit'],
+                         [name for name, _ in sent])
+        self.assertGreaterEqual(sent[1][1] - sent[0][1], 0.1)
+
+    def test_submit_counts_calls_in_metrics(self):
+        metrics = Metrics()
+        scheduler = OutboundScheduler(rate=1000, metrics=metrics)
+        errors = [RetryAfter(0.01)]
+
+        def edit_message_text():
+            if errors:
+                raise errors.pop()
+            return True
+        scheduler.submit(EDIT_PRIORITY, None, edit_message_text).result(timeout=1)
+        scheduler.close()
+        self.assertEqual(1, metrics.value(
+            'api_calls_total', method='edit_message_text', outcome='ok'))
+        self.assertEqual(1, metrics.value(
+            'api_calls_total', method='edit_message_text', outcome='retry_after'))
+        self.assertEqual(2, metrics.histogram(
+            'api_call_seconds', method='edit_message_text').count)
+
+    def test_submit_propagates_errors(self):
+        scheduler = OutboundScheduler(rate=1000)
+        future = scheduler.submit(EDIT_PRIORITY, None, lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(timeout=1)
+        scheduler.close()
+
+
+CALLBACK_QUERY_UPDATE = {
+    'update_id': 1,
+    'callback_query': {
+        'id': '42',
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'user'},
+        'chat_instance': '1',
+        'inline_message_id': 'inline',
+        'data': '1',
+    },
+}
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.received = []
+        self.server = WebhookServer(self.handle, port=0, path='/hook')
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.server.start())
+        self.thread = Thread(
+            target=self.loop.run_until_complete, args=(self.server.serve(),))
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.loop.call_soon_threadsafe(self.server.stop)
+        self.thread.join()
+        self.loop.close()
+        super().tearDown()
+
+    def handle(self, data):
+        self.received.append(data)
+        return {'method': 'answerCallbackQuery'} if 'callback_query' in data else None
+
+    def post(self, path, body):
+        request = urllib.request.Request(
+            'http://127.0.0.1:%d%s' % (self.server.port, path), data=body,
+            headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read()
+
+    def test_post_update_with_answer(self):
+        status, body = self.post(
+            '/hook', json.dumps(CALLBACK_QUERY_UPDATE).encode())
+        self.assertEqual(200, status)
+        self.assertEqual({'method': 'answerCallbackQuery'}, json.loads(body))
+        self.assertEqual([CALLBACK_QUERY_UPDATE], self.received)
+
+    def test_post_update_without_answer(self):
+        status, body = self.post('/hook', b'{"update_id": 2}')
+        self.assertEqual((200, b''), (status, body))
+
+    def test_error_post_to_unknown_path(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.post('/unknown', b'{}')
+        self.assertEqual(404, context.exception.code)
+
+    def test_error_post_bad_json(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.post('/hook', b'{')
+        self.assertEqual(400, context.exception.code)
+        self.assertEqual([], self.received)
+
+    def send(self, request):
+        with socket.create_connection(('127.0.0.1', self.server.port), 5) as client:
+            client.sendall(request)
+            response = b''
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    return response
+                response += data
+
+    def test_error_malformed_request_line(self):
+        response = self.send(b'GARBAGE\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 400 '))
+        self.assertEqual([], self.received)
+
+    def test_error_bad_content_length(self):
+        for length in (b'abc', b'-1'):
+            response = self.send(b'POST /hook HTTP/1.1\r\nContent-Length: %s\r\n'
+                                 b'\r\n{}' % length)
+            self.assertTrue(response.startswith(b'HTTP/1.1 400 '))
+        self.assertEqual([], self.received)
+
+    def test_error_method_and_body_size(self):
+        response = self.send(b'GET /hook HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 405 '))
+        response = self.send(b'POST /hook HTTP/1.1\r\nContent-Length: %d\r\n'
+                             b'\r\n' % (MAX_BODY_SIZE + 1))
+        self.assertTrue(response.startswith(b'HTTP/1.1 413 '))
+        self.assertEqual([], self.received)
+
+
+class TestTelegramCalculatorController(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.controller = TelegramCalculatorController(
+            '123:token', CalculatorService(MemoryCalculatorRepository()),
+            edit_window=0)
+        self.dispatcher = Mock(bot=Bot('123:token'), update_queue=Queue())
+
+    def history(self, reply_to_message):
+        update = Mock()
+        update.message.reply_to_message = reply_to_message
+        self.controller.history_command(update, Mock())
+        self.controller.scheduler.close()
+        return update.message.reply_text
+
+    def run_shard(self, background_handshake):
+        api = FakeBotApi(latency=0.2)
+        api.start()
+        self.addCleanup(api.stop)
+        startup = StartupReport(time.perf_counter())
+        controller = TelegramCalculatorController(
+            '123:token', CalculatorService(MemoryCalculatorRepository()),
+            edit_window=0, base_url=api.base_url, startup=startup,
+            background_handshake=background_handshake)
+        updates = Queue()
+        updates.put(dict(callback_query('1', '1', '1'), update_id=1))
+        updates.put(None)
+        controller.run_shard(updates)
+        return startup.phases()
+
+    def test_run_waits_for_handshake(self):
+        phases = self.run_shard(False)
+        self.assertGreaterEqual(phases[HANDSHAKE], 0.2)
+        self.assertGreaterEqual(phases[READY], phases[HANDSHAKE])
+        self.assertGreaterEqual(phases[FIRST_UPDATE], phases[READY])
+
+    def test_run_handshakes_in_background(self):
+        phases = self.run_shard(True)
+        self.assertLess(phases[READY], 0.2)
+        self.assertLess(phases[FIRST_UPDATE], 0.2)
+
+    def test_history_command_lists_latest_results(self):
+        self.controller.service.evaluate_batch(
+            [('5', key) for key in '2*3=+1=*'])
+        self.history(Mock(message_id=5)).assert_called_once_with(
+            'Latest results:\n7\n6')
+
+    def test_history_command_without_reply(self):
+        self.history(None).assert_called_once_with(
+            'Reply to a calculator message with /history')
+
+    def inline_query(self, query):
+        update = Mock()
+        update.inline_query.query = query
+        self.controller.inlinequery(update, Mock())
+        self.controller.scheduler.close()
+        return update.inline_query.answer
+
+    def test_inlinequery_answers_result_and_calculator(self):
+        answer = self.inline_query('12*(3+4)')
+        answer.assert_called_once_with(
+            [render_result_article('12*(3+4)', 84), CALCULATOR_ARTICLE],
+            cache_time=300, is_personal=False)
+
+    def test_inlinequery_answers_calculator_when_invalid(self):
+        answer = self.inline_query('12*(')
+        answer.assert_called_once_with(
+            [CALCULATOR_ARTICLE], cache_time=300, is_personal=False)
+
+    def test_inlinequery_caches_answers(self):
+        self.controller.answers.put('1+1', [CALCULATOR_ARTICLE])
+        answer = self.inline_query(' 1 + 1')
+        answer.assert_called_once_with(
+            [CALCULATOR_ARTICLE], cache_time=300, is_personal=False)
+        self.assertEqual(1, self.controller.answers.hits)
+
+    def test_webhook_update_answers_callback_query(self):
+        answer = self.controller.webhook_update(
+            self.dispatcher, CALLBACK_QUERY_UPDATE)
+        self.assertEqual({
+            'method': 'answerCallbackQuery', 'callback_query_id': '42',
+        }, answer)
+        self.assertIn('42', self.controller.answered)
+        update = self.dispatcher.update_queue.get_nowait()
+        self.assertEqual('1', update.callback_query.data)
+
+    def press(self, update, key):
+        update.callback_query.data = key
+        self.controller.callbackquery(update, self.context)
+        while len(self.controller.executor):
+            time.sleep(0.001)
+        # Edits are sent after the keypresses are evaluated
+        scheduler = self.controller.scheduler
+        while isinstance(scheduler, OutboundScheduler) and \
+                (scheduler.stats()['depth'] or scheduler.stats()['inflight']):
+            time.sleep(0.001)
+
+    def inline_update(self):
+        update = Mock()
+        update.callback_query.message = None
+        update.callback_query.inline_message_id = 'inline'
+        return update
+
+    def test_callbackquery_edits_inline_message(self):
+        self.context = Mock()
+        self.context.bot.edit_message_text.return_value = True
+        self.press(self.inline_update(), '1')
+        self.context.bot.edit_message_text.assert_called_once_with(
+            render_calculator(Calculator('inline', 0, '1')),
+            inline_message_id='inline',
+            reply_markup=CALCULATOR_KEYBOARD
+        )
+
+    def test_callbackquery_edits_single_keypress_within_window(self):
+        self.controller.coalescer.close()
+        self.controller.coalescer = EditCoalescer(self.controller.executor, 60)
+        self.context = Mock()
+        self.context.bot.edit_message_text.return_value = True
+        self.press(self.inline_update(), '1')
+        self.context.bot.edit_message_text.assert_called_once_with(
+            render_calculator(Calculator('inline', 0, '1')),
+            inline_message_id='inline',
+            reply_markup=CALCULATOR_KEYBOARD
+        )
+        self.assertEqual(1, self.controller.coalescer.sent)
+
+    def test_callbackquery_answers_before_evaluation(self):
+        self.context = Mock()
+        update = self.inline_update()
+        calls = Mock()
+        self.controller.scheduler = calls.scheduler
+        self.controller.service = calls.service
+        self.press(update, '1')
+        self.assertEqual(
+            call.scheduler.submit(ANSWER_PRIORITY, None, update.callback_query.answer),
+            calls.mock_calls[0])
+        self.assertEqual('service.evaluate_batch', calls.mock_calls[1][0])
+
+    def test_callbackquery_edits_without_blocking_in_order(self):
+        self.context = Mock()
+        futures = dict()
+        self.controller.scheduler = Mock()
+        # Futures of edits by text, answers are never done
+        self.controller.scheduler.submit.side_effect = \
+            lambda *args, **kwargs: futures.setdefault(args[3:], Future())
+        update = self.inline_update()
+        # Workers are not blocked by the edit in flight
+        self.press(update, '1')
+        self.press(update, '2')
+        self.press(update, '3')
+        edits = [args for args, _ in self.controller.scheduler.submit.call_args_list
+                 if args[0] == EDIT_PRIORITY]
+        self.assertEqual([render_calculator(Calculator('inline', 0, '1'))],
+                         [args[3] for args in edits])
+        # Only the latest text is sent once the edit in flight is done
+        futures[(render_calculator(Calculator('inline', 0, '1')),)].set_result(True)
+        edits = [args for args, _ in self.controller.scheduler.submit.call_args_list
+                 if args[0] == EDIT_PRIORITY]
+        self.assertEqual([render_calculator(Calculator('inline', 0, '1')),
+                          render_calculator(Calculator('inline', 0, '123'))],
+                         [args[3] for args in edits])
+
+    def test_callbackquery_answered_by_webhook_is_not_answered_again(self):
+        self.context = Mock()
+        self.context.bot.edit_message_text.return_value = True
+        update = self.inline_update()
+        self.controller.answered.add(update.callback_query.id)
+        self.press(update, '1')
+        self.controller.scheduler.close()
+        update.callback_query.answer.assert_not_called()
+
+    def test_deduplicate_stops_handled_updates(self):
+        update = Update.de_json(CALLBACK_QUERY_UPDATE, self.dispatcher.bot)
+        self.controller.deduplicate(update, Mock())
+        with self.assertRaises(DispatcherHandlerStop):
+            self.controller.deduplicate(update, Mock())
+        # Retried by the client in a new update
+        retried = Update.de_json(dict(CALLBACK_QUERY_UPDATE, update_id=2),
+                                 self.dispatcher.bot)
+        with self.assertRaises(DispatcherHandlerStop):
+            self.controller.deduplicate(retried, Mock())
+        self.assertEqual(2, self.controller.recent.duplicates)
+
+    def test_callbackquery_edits_chat_message_by_its_text(self):
+        self.context = Mock()
+        update = Mock()
+        update.callback_query.message.message_id = 5
+        update.callback_query.message.text = 'old'
+        text = render_calculator(Calculator('5', 0, '1'))
+        # Whatever the cache says, the text of the message is checked
+        self.controller.renders.mark_sent('5', text)
+        self.press(update, '1')
+        update.callback_query.message.edit_text.assert_called_once_with(
+            text, reply_markup=CALCULATOR_KEYBOARD)
+        update.callback_query.message.text = render_calculator(
+            Calculator('5', 0, '12'))
+        self.press(update, '2')
+        update.callback_query.message.edit_text.assert_called_once()
+        self.assertEqual(1, self.controller.renders.skipped)
+
+    def test_callbackquery_skips_edit_when_render_unchanged(self):
+        self.context = Mock()
+        self.context.bot.edit_message_text.return_value = True
+        update = self.inline_update()
+        self.press(update, 'c')
+        self.press(update, 'c')
+        self.context.bot.edit_message_text.assert_called_once()
+        self.assertEqual(1, self.controller.renders.skipped)
+
+    def test_callbackquery_edits_inline_message_of_shared_repository(self):
+        server = FakeRespServer()
+        server.start()
+        self.addCleanup(server.stop)
+        repo = RespCalculatorRepository(RespClient(*server.address))
+        self.addCleanup(repo.close)
+        controllers = [
+            TelegramCalculatorController(
+                '123:token', CalculatorService(repo), edit_window=0,
+                render_cache_size=0)
+            for _ in range(2)
+        ]
+        self.context = Mock()
+        self.context.bot.edit_message_text.return_value = True
+        update = self.inline_update()
+        # Pressed on two hosts, the last one rendering again what it sent
+        # before the other cleared it
+        for controller, key in zip(controllers * 2, '1c1'):
+            self.controller = controller
+            self.press(update, key)
+        self.assertEqual(
+            [render_calculator(Calculator('inline', 0, expr))
+             for expr in ('1', '', '1')],
+            [args[0] for args, _ in
+             self.context.bot.edit_message_text.call_args_list])
+
+    def test_webhook_update_without_answer(self):
+        answer = self.controller.webhook_update(
+            self.dispatcher, {'update_id': 2})
+        self.assertIsNone(answer)
+        self.assertEqual(1, self.dispatcher.update_queue.qsize())
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_replay_trace(self):
+        service = CalculatorService(MemoryCalculatorRepository())
+        latencies = replay(service, iter([('a', '2'), ('a', '*'), ('a', '3'),
+                                          ('a', '=')]))
+        self.assertEqual(4, len(latencies))
+        self.assertEqual(6, service.get_or_create_calculator('a').unwrap().value)
+
+    def test_replay_trace_over_every_repository(self):
+        for name, create in REPOSITORIES.items():
+            with tempfile.TemporaryDirectory() as directory:
+                repo = create(directory)
+                service = CalculatorService(repo)
+                replay(service, iter([('a', '2'), ('a', '+'), ('a', '3'),
+                                      ('a', '=')]))
+                self.assertEqual(5, service.get_or_create_calculator('a')
+                                 .unwrap().value, name)
+                repo.close()
+
+    def test_regressions(self):
+        baseline = [{'repository': 'memory', 'trace': 'short_sums',
+                     'ops_per_second': 100, 'p50_us': 10, 'p99_us': 20,
+                     'peak_memory_bytes': 1000}]
+        results = [dict(baseline[0], ops_per_second=70, p99_us=21)]
+        self.assertEqual(1, len(regressions(results, baseline, 0.2)))
+        self.assertEqual([], regressions(baseline, baseline, 0.2))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.metrics = Metrics()
+
+    def test_render_histogram(self):
+        self.metrics.observe('handler_seconds', 0.002, handler='start')
+        self.metrics.observe('handler_seconds', 20, handler='start')
+        text = self.metrics.render()
+        self.assertIn('# TYPE calculator_bot_handler_seconds histogram', text)
+        self.assertIn('calculator_bot_handler_seconds_bucket'
+                      '{handler="start",le="0.001"} 0', text)
+        self.assertIn('calculator_bot_handler_seconds_bucket'
+                      '{handler="start",le="0.0025"} 1', text)
+        self.assertIn('calculator_bot_handler_seconds_bucket'
+                      '{handler="start",le="+Inf"} 2', text)
+        self.assertIn('calculator_bot_handler_seconds_count{handler="start"} 2',
+                      text)
+
+    def test_render_counters_and_gauges(self):
+        self.metrics.count('api_calls_total', method='answer', outcome='ok')
+        self.metrics.count('api_calls_total', method='answer', outcome='ok')
+        self.metrics.gauge('queue_depth', lambda: 3, queue='outbound')
+        text = self.metrics.render()
+        self.assertIn('calculator_bot_api_calls_total'
+                      '{method="answer",outcome="ok"} 2', text)
+        self.assertIn('calculator_bot_queue_depth{queue="outbound"} 3', text)
+
+    def test_timed(self):
+        timed = self.metrics.timed('evaluation_seconds', lambda x: x * 2)
+        self.assertEqual(4, timed(2))
+        self.assertEqual(1, self.metrics.histogram('evaluation_seconds').count)
+
+    def test_serve(self):
+        self.metrics.count('skipped_edits_total')
+        port = self.metrics.serve('127.0.0.1', 0)
+        try:
+            url = 'http://127.0.0.1:%d' % port
+            with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+                self.assertIn(b'calculator_bot_skipped_edits_total 1',
+                              response.read())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/other', timeout=5)
+        finally:
+            self.metrics.close()
+
+    def test_service_times_evaluation(self):
+        service = CalculatorService(MemoryCalculatorRepository(),
+                                    metrics=self.metrics)
+        service.evaluate_batch([('a', '1'), ('a', '+'), ('a', '2'), ('a', '=')])
+        self.assertEqual(1, self.metrics.histogram('evaluation_seconds').count)
+
+
+class TestSlowUpdateProfiler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_sampled_updates_are_profiled(self):
+        profiler = SlowUpdateProfiler(self.directory.name, sample_rate=1)
+        handler = profiler.wrap('start', lambda update, context: 'handled')
+        self.assertEqual('handled', handler(Mock(update_id=7), None))
+        self.assertEqual(1, len(self.profiles()))
+        self.assertTrue(self.profiles()[0].endswith('-7-start.prof'))
+
+    def test_slow_updates_are_profiled(self):
+        profiler = SlowUpdateProfiler(self.directory.name, threshold=0.1)
+        handler = profiler.wrap('callbackquery',
+                                lambda update, seconds: time.sleep(seconds))
+        handler(Mock(update_id=1), 0)
+        self.assertEqual([], self.profiles())
+        handler(Mock(update_id=2), 0.15)
+        self.assertEqual(1, len(self.profiles()))
+        self.assertIn('-2-callbackquery', self.profiles()[0])
+
+    def test_unsampled_updates_are_not_profiled(self):
+        profiler = SlowUpdateProfiler(self.directory.name)
+        profiler.wrap('start', lambda update: None)(Mock(update_id=1))
+        self.assertEqual([], self.profiles())
+
+    def test_keeps_latest_profiles(self):
+        profiler = SlowUpdateProfiler(self.directory.name, sample_rate=1, keep=2)
+        handler = profiler.wrap('callbackquery_batch', lambda message_id: None)
+        for message_id in ('a', 'b', 'c'):
+            handler(message_id)
+        self.assertEqual(2, len(self.profiles()))
+        self.assertIn('-c-callbackquery_batch', self.profiles()[-1])
+        self.assertEqual(3, profiler.saved)
+
+
+def echo_shard(index, updates, results):
+    while True:
+        data = updates.get()
+        if data is None:
+            return
+        results.put((index, data['update_id']))
+
+
+def keypress(update_id, message_id):
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'inline_message_id': message_id, 'data': '1'}}
+
+
+class TestShardPool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.results = multiprocessing.get_context('spawn').Queue()
+        self.pool = ShardPool(2, echo_shard, self.results)
+
+    def received(self, count):
+        return [self.results.get(timeout=10) for _ in range(count)]
+
+    def test_shard_key(self):
+        self.assertEqual('inline', shard_key(keypress(1, 'inline')))
+        self.assertEqual('5', shard_key({'callback_query': {
+            'message': {'message_id': 5}}}))
+        self.assertIsNone(shard_key({'update_id': 1, 'message': {}}))
+        self.assertEqual('5', shard_key({'message': {
+            'text': '/history', 'reply_to_message': {'message_id': 5}}}))
+
+    def test_route_keeps_messages_in_a_shard(self):
+        shards = {self.pool.shard(keypress(id_, 'a')) for id_ in range(10)}
+        self.assertEqual(1, len(shards))
+        self.assertEqual({0, 1}, {self.pool.shard({'update_id': id_})
+                                  for id_ in range(2)})
+
+    def test_restart_keeps_queued_updates_in_order(self):
+        self.pool.start()
+        index = self.pool.route(keypress(1, 'a'))
+        self.pool.restart(index)
+        self.pool.route(keypress(2, 'a'))
+        self.pool.close()
+        self.assertEqual([(index, 1), (index, 2)], self.received(2))
+        self.assertEqual(1, self.pool.restarts)
+
+    def test_sharded_controller_answers_callback_queries(self):
+        pool = Mock()
+        controller = ShardedController('123:token', pool)
+        self.assertEqual({
+            'method': 'answerCallbackQuery', 'callback_query_id': '1',
+        }, controller.webhook_update(keypress(1, 'a')))
+        self.assertTrue(pool.route.call_args[0][0][ANSWERED_INLINE])
+        self.assertIsNone(controller.webhook_update({'update_id': 2}))
+        self.assertEqual(2, pool.route.call_count)
+
+
+class TestFakeBotApi(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeBotApi()
+        self.api.start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def post(self, method, params):
+        request = urllib.request.Request(
+            '%s123:token/%s' % (self.api.base_url, method),
+            data=json.dumps(params).encode(),
+            headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, json.loads(error.read())
+
+    def test_get_updates_confirms_offset(self):
+        first = self.api.push_update({'message': None})
+        second = self.api.push_update({'message': None})
+        _, response = self.post('getUpdates', {'timeout': 0})
+        self.assertEqual([first, second],
+                         [update['update_id'] for update in response['result']])
+        _, response = self.post('getUpdates', {'offset': second, 'timeout': 0})
+        self.assertEqual([second],
+                         [update['update_id'] for update in response['result']])
+
+    def test_get_updates_long_polls(self):
+        Thread(target=lambda: (time.sleep(0.1),
+                               self.api.push_update({'message': None}))).start()
+        _, response = self.post('getUpdates', {'timeout': 5})
+        self.assertEqual(1, len(response['result']))
+
+    def test_flood_errors(self):
+        self.api.flood_rate = 1
+        status, response = self.post('editMessageText',
+                                     {'inline_message_id': '1', 'text': 'x'})
+        self.assertEqual(429, status)
+        self.assertEqual(1, response['parameters']['retry_after'])
+        self.assertEqual(1, len(self.api.calls_of('editMessageText')))
+
+
+class TestSampledFilter(unittest.TestCase):
+
+    def records(self, sampler, count, function='handler', msg='failed: %s'):
+        return [sampler.filter(logging.makeLogRecord(
+            {'funcName': function, 'msg': msg, 'args': (index,)}))
+            for index in range(count)]
+
+    def test_samples_records_past_burst(self):
+        sampler = SampledFilter(burst=2, sample=3)
+        self.assertEqual([True, True, False, False, True, False, False, True],
+                         self.records(sampler, 8))
+        self.assertEqual(4, sampler.suppressed)
+
+    def test_keys_by_function_and_message(self):
+        sampler = SampledFilter(burst=1, sample=100)
+        self.assertEqual([True, False], self.records(sampler, 2))
+        self.assertEqual([True], self.records(sampler, 1, function='other'))
+        self.assertEqual([True], self.records(sampler, 1, msg='other: %s'))
+
+    def test_summaries_restart_counts(self):
+        sampler = SampledFilter(burst=1, sample=100)
+        self.records(sampler, 5)
+        self.records(sampler, 1, function='other')
+        summaries = sampler.summaries()
+        self.assertEqual(['Suppressed 4 of 5 records of handler like: failed: %s'],
+                         [summary.getMessage() for summary in summaries])
+        self.assertEqual([], sampler.summaries())
+        self.assertEqual([True, False], self.records(sampler, 2))
+
+
+class TestBackgroundLogging(unittest.TestCase):
+
+    def setUp(self):
+        # Not registered, so no other handler is attached to it
+        self.logger = logging.Logger('test.background', logging.DEBUG)
+        self.written = BufferingHandler(1000)
+        self.logger.addHandler(self.written)
+
+    def test_writes_records_formatted_once_written(self):
+        logs = BackgroundLogging()
+        logs.install(self.logger)
+        self.assertEqual([logs.handler], self.logger.handlers)
+        self.logger.error('failed: %s', 1)
+        logs.close()
+        self.assertEqual([self.written], self.logger.handlers)
+        [record] = self.written.buffer
+        self.assertEqual((1,), record.args)
+        self.assertEqual('failed: 1', record.getMessage())
+
+    def test_summarizes_suppressed_records(self):
+        logs = BackgroundLogging(burst=2, sample=100)
+        logs.install(self.logger)
+        for index in range(50):
+            self.logger.error('failed: %s', index)
+        logs.close()
+        self.assertEqual(48, logs.suppressed)
+        self.assertEqual(
+            ['failed: 0', 'failed: 1',
+             'Suppressed 48 of 50 records of test_summarizes_suppressed_records '
+             'like: failed: %s'],
+            [record.getMessage() for record in self.written.buffer])
+
+    def test_drops_records_while_queue_full(self):
+        logs = BackgroundLogging(size=1, sample=1)
+        for index in range(3):
+            logs.handler.handle(logging.makeLogRecord({'msg': str(index)}))
+        self.assertEqual(2, logs.dropped)
+        self.assertEqual('0', logs.queue.get_nowait().msg)
+
+
+class TestStartupReport(unittest.TestCase):
+
+    def test_records_phases_once(self):
+        startup = StartupReport(time.perf_counter() - 1)
+        self.assertTrue(startup.mark(READY))
+        self.assertFalse(startup.mark(READY))
+        self.assertTrue(startup.record(HANDSHAKE, 0.5))
+        self.assertFalse(startup.record(HANDSHAKE, 0.25))
+        phases = startup.phases()
+        self.assertGreaterEqual(phases[READY], 1)
+        self.assertEqual(0.5, phases[HANDSHAKE])
+        self.assertEqual(['ready', 'handshake'],
+                         [phase.split()[0] for phase in str(startup).split(', ')])
+
+    def test_gauges_phases(self):
+        metrics = Metrics()
+        startup = StartupReport()
+        startup.record(IMPORT, 0.25)
+        startup.gauge(metrics)
+        startup.record(HANDSHAKE, 0.5)
+        self.assertEqual(0.25, metrics.value('startup_seconds', phase='import'))
+        self.assertEqual(0.5, metrics.value('startup_seconds', phase='handshake'))
+
+
+class TestPooledRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeBotApi()
+        self.api.start()
+        self.request = PooledRequest(2, polling=PooledRequest(1))
+        self.bot = Bot('123:token', base_url=self.api.base_url,
+                       request=self.request)
+
+    def tearDown(self):
+        self.request.stop()
+        self.api.stop()
+
+    def test_reuses_connections(self):
+        for _ in range(5):
+            self.bot.answer_callback_query('1')
+        stats = self.request.stats()
+        self.assertEqual(5, stats['requests'])
+        self.assertEqual(1, stats['connections'])
+        self.assertAlmostEqual(0.8, stats['reuse_rate'])
+
+    def test_polls_through_polling_request(self):
+        self.bot.get_updates(timeout=0)
+        self.assertEqual(0, self.request.stats()['requests'])
+        self.assertEqual(1, self.request.polling.stats()['requests'])
+
+    def test_waits_for_free_connection(self):
+        self.api.latency = 0.05
+        threads = [Thread(target=self.bot.answer_callback_query, args=(str(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.request.stats()
+        self.assertEqual(4, stats['requests'])
+        self.assertLessEqual(stats['connections'], 2)
+        self.assertGreater(stats['waits'], 0)
+        self.assertGreater(stats['mean_wait'], 0.0)
+
 
 if __name__ == '__main__':
     unittest.main()